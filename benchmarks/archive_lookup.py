@@ -0,0 +1,80 @@
+# Compares resource lookups through the archive's name index against the old linear search.
+# Run from the repository root: python -m benchmarks.archive_lookup [resource count]
+import os
+import sys
+import random
+import timeit
+from io import BytesIO
+
+from lib.lua.bwarchivelib import (BattalionArchive, TextureArchive, TextureBW2, SoundArchive, Sound,
+                                  Model, Animation, Effect, LuaScript)
+
+
+def make_archive(count):
+    arc = BattalionArchive()
+    arc.textures = TextureArchive(b"RXET", b"Benchmark", [], False)
+    arc.sounds = SoundArchive(b"Benchmark", [])
+    arc.sections.extend((arc.textures, arc.sounds))
+
+    for i in range(count):
+        arc.textures.textures.append(TextureBW2(b"DXTG", "Texture_{0}".format(i), os.urandom(64)))
+        arc.sounds.sounds.append(Sound("Sound_{0}".format(i), os.urandom(32)))
+        arc.sections.append(Model("Model_{0}".format(i), os.urandom(64)))
+        arc.sections.append(Animation("Anim_{0}".format(i), os.urandom(32)))
+        arc.sections.append(Effect("Effect_{0}".format(i), b"effect"))
+        arc.sections.append(LuaScript(b"PRCS", "Script_{0}".format(i), os.urandom(32)))
+
+    # Write and read it back so the archive is set up the same way as a loaded level
+    tmp = BytesIO()
+    arc.write(tmp)
+    tmp.seek(0)
+    return BattalionArchive.from_file(tmp)
+
+
+def get_resource_linear(arc, restype, resname):
+    for res in arc._get_resource_list(restype):
+        if res.secname == restype and res.name.lower() == resname.lower():
+            return res
+    return None
+
+
+def get_script_linear(arc, script_name):
+    for sec in arc.sections:
+        if sec.secname == b"PRCS" and sec.name == script_name:
+            return sec
+    return None
+
+
+def main(count):
+    arc = make_archive(count)
+
+    lookups = []
+    for i in range(count):
+        lookups.append((b"DXTG", "TEXTURE_{0}".format(i)))
+        lookups.append((b"HPSD", "sound_{0}".format(i)))
+        lookups.append((b"LDOM", "Model_{0}".format(i)))
+        lookups.append((b"MINA", "anim_{0}".format(i)))
+        lookups.append((b"FEQT", "EFFECT_{0}".format(i)))
+    random.shuffle(lookups)
+    scripts = ["Script_{0}".format(i) for i in range(count)]
+    random.shuffle(scripts)
+
+    for restype, resname in lookups:
+        assert arc.get_resource(restype, resname) is get_resource_linear(arc, restype, resname)
+    for script_name in scripts:
+        assert arc.get_script(script_name) is get_script_linear(arc, script_name)
+
+    print("{0} resources per type, {1} resource lookups, {2} script lookups".format(count, len(lookups), len(scripts)))
+
+    for name, func in (
+            ("get_resource (linear)", lambda: [get_resource_linear(arc, t, n) for t, n in lookups]),
+            ("get_resource (index)", lambda: [arc.get_resource(t, n) for t, n in lookups]),
+            ("get_script (linear)", lambda: [get_script_linear(arc, n) for n in scripts]),
+            ("get_script (index)", lambda: [arc.get_script(n) for n in scripts])):
+        total = min(timeit.repeat(func, number=1, repeat=3))
+        lookupcount = len(scripts) if "script" in name else len(lookups)
+        print("{0:24} {1:8.3f} s {2:12.0f} lookups/s".format(name, total, lookupcount/total))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
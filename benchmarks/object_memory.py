@@ -0,0 +1,92 @@
+# Compares the memory used by objects that keep their fields and editor state in slots against the
+# old BattalionObject, which kept all of them in the instance dict.
+# Run from the repository root: python -m benchmarks.object_memory [object count]
+import os
+import sys
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+from lib.BattalionXMLLib import BattalionLevelFile, BattalionObject, decode_field
+
+
+class DictFieldsObject(object):
+    # The old BattalionObject: every field is decoded when the object is created and kept in the
+    # instance dict along with the editor state, and every object has its own getmatrix function
+    def __init__(self, level, node):
+        self._node = node
+        self._level = level
+        self.getmatrix = lambda: None
+
+        self._attributes = {}
+        self._custom_name = ""
+        self.lua_name = ""
+
+        self._referenced_by = set()
+
+        for attr_node in node:
+            setattr(self, attr_node.attrib["name"], decode_field(attr_node))
+
+        if hasattr(self, "Mat"):
+            self.getmatrix = lambda: self.Mat
+        elif hasattr(self, "mMatrix"):
+            self.getmatrix = lambda: self.mMatrix
+
+        self.height = None
+        self.dirty = True
+        self.deleted = False
+
+        self.mtxoverride = None
+
+
+def make_level(count):
+    path = "resources/basetemplates/BW2"
+    templates = [etree.parse(os.path.join(path, filename)).getroot()
+                 for filename in sorted(os.listdir(path)) if filename.endswith(".xml")]
+
+    root = etree.Element("Instances")
+    for i in range(count):
+        template = templates[i % len(templates)]
+        node = etree.SubElement(root, "Object", {"type": template.attrib["type"], "id": str(100000 + i)})
+        node.extend(template)
+    return root
+
+
+def create_objects(cls, level, root):
+    return [cls(level, node) for node in root]
+
+
+def read_fields(objects):
+    for obj in objects:
+        for attr_node in obj._node:
+            getattr(obj, attr_node.attrib["name"])
+
+
+def measure(cls, level, root):
+    tracemalloc.start()
+    objects = create_objects(cls, level, root)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    readtime = min(timeit.repeat(lambda: read_fields(objects), number=1, repeat=5))
+    return objects, size, readtime
+
+
+def main(count):
+    level = BattalionLevelFile()
+    root = make_level(count)
+    fieldcount = sum(len(node) for node in root)
+    print("{0} objects with {1} fields".format(count, fieldcount))
+
+    old, oldsize, oldtime = measure(DictFieldsObject, level, root)
+    del old
+    new, newsize, newtime = measure(BattalionObject, level, root)
+    del new
+
+    print("Instance dict: {0:.2f} MB, {1:.0f} bytes per object".format(oldsize/1024**2, oldsize/count))
+    print("Schema slots:  {0:.2f} MB, {1:.0f} bytes per object".format(newsize/1024**2, newsize/count))
+    print("Reading every field: {0:.2f} ms vs {1:.2f} ms".format(oldtime*1000, newtime*1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,72 @@
+# Compares searching a synthetic level by walking the query tree for every object against the compiled
+# query, with and without the search index.
+# Run from the repository root: python -m benchmarks.search_query [object count]
+import sys
+import timeit
+from io import BytesIO
+
+from lib.BattalionXMLLib import BattalionLevelFile
+from lib.searchquery import create_query, CompiledQuery
+
+QUERIES = [
+    "self.type = cTroop",
+    "self.mBase.mName = Base_7",
+    "self.type = cGroundVehicle & self.mHealth > 50",
+    "self.mName contains Unit_12",
+    "(self.type = cTroop | self.type = cAirVehicle) & self.mHealth <= 10",
+    "self.mHealth > 90"
+]
+
+UNIT_TYPES = ["cTroop", "cGroundVehicle", "cAirVehicle", "cBuilding", "cWaypoint"]
+
+
+def make_level(count):
+    basecount = 50
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', "<Instances>"]
+    for i in range(basecount):
+        lines.append('<Object type="sTroopBase" id="{0}">'.format(1000 + i))
+        lines.append('<Attribute name="mName" type="cFxString8" elements="1"><Item>Base_{0}</Item></Attribute>'.format(i))
+        lines.append('<Resource name="mBAN_Model" type="cNodeHierarchyResource" elements="1"><Item>0</Item></Resource>')
+        lines.append("</Object>")
+
+    for i in range(count):
+        lines.append('<Object type="{0}" id="{1}">'.format(UNIT_TYPES[i % len(UNIT_TYPES)], 100000 + i))
+        lines.append('<Attribute name="mName" type="cFxString8" elements="1"><Item>Unit_{0}</Item></Attribute>'.format(i))
+        lines.append('<Attribute name="mHealth" type="sInt32" elements="1"><Item>{0}</Item></Attribute>'.format(i % 100))
+        lines.append('<Pointer name="mBase" type="sTroopBase" elements="1"><Item>{0}</Item></Pointer>'.format(
+            1000 + (i*7) % basecount))
+        lines.append("</Object>")
+    lines.append("</Instances>")
+
+    level = BattalionLevelFile(BytesIO("\n".join(lines).encode("utf-8")))
+    level.resolve_pointers(None)
+    return level
+
+
+def search_interpreted(query, objects):
+    return [(obj, query.get_values(obj)) for obj in objects if query.evaluate(obj)]
+
+
+def main(count):
+    level = make_level(count)
+    objects = list(level.objects.values())
+    index = level.get_search_index()
+
+    for querytext in QUERIES:
+        query = create_query(querytext)
+        compiled = CompiledQuery(query)
+
+        expected = search_interpreted(query, objects)
+        assert compiled.search(objects) == expected
+        assert compiled.search(objects, index) == expected
+
+        interpreted = min(timeit.repeat(lambda: search_interpreted(query, objects), number=1, repeat=3))
+        scan = min(timeit.repeat(lambda: compiled.search(objects), number=1, repeat=3))
+        indexed = min(timeit.repeat(lambda: compiled.search(objects, index), number=1, repeat=3))
+        print("{0}: {1} results".format(querytext, len(expected)))
+        print("    query tree {0:.2f} ms, compiled {1:.2f} ms, compiled with index {2:.2f} ms".format(
+            interpreted*1000, scan*1000, indexed*1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
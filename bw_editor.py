@@ -609,7 +609,7 @@ class LevelEditor(QMainWindow):
 
     def connect_actions(self):
         self.level_view.select_update.connect(self.action_update_info)
-        self.level_view.select_update.connect(self.select_from_3d_to_treeview)
+        self.level_view.selection_changed.connect(self.select_from_3d_to_treeview)
         self.level_view.select_update.connect(self.update_model_viewer)
         self.level_view.select_update.connect(lambda: self.plugin_handler.execute_event("select_update", self))
         #self.pik_control.lineedit_coordinatex.textChanged.connect(self.create_field_edit_action("coordinatex"))
@@ -904,6 +904,7 @@ class LevelEditor(QMainWindow):
                         obj.y = obj.position_y = round(y, 6)
                         obj.offset_y = 0"""
                 mtx.add_position(deltax, deltay, deltaz)
+            self.mark_selected_dirty()
 
 
 
@@ -1052,6 +1053,7 @@ class LevelEditor(QMainWindow):
                         mtx[14] = position.z
                     else:
                         obj.setposition(position.x, position.y, position.z)
+        self.mark_selected_dirty()
 
         #self.pikmin_gen_view.update()
         self.level_view.do_redraw(forceselected=True)
@@ -1066,12 +1068,19 @@ class LevelEditor(QMainWindow):
 
             if height is not None:
                 pos.y = height
+        self.mark_selected_dirty()
 
         self.pik_control.update_info()
         self.level_view.center_gizmo(self.dolphin.do_visualize())
         self.set_has_unsaved_changes(True)
         self.level_view.do_redraw()
 
+    def mark_selected_dirty(self):
+        # The matrices of the selected objects were edited in place
+        for obj in self.level_view.selected:
+            if isinstance(obj, BattalionObject):
+                obj.mark_dirty()
+
     def delete_objects(self, objects):
         self.level_file.delete_objects(objects)
         self.preload_file.delete_objects(objects)
@@ -1145,12 +1154,12 @@ class LevelEditor(QMainWindow):
             self.level_view.center_gizmo(self.dolphin.do_visualize())
         self.level_view.do_redraw()
 
-    def select_from_3d_to_treeview(self):
+    def select_from_3d_to_treeview(self, added, removed):
         if self.level_file is not None:
             selected = self.level_view.selected
             if len(selected) == 1:
                 currentobj = selected[0]
-                item = None
+                item = self.leveldatatreeview.get_item(currentobj)
                 """if isinstance(currentobj, libbol.EnemyPoint):
                     for i in range(self.leveldatatreeview.enemyroutes.childCount()):
                         child = self.leveldatatreeview.enemyroutes.child(i)
@@ -1160,9 +1169,11 @@ class LevelEditor(QMainWindow):
 
 
                 #assert item is not None
-                if item is not None:
-                    #self._dontselectfromtree = True
+                if item is not None and item is not self.leveldatatreeview.currentItem():
+                    # Don't let the tree select the object again
+                    self.leveldatatreeview.blockSignals(True)
                     self.leveldatatreeview.setCurrentItem(item)
+                    self.leveldatatreeview.blockSignals(False)
 
     @catch_exception
     def action_update_info(self):
@@ -1300,6 +1311,7 @@ class HistoryEntryBW(HistoryEntry):
         if currmtx is not None:
             for i in range(16):
                 currmtx.mtx[i] = self.data1[i]
+            self.obj.mark_dirty()
             self.obj.update_xml()
 
     @classmethod
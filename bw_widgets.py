@@ -32,18 +32,20 @@ from widgets.editor_widgets import catch_exception, catch_exception_with_dialog
 from opengltext import draw_collision
 from lib.vectors import Matrix4x4, Vector3, Line, Plane, Triangle
 from lib.model_rendering import TexturedPlane, Model, Grid, GenericObject, Material, Minimap
-from lib.shader import create_default_shader
 from gizmo import Gizmo
 from lib.object_models import ObjectModels
 from editor_controls import UserControl, MouseMode, EditorMouseMode
 import numpy
 from lib.BattalionXMLLib import BattalionLevelFile, BattalionObject
 from lib.bw_terrain import BWTerrainV2
-from lib.bw.bwmodelrender import BWModelHandler
+from lib.bw.bwmodelrender import BWModelHandler, set_model_cache_budget
 from lib.graphics import Graphics
+from lib.selection import SelectionSet
+from lib.render.model_renderingv2 import render_state
+from lib.render.terrain_rendering import TerrainModel
 from widgets.filter_view import FilterViewMenu
 from widgets.editor_widgets import GizmoWidget
-from lib.bw.texture import OpenGLTexture
+from lib.bw.texture import OpenGLTexture, set_texture_cache_budget
 
 import typing
 if typing.TYPE_CHECKING:
@@ -167,6 +169,10 @@ class FPSCounter(QtWidgets.QLabel):
         self.frametime_terrain = 0
         self.frametime_objects = 0
         self.frametime_liveedit = 0
+        self.texture_binds = 0
+        self.skipped_binds = 0
+        self.draw_calls = 0
+        self.culling = None
         self.update_frametime()
 
     def paintEvent(self, event):
@@ -201,7 +207,14 @@ class FPSCounter(QtWidgets.QLabel):
         terraintime = "Terrain: {0:.0f}msec ({1:.1f}%)".format(self.frametime_terrain*1000, (self.frametime_terrain/self.frametime_total)*100)
         objecttime = "Objects: {0:.0f}msec ({1:.1f}%)".format(self.frametime_objects*1000, (self.frametime_objects/self.frametime_total)*100)
         liveedit = "Live View: {0:.0f}msec".format(self.frametime_liveedit*1000)
-        self.setText("\n".join((total, terraintime, objecttime, liveedit)))
+        binds = "Binds: {0} ({1} skipped)".format(self.texture_binds, self.skipped_binds)
+        draws = "Draw calls: {0}".format(self.draw_calls)
+        lines = [total, terraintime, objecttime, liveedit, binds, draws]
+        if self.culling is not None:
+            lines.append("Culled: {0}/{1} objects, {2}/{3} instances".format(
+                self.culling["culled_objects"], self.culling["culled_objects"] + self.culling["visible_objects"],
+                self.culling["culled_instances"], self.culling["culled_instances"] + self.culling["submitted_instances"]))
+        self.setText("\n".join(lines))
 
 
 class CustomText(QtWidgets.QLabel):
@@ -316,6 +329,7 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
     position_update = pyqtSignal(QMouseEvent, tuple)
     height_update = pyqtSignal(float)
     select_update = pyqtSignal()
+    selection_changed = pyqtSignal(list, list)  # added, removed
     move_points = pyqtSignal(float, float, float)
     connect_update = pyqtSignal(int, int)
     create_waypoint = pyqtSignal(float, float)
@@ -351,10 +365,10 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         self.right_button_down = False
         self.drag_last_pos = None
 
-        self.selected = []
+        self._selected = SelectionSet()
+        self._selected_positions = SelectionSet()
+        self._selected_rotations = SelectionSet()
         self.selected_misc = []
-        self.selected_positions = []
-        self.selected_rotations = []
         self.waterheight = None
 
         #self.p = QPainter()
@@ -461,7 +475,7 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
                                None)
         self.overlay_texture = OpenGLTexture.create_dummy(512, 512, mag_filter=GL_NEAREST)
         self.bwterrain: BWTerrainV2 = None
-        self.terrainmap = None
+        self.terrainmodel = TerrainModel()
         self._lasthit = []
         self._hitcycle = 0
         #ith open("lib/MP4.out", "rb") as f:
@@ -497,7 +511,69 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         self.gizmo_visibility_widget.rotationbutton.pressed.connect(self.toggle_rotation_gizmo)
         self.gizmo_visibility_widget.cubebutton.pressed.connect(self.toggle_cube_visibility)
 
+        # Connected first so that the selection deltas go out before anything else reacts to select_update
+        self.select_update.connect(self.emit_selection_changes)
         self.select_update.connect(lambda: self.do_redraw(force=True))
+        self.selection_changed.connect(self.update_gizmo)
+
+    @property
+    def selected(self):
+        return self._selected
+
+    @selected.setter
+    def selected(self, objects):
+        self._selected.replace(objects)
+
+    @property
+    def selected_positions(self):
+        return self._selected_positions
+
+    @selected_positions.setter
+    def selected_positions(self, positions):
+        self._selected_positions.replace(positions)
+
+    @property
+    def selected_rotations(self):
+        return self._selected_rotations
+
+    @selected_rotations.setter
+    def selected_rotations(self, rotations):
+        self._selected_rotations.replace(rotations)
+
+    def select(self, objects, add=False):
+        # Selects the objects together with their matrices, add keeps the current selection
+        if not add:
+            self.selected = filter_combine(self.selected, [], (BattalionObject, ))
+            self.selected_positions = filter_combine(self.selected_positions, [], (BWMatrix, ))
+            self.selected_rotations = filter_combine(self.selected_rotations, [], (BWMatrix, ))
+
+        for obj in objects:
+            self._selected.append(obj)
+            mtx = obj.getmatrix()
+            if mtx is not None:
+                self._selected_positions.append(mtx)
+
+    def deselect(self, objects):
+        for obj in objects:
+            self._selected.discard(obj)
+            mtx = obj.getmatrix()
+            if mtx is not None:
+                self._selected_positions.discard(mtx)
+                self._selected_rotations.discard(mtx)
+
+    def emit_selection_changes(self):
+        added, removed = self._selected.take_changes()
+        self._selected_positions.take_changes()
+        self._selected_rotations.take_changes()
+        if added or removed:
+            self.selection_changed.emit(added, removed)
+
+    def update_gizmo(self, added, removed):
+        if self.selected_misc:
+            self.center_gizmo(self.dolphin.do_visualize())
+        else:
+            self.gizmo.update_average(added, removed, self.selected, self.bwterrain, self.waterheight,
+                                      self.dolphin.do_visualize())
 
     def toggle_translation_gizmo(self):
         self.translation_visible = not self.translation_visible
@@ -551,150 +627,44 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         if self.bwmodelhandler is None:
             return
 
+        bwterrain = BWTerrainV2(f)
+        print("Terrain read")
+        self.set_terrain(bwterrain, callback)
+
+    def set_terrain(self, bwterrain, callback=None):
+        # Parsing the terrain doesn't need the GL context so it can happen in another thread,
+        # this part has to run on the UI thread.
+        if self.bwmodelhandler is None:
+            return
+
         self.overlay_texture.init()
-        self.bwterrain = BWTerrainV2(f)
+        self.bwterrain = bwterrain
         self.makeCurrent()
-        print("Terrain read")
 
-        if self.terrainmap is not None:
-            for entry in self.terrainmap:
-                glDeleteLists(entry, 1)
+        self.terrainmodel.free()
 
-        print("Lists cleared")
+        print("Buffers cleared")
         for i, material in enumerate(self.bwterrain.materials):
             self.bwmodelhandler.textures.initialize_texture(material.mat1, mipmap=True)
             self.bwmodelhandler.textures.initialize_texture(material.mat2, mipmap=True)
             if callback is not None:
                 callback(len(self.bwterrain.materials), i)
         print("Materials initialized")
-        self.terrainmap = []
-
-        glColor4f(0.0, 0.0, 0.0, 1.0)
-        for meshindex, meshes in self.bwterrain.meshes.items():
-            mesh = glGenLists(1)
-            glNewList(mesh, GL_COMPILE)
-            glBegin(GL_QUADS)
-            for tilemesh in meshes:
-                for quad in tilemesh.quads:
-                    vtx = tilemesh.vertices[quad[0]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0]+2048)/4096.0, (vtx.pos[2]+2048)/4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[1]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[2]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[3]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-            glEnd()
-
-            # 11 12
-            # 13 14
 
-            # 21 22
-            # 23 24
-
-            #
-            """for tilemesh in meshes:
-                minaabb, maxaabb = tilemesh.aabb.min, tilemesh.aabb.max
-                corner_11 = minaabb.x, minaabb.z, minaabb.y
-                corner_12 = maxaabb.x, minaabb.z, minaabb.y
-                corner_13 = minaabb.x, maxaabb.z, minaabb.y
-                corner_14 = maxaabb.x, maxaabb.z, minaabb.y
-
-                corner_21 = minaabb.x, minaabb.z, maxaabb.y
-                corner_22 = maxaabb.x, minaabb.z, maxaabb.y
-                corner_23 = minaabb.x, maxaabb.z, maxaabb.y
-                corner_24 = maxaabb.x, maxaabb.z, maxaabb.y
-                glBegin(GL_LINE_LOOP)
-                glVertexAttrib4f(2, 0, 0, 0, 1.0)
-                glVertex3f(*corner_11)
-                glVertex3f(*corner_12)
-                glVertex3f(*corner_14)
-                glVertex3f(*corner_13)
-                glEnd()
-
-                glBegin(GL_LINE_LOOP)
-                glVertex3f(*corner_21)
-                glVertex3f(*corner_22)
-                glVertex3f(*corner_24)
-                glVertex3f(*corner_23)
-                glEnd()
-
-                glBegin(GL_LINES)
-                glVertex3f(*corner_11)
-                glVertex3f(*corner_21)
-
-                glVertex3f(*corner_12)
-                glVertex3f(*corner_22)
-
-                glVertex3f(*corner_13)
-                glVertex3f(*corner_23)
-
-                glVertex3f(*corner_14)
-                glVertex3f(*corner_24)
-                glEnd()
-
-            #glVertex3f()
-
-            #glEnd()"""
-
-            glEndList()
-            self.terrainmap.append(mesh)
+        self.terrainmodel.build(self.bwterrain)
         print("Done")
         self.doneCurrent()
 
-    def render_terrain_immediate(self):
+    def render_terrain(self):
         if self.bwmodelhandler is None:
             return
-        glUseProgram(self.shader)
         glDisable(GL_ALPHA_TEST)
-
-        overlayvar = glGetUniformLocation(self.shader, "overlayTex")
-        glUniform1i(overlayvar, 2)
-        glActiveTexture(GL_TEXTURE2)
-        glBindTexture(GL_TEXTURE_2D, self.overlay_texture.id)
-
-        for meshindex, displist in zip(self.bwterrain.meshes, self.terrainmap):
-            material = self.bwterrain.materials[meshindex]
-            tex1 = self.bwmodelhandler.textures.get_texture(material.mat1)
-            tex2 = self.bwmodelhandler.textures.get_texture(material.mat2)
-
-            texvar = glGetUniformLocation(self.shader, "tex")
-            # print(texvar, self.shader, type(self.shader))
-            glUniform1i(texvar, 0)
-            texvar2 = glGetUniformLocation(self.shader, "tex2")
-            glUniform1i(texvar2, 1)
-
-            glActiveTexture(GL_TEXTURE0)
-            glBindTexture(GL_TEXTURE_2D, tex1[1])
-            glActiveTexture(GL_TEXTURE1)
-            glBindTexture(GL_TEXTURE_2D, tex2[1])
-            glCallList(displist)
+        self.terrainmodel.render(self.bwmodelhandler.textures, self.overlay_texture)
         glEnable(GL_ALPHA_TEST)
         glDisable(GL_TEXTURE_2D)
-        glUseProgram(0)
 
     @catch_exception_with_dialog
     def initializeGL(self):
-        self.shader = create_default_shader()
         self.rotation_visualizer = glGenLists(1)
         glNewList(self.rotation_visualizer, GL_COMPILE)
         glColor4f(0.0, 0.0, 1.0, 1.0)
@@ -729,6 +699,8 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
                                 int(backgroundcolor[1])/255.0,
                                 int(backgroundcolor[2])/255.0,
                                 1.0)
+        set_texture_cache_budget(config.getint("texture_cache_size_mb", fallback=512)*1024*1024)
+        set_model_cache_budget(config.getint("model_cache_size_mb", fallback=256)*1024*1024)
 
         if config.getboolean("selection_debug", fallback=False):
             self.selectdebug.enabled = True
@@ -794,6 +766,11 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
 
         self.logic(timedelta, diff)
 
+        # Keep redrawing until textures decoded in the background have been uploaded
+        if self.bwmodelhandler is not None and self.bwmodelhandler.textures is not None:
+            if self.bwmodelhandler.textures.has_pending():
+                self._frame_invalid = True
+
         # If fps counter isn't visible, no need to keep redrawing.
         if self.fpscounter.isVisible() and self._keep_redrawing:
             self._frame_invalid = True
@@ -915,17 +892,12 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
             self.graphics.set_dirty()
             self._lastrendertime = 0
         elif forceselected or forcespecific:
-            modelnames = set()
             if forceselected:
-                for obj in self.selected:
-                    if obj.modelname is not None:
-                        modelnames.add(obj.modelname)
-
+                # Selected objects were changed, the gizmo can't reuse their old positions
+                self.gizmo.invalidate_average()
+                self.graphics.set_dirty_limited(self.selected)
             elif forcespecific:
-                for obj in forcespecific:
-                    if obj.modelname is not None:
-                        modelnames.add(obj.modelname)
-            self.graphics.set_dirty_limited(modelnames)
+                self.graphics.set_dirty_limited(forcespecific)
             self._lastrendertime = 0
             #self.update()
 
@@ -1123,30 +1095,16 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
 
                 id = 0x100000
                 selected = {}
-                selected_positions = []
-                selected_rotations = []
                 offset = 0
                 if not self.ignore_selection:
                     if self.is_topdown():
-                        objlist = list(self.level_file.objects_with_positions.values())
-                        self.graphics.render_select(objlist)
                         if clickwidth*clickheight == 1:
-                            hit = []
                             # Check click <-> object intersection
                             x, z = self.mouse_coord_to_world_coord(click_x, original_click_y)
-                            for obj in reversed(self.level_file.objects_with_positions.values()):
-                                if not vismenu.object_visible(obj.type, obj):
-                                    continue
-                                if self.dolphin.do_visualize():
-                                    mtx = obj.mtxoverride
-                                else:
-                                    mtx = obj.getmatrix()
-                                    if mtx is not None:
-                                        mtx = mtx.mtx
-                                if mtx is not None:
-                                    objx, objz = mtx[12], mtx[14]
-                                    if (x-objx)**2 + (z-objz)**2 <= 2.25**2:
-                                        hit.append(obj)
+                            hit = [obj for obj in self.graphics.select_circle(x, z, 2.25)
+                                   if vismenu.object_visible(obj.type, obj)]
+                            # Same order every time so repeated clicks cycle through the objects
+                            hit.sort(key=lambda obj: obj.id)
                             if len(hit) > 0:
                                 if self._lasthit == hit:
                                     self._hitcycle = (self._hitcycle+1)%len(self._lasthit)
@@ -1164,73 +1122,35 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
                                     miny = min(startbox[1], endbox[1])
                                     maxy = max(startbox[1], endbox[1])
 
-                                    for obj in reversed(self.level_file.objects_with_positions.values()):
-                                        if not vismenu.object_visible(obj.type, obj):
-                                            continue
-
-                                        if self.dolphin.do_visualize():
-                                            mtx = obj.mtxoverride
-                                        else:
-                                            mtx = obj.getmatrix()
-                                            if mtx is not None:
-                                                mtx = mtx.mtx
-                                        if mtx is not None:
-                                            objx, objz = mtx[12], mtx[14]
-                                            if minx <= objx <= maxx and miny <= objz <= maxy:
-                                                selected[obj] = True
+                                    for obj in self.graphics.select_rectangle(minx, miny, maxx, maxy):
+                                        if vismenu.object_visible(obj.type, obj):
+                                            selected[obj] = True
                     else:
                         objlist = list(self.level_file.objects_with_positions.values())
                         self.graphics.render_select(objlist)
-                        pixels = glReadPixels(click_x, click_y, clickwidth, clickheight, GL_RGB, GL_UNSIGNED_BYTE)
+                        ids = self.graphics.read_select(click_x, click_y, clickwidth, clickheight,
+                                                        self.defaultFramebufferObject())
                         self.selectdebug.record_view("3DSelect", click_x, click_y)
-                        #print(pixels, click_x, click_y, clickwidth, clickheight)
 
-                        #for i in range(0, clickwidth*clickheight, 4):
                         start = default_timer()
                         selectionfail = False
-                        for i in range(0, clickwidth*clickheight, 13):
-                            # | (pixels[i*3+0] << 16)
-                            if pixels[i * 3] != 0xFF:
-                                value = pixels[i*3] | pixels[i*3+1]<<8 | pixels[i*3+2]<<16
-                                if value != 0:
-                                    index = (value >> 4) & 0xFFFF
-                                    misc = value & 0xFF
-                                    if not 0 <= index < len(objlist):
-                                        print("Selection failure, index", index, "vs", len(objlist), "objects")
-                                        selectionfail = True
-                                        break
-
-                                    selected[objlist[index]] = True
+                        for objectid in numpy.unique(ids).tolist():
+                            if objectid != 0:
+                                index = objectid - 1
+                                if not 0 <= index < len(objlist):
+                                    print("Selection failure, index", index, "vs", len(objlist), "objects")
+                                    selectionfail = True
+                                    break
+
+                                selected[objlist[index]] = True
                         if selectionfail:
                             selected = {}
                 #print("select time taken", default_timer() - start)
                 #print("result:", selected)
-                selected = [x for x in selected.keys()]
-                for obj in selected:
-                    mtx = obj.getmatrix()
-                    selected_positions.append(mtx)
-
-                if not shiftpressed:
-                    self.selected = filter_combine(self.selected, selected, (BattalionObject, ))
-                    self.selected_positions = filter_combine(self.selected_positions, selected_positions, (BWMatrix, ))
-                    self.selected_rotations = filter_combine(self.selected_rotations, selected_rotations, (BWMatrix, ))
-                    self.select_update.emit()
-
-                else:
-                    for obj in selected:
-                        if obj not in self.selected:
-                            self.selected.append(obj)
-                    for pos in selected_positions:
-                        if pos not in self.selected_positions:
-                            self.selected_positions.append(pos)
-
-                    for rot in selected_rotations:
-                        if rot not in self.selected_rotations:
-                            self.selected_rotations.append(rot)
-
-                    self.select_update.emit()
-
-                self.center_gizmo(self.dolphin.do_visualize())
+                # The gizmo follows the selection through selection_changed
+                self.select(selected.keys(), add=shiftpressed)
+                self.select_update.emit()
+
                 if len(self.selected) == 0 and len(self.selected_misc) == 0:
                     #print("Select did register")
                     self.gizmo.hidden = True
@@ -1252,9 +1172,8 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         glDisable(GL_CULL_FACE)
 
         subtime = default_timer()
-        if self.terrainmap is not None:
-            #glCallList(self.terrainmap)
-            self.render_terrain_immediate()
+        if self.bwterrain is not None:
+            self.render_terrain()
         glActiveTexture(GL_TEXTURE0)
         glDisable(GL_TEXTURE_2D)
         glActiveTexture(GL_TEXTURE1)
@@ -1421,6 +1340,10 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         self.fpscounter.frametime_total = avgtime
         self.fpscounter.frametime_terrain = terraintime
         self.fpscounter.frametime_objects = objecttime
+        self.fpscounter.texture_binds = render_state.texture_binds
+        self.fpscounter.skipped_binds = render_state.skipped_binds
+        self.fpscounter.draw_calls = render_state.draw_calls
+        self.fpscounter.culling = self.graphics.culling.statistics()
         #print("Frame time:", now, 1/now, "fps")
         #print("Spent on terrain: {0} {1}%".format(terraintime, round(terraintime/now, 3)*100))
         #print("Spent on objects: {0} {1}%".format(objecttime, round(objecttime/now, 3)*100))
@@ -1428,11 +1351,7 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
     def do_select(self, objs):
         self.selected = []
         self.selected_positions = []
-        for obj in objs:
-            mtx = obj.getmatrix()
-            if mtx is not None:
-                self.selected_positions.append(mtx)
-            self.selected.append(obj)
+        self.select(objs, add=True)
 
     def set_2d_selectionbox_start(self, x, y):
         self._selectbox_x = x
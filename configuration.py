@@ -25,7 +25,9 @@ def make_default_config():
         "regenerate_pf2": "True",
         "regenerate_waypoints": "False",
         "fps_counter": "False",
-        "dark_mode": "True"
+        "dark_mode": "True",
+        "texture_cache_size_mb": "512",
+        "model_cache_size_mb": "256"
     }
 
     with open("editor_config.ini", "w") as f:
@@ -32,6 +32,11 @@ class Gizmo(Model):
         self.position = Vector3(0.0, 0.0, 0.0)
         self.hidden = True
 
+        # Per selected object position that went into the average, None if it has to be recalculated
+        self._contributions = None
+        self._sum = [0.0, 0.0, 0.0]
+        self._visualize = False
+
         self.callbacks = {}
 
         self.was_hit = {}
@@ -85,56 +90,67 @@ class Gizmo(Model):
 
 
     def move_to_average(self, objects, misc_objects, bwterrain, waterheight, visualize):
-        for obj in chain(objects, misc_objects):
-            if obj is None:
-                continue
-            if obj.getmatrix() is not None or obj.getposition() is not None:
-                self.hidden = False
-                break
-        else:
-            self.hidden = True
+        self._contributions = {}
+        self._sum = [0.0, 0.0, 0.0]
+        self._visualize = visualize
+        self._add_to_average(chain(objects, misc_objects), bwterrain, waterheight, visualize)
+        self._apply_average()
+
+    def update_average(self, added, removed, objects, bwterrain, waterheight, visualize):
+        # Only looks at the objects that were added to or removed from the selection. Falls back
+        # to recalculating everything if the selected objects moved since the last calculation.
+        if self._contributions is None or self._visualize != visualize:
+            self.move_to_average(objects, [], bwterrain, waterheight, visualize)
             return
 
+        for obj in removed:
+            position = self._contributions.pop(obj, None)
+            if position is not None:
+                for i in range(3):
+                    self._sum[i] -= position[i]
+        self._add_to_average(added, bwterrain, waterheight, visualize)
+        self._apply_average()
+
+    def invalidate_average(self):
+        self._contributions = None
+
+    def _add_to_average(self, objects, bwterrain, waterheight, visualize):
+        for obj in objects:
+            if obj is None or obj in self._contributions:
+                continue
 
-        avgx = None
-        avgy = None
-        avgz = None
-        count = 0
-        for obj in chain(objects, misc_objects):
             if obj.getmatrix() is not None:
                 if visualize and obj.mtxoverride is not None:
                     mtx = obj.mtxoverride
                 else:
-                    mtx = obj.getmatrix()
-                    if mtx is not None:
-                        mtx = mtx.mtx
+                    mtx = obj.getmatrix().mtx
                 x, objheight, z = mtx[12:15]
             elif obj.getposition() is not None:
                 x, objheight, z = obj.getposition()
             else:
-                x, objheight, z = None, None, None
+                continue
 
-            if x is not None:
-                count += 1
+            if not visualize:
+                h = obj.calculate_height(bwterrain, waterheight)
+                if h is not None:
+                    objheight = h
 
-                if not visualize:
-                    h = obj.calculate_height(bwterrain, waterheight)
-                    if h is not None:
-                        objheight = h
+            self._contributions[obj] = (x, objheight, z)
+            self._sum[0] += x
+            self._sum[1] += objheight
+            self._sum[2] += z
 
-                if avgx is None:
-                    avgx = x
-                    avgy = objheight
-                    avgz = z
-                else:
-                    avgx += x
-                    avgy += objheight
-                    avgz += z
-
-        self.position.x = avgx / count
-        self.position.y = avgy / count
-        self.position.z = avgz / count
-        #print("New position is", self.position, len(objects))
+    def _apply_average(self):
+        count = len(self._contributions)
+        if count == 0:
+            self.hidden = True
+            return
+
+        self.hidden = False
+        self.position.x = self._sum[0] / count
+        self.position.y = self._sum[1] / count
+        self.position.z = self._sum[2] / count
+        #print("New position is", self.position, count)
 
     def render_collision_check(self, scale, is3d=True, translation_visible=True, rotation_visible=True):
         if not self.hidden:
@@ -11,6 +11,7 @@ except: # cElementTree not available
     import xml.etree.ElementTree as etree
 
 from lib.searchquery import fieldnames
+from lib.search_index import SearchIndex
 
 from numpy import array, float32
 #import xml.etree.ElementTree.Element as Element
@@ -21,13 +22,13 @@ for x in fieldnames.values():
 LOCALTESTING = False
 if not LOCALTESTING:
     from lib.bw_types import convert_from, get_types, BWMatrix, convert_to
-    from lib.vectors import Vector4
+    from lib.vectors import Vector4, Vector3
 
     with open("resources/BattalionWarsIcons.json", "r") as f:
         BWICONS = json.load(f)
 else:
     from bw_types import convert_from, get_types, BWMatrix, convert_to
-    from vectors import Vector4
+    from vectors import Vector4, Vector3
 
     with open("../resources/BattalionWarsIcons.json", "r") as f:
         BWICONS = json.load(f)
@@ -189,11 +190,138 @@ def sort_key(node):
         return 99999
 
 
+# Value types that are edited in place (e.g. matrices moved by the gizmo) instead of being
+# reassigned, so writes to them can't be caught by BattalionObject.__setattr__. Code that edits
+# them should call mark_dirty on the object, is_xml_dirty also compares them with their values at
+# the last serialization in case it doesn't.
+MUTABLE_TYPES = ("sMatrix4x4", "cMatrix4x4", "sVector4", "sU8Color", "sVectorXZ", "cU8Color")
+
+# Public attributes of BattalionObject that are editor state and not part of the XML
+RUNTIME_ATTRIBUTES = frozenset(("getmatrix", "lua_name", "height", "dirty", "deleted", "mtxoverride"))
+
+
+def value_fingerprint(value):
+    if isinstance(value, BattalionObject):
+        return value.id
+    elif isinstance(value, BWMatrix):
+        return value.mtx.tobytes()
+    elif isinstance(value, Vector4):
+        return value.x, value.y, value.z, value.w
+    elif isinstance(value, Vector3):
+        return value.x, value.y, value.z
+    elif isinstance(value, list):
+        return tuple(value_fingerprint(x) for x in value)
+    else:
+        return value
+
+
+def pointees(value):
+    # The objects a field value points to
+    if isinstance(value, BattalionObject):
+        return [value]
+    elif isinstance(value, list):
+        return [item for item in value if isinstance(item, BattalionObject)]
+    else:
+        return []
+
+
 class PointerPlaceholder(object):
     def __init__(self, pointer):
         self.pointer = pointer
 
 
+def decode_field(attr_node):
+    if attr_node.tag in ("Pointer", "Resource"):
+        # Replaced by the objects when pointers are resolved
+        if int(attr_node.attrib["elements"]) == 1:
+            return PointerPlaceholder(attr_node[0].text)
+        else:
+            return [PointerPlaceholder(subnode.text for subnode in attr_node)]
+    elif int(attr_node.attrib["elements"]) == 1:
+        return convert_from(attr_node.attrib["type"], attr_node[0].text)
+    else:
+        return [convert_from(attr_node.attrib["type"], subnode.text) for subnode in attr_node]
+
+
+class FieldSchema(object):
+    """Field layout that all objects of a type with the same fields share. Each schema has its own
+    BattalionObject subclass that keeps the field values in __slots__ instead of the instance dict,
+    the position of a field in the schema is also the position of its node in the object's XML."""
+    def __init__(self, objtype, fields):
+        self.type = objtype
+        self.fields = fields  # (tag, name) in XML order
+        self.names = tuple(name for tag, name in fields)
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index.setdefault(name, i)
+
+        self.pointers = tuple(name for tag, name in fields if tag in ("Pointer", "Resource"))
+        self.enums = tuple(name for tag, name in fields if tag == "Enum")
+        # Order in which iterate_fields_recursive visits the fields, pointers last
+        self.recursive_order = (tuple((name, False) for tag, name in fields if tag not in ("Pointer", "Resource"))
+                                + tuple((name, True) for name in self.pointers))
+
+        if "Mat" in self.index:
+            self.matrixfield = "Mat"
+        elif "mMatrix" in self.index:
+            self.matrixfield = "mMatrix"
+        else:
+            self.matrixfield = None
+
+        self._mutable = None
+        self._objectclass = None
+
+    def mutable_fields(self, node):
+        # Fields with one of the MUTABLE_TYPES. The types aren't part of the key so they're taken from a node.
+        if self._mutable is None:
+            self._mutable = tuple(attr_node.attrib["name"] for attr_node in node
+                                  if attr_node.attrib["type"] in MUTABLE_TYPES)
+        return self._mutable
+
+    @property
+    def objectclass(self):
+        if self._objectclass is None:
+            # Fields that would hide something of BattalionObject or aren't valid slot names stay in the dict
+            slots = tuple(name for name in self.index
+                          if name.isidentifier() and name[0] != "_"
+                          and name not in RUNTIME_ATTRIBUTES and not hasattr(BattalionObject, name))
+            self._objectclass = type(self.type, (BattalionObject, ), {"__slots__": slots,
+                                                                      "_schema": self,
+                                                                      "_slotted": frozenset(slots)})
+        return self._objectclass
+
+    @staticmethod
+    def key(node):
+        return node.attrib["type"], tuple((attr_node.tag, attr_node.attrib["name"]) for attr_node in node)
+
+
+SCHEMAS = {}
+
+
+def load_template_schemas():
+    # The base templates have the full field layout of the types that can be added in the editor
+    for game in ("BW1", "BW2"):
+        path = os.path.join("resources/basetemplates", game)
+        if not os.path.isdir(path):
+            continue
+
+        for filename in os.listdir(path):
+            if filename.endswith(".xml"):
+                get_schema(etree.parse(os.path.join(path, filename)).getroot())
+
+
+def get_schema(node):
+    if not SCHEMAS:
+        SCHEMAS[None] = None  # Only load the templates once
+        load_template_schemas()
+
+    key = FieldSchema.key(node)
+    schema = SCHEMAS.get(key)
+    if schema is None:
+        schema = SCHEMAS[key] = FieldSchema(*key)
+    return schema
+
+
 class PointerAttribute(MutableSequence, Iterable):
     def __init__(self, tag, name, type, values, bwlevel):
         self.tag = tag
@@ -283,8 +411,22 @@ class AttributeList(MutableSequence, Iterable):
         return str([x for x in self])
     
         
+def detect_bw2(nodes):
+    # BW2 objects have fields that don't exist in BW1. All objects of a type have the same fields,
+    # so looking at one object per type is enough.
+    checked = set()
+    for node in nodes:
+        if node.tag != "Object" or node.attrib["type"] in checked:
+            continue
+        checked.add(node.attrib["type"])
+        for attr_node in node:
+            if attr_node.attrib["name"] not in bwfieldnames:
+                return True
+    return False
+
+
 class BattalionLevelFile(object):
-    def __init__(self, fileobj=None, callback=None):
+    def __init__(self, fileobj=None, callback=None, lazy=True):
         if fileobj is None:
             root = etree.Element("Instances")
             self._tree = etree.ElementTree(root)
@@ -301,18 +443,15 @@ class BattalionLevelFile(object):
             setattr(self, attr, self._categories[category])
         self.scripts: typing.Dict[str, BattalionObject]
 
-        self.bw2 = False
+        # In lazy mode objects only decode a field's value when it's accessed the first time
+        self.lazy = lazy
+        self.bw2 = detect_bw2(self._root)
+        self._needs_sort = True
+        self.search_index: SearchIndex | None = None
 
         for i, child in enumerate(self._root):
             if child.tag == "Object":
-                bwobject = BattalionObject(self, child)
-
-                if not self.bw2:
-                    for node in bwobject._node:
-                        if node.attrib["name"] not in bwfieldnames:
-                            self.bw2 = True
-                            #print("Detected XML as BW2")
-
+                bwobject = BattalionObject(self, child, lazy=lazy)
                 self.add_object(bwobject)
                 if callback is not None: callback(len(self._root), i)
 
@@ -333,43 +472,55 @@ class BattalionLevelFile(object):
         for obj in objects:
             assert not obj.deleted
 
-        for k, v in self.objects.items():
-            v.delete_references(objects)
+        deleted = set(objects)
 
-        for obj in objects:
-            if obj.id in self.objects:
+        # Only objects that point at one of the deleted objects need to be touched,
+        # these are tracked by the reverse reference index of each object.
+        referrers = set()
+        for obj in deleted:
+            for referrer in obj._referenced_by:
+                if referrer not in deleted and self.objects.get(referrer.id) is referrer:
+                    referrers.add(referrer)
+
+        for referrer in referrers:
+            referrer.delete_references(deleted)
+
+        deleted_nodes = []
+        for obj in deleted:
+            for ref in obj.references:
+                if isinstance(ref, BattalionObject):
+                    ref.remove_reference(obj)
+
+            if self.objects.get(obj.id) is obj:
                 del self.objects[obj.id]
+                deleted_nodes.append(obj._node)
             if obj.id in self.objects_with_positions:
                 del self.objects_with_positions[obj.id]
             if obj.type in self._categories and obj.id in self._categories[obj.type]:
                 del self._categories[obj.type][obj.id]
+            if self.search_index is not None:
+                self.search_index.remove(obj)
 
-        deleted_refs = set(obj.id for obj in objects)
-        newroot = etree.Element("Instances")
-
-        for node in self._root:
-            if node.tag == "Object":
-                if node.attrib["id"] not in deleted_refs:
-                    newroot.append(node)
-            else:
-                newroot.append(node)
-
-        self._tree._setroot(newroot)
-        self._root = self._tree.getroot()
+        if len(deleted_nodes) < 32:
+            for node in deleted_nodes:
+                self._root.remove(node)
+        else:
+            deleted_nodes = set(deleted_nodes)
+            self._root[:] = [node for node in self._root if node not in deleted_nodes]
 
     def sort_nodes(self):
+        # Removing objects keeps the nodes sorted, so we only need to sort again
+        # after objects were added since the last sort.
+        if not self._needs_sort:
+            return
+
         nodes = []
         for node in self._root:
             nodes.append(node)
 
         nodes.sort(key=sort_key)
-
-        newroot = etree.Element("Instances")
-        for node in nodes:
-            newroot.append(node)
-
-        self._tree._setroot(newroot)
-        self._root = self._tree.getroot()
+        self._root[:] = nodes
+        self._needs_sort = False
 
     def resolve_pointers(self, other):
         for bwobject in self.objects.values():
@@ -381,13 +532,17 @@ class BattalionLevelFile(object):
     def add_object_new(self, bwobject):
         self.add_object(bwobject)
         self._root.append(bwobject._node)
+        self._needs_sort = True
+        for ref in bwobject.references:
+            ref.add_reference(bwobject)
 
     def add_object(self, bwobject):
         if bwobject in self.objects:
             raise ObjectIDAlreadyExists()
 
         self.objects[bwobject.id] = bwobject
-        hasposition = hasattr(bwobject, "spawnMatrix") or hasattr(bwobject, "Mat") or hasattr(bwobject, "mMatrix")
+        hasposition = (bwobject.has_field("spawnMatrix") or bwobject.has_field("Mat")
+                       or bwobject.has_field("mMatrix"))
         if hasposition:
             self.objects_with_positions[bwobject.id] = bwobject
             assert bwobject.getmatrix() is not None
@@ -398,9 +553,43 @@ class BattalionLevelFile(object):
             self._categories[bwobject.type] = {}
             self._categories[bwobject.type][bwobject.id] = bwobject
 
+        if self.search_index is not None:
+            self.search_index.add(bwobject)
+
+    def get_search_index(self):
+        # Built on first use and kept up to date from then on
+        if self.search_index is None:
+            self.search_index = SearchIndex()
+            for bwobject in self.objects.values():
+                self.search_index.add(bwobject)
+        return self.search_index
+
     def write(self, f):
+        """Writes the XML to f, only regenerating the XML of objects that changed since the
+        last write. Returns the amount of objects that were serialized again."""
         f.write(b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
-        self._tree.write(f, encoding="utf-8", short_empty_elements=False)
+
+        emptyroot = etree.Element(self._root.tag, self._root.attrib)
+        emptyroot.text = self._root.text
+        roottext = etree.tostring(emptyroot, encoding="utf-8", short_empty_elements=False)
+        endtag = "</{0}>".format(self._root.tag).encode("utf-8")
+        f.write(roottext[:-len(endtag)])
+
+        reserialized = 0
+        for node in self._root:
+            obj = self.objects.get(node.attrib.get("id")) if node.tag == "Object" else None
+            if obj is not None and obj._node is node:
+                if obj.is_xml_dirty():
+                    reserialized += 1
+                f.write(obj.serialize())
+            else:
+                f.write(etree.tostring(node, encoding="utf-8", short_empty_elements=False))
+
+        f.write(endtag)
+        if self._root.tail:
+            f.write(self._root.tail.encode("utf-8"))
+
+        return reserialized
 
 
 class BattalionFilePaths(object):
@@ -538,10 +727,30 @@ class BattalionFilePaths(object):
 
 
 class BattalionObject(object):
-    def __init__(self, level: BattalionLevelFile, node: etree.Element):
+    # Editor state and caches that every object has. Fields are kept in the slots of the
+    # FieldSchema subclasses, anything else that is set on an object goes into the instance dict.
+    __slots__ = ("_node", "_level", "_attributes", "_custom_name", "lua_name", "_referenced_by",
+                 "_xml_dirty", "_xml_cache", "_xml_snapshot", "_tracked_fields",
+                 "_hash", "_hash_snapshot", "_hash_recursive", "_search_index", "_modelname", "_iconoffset",
+                 "height", "dirty", "deleted", "mtxoverride", "__dict__", "__weakref__")
+
+    # Set on the subclasses made by FieldSchema
+    _schema: FieldSchema = None
+    _slotted = frozenset()
+
+    def __new__(cls, level: BattalionLevelFile, node: etree.Element, lazy=False):
+        if cls is BattalionObject or cls._schema is not None:
+            cls = get_schema(node).objectclass
+        return super().__new__(cls)
+
+    def __init__(self, level: BattalionLevelFile, node: etree.Element, lazy=False):
+        if self._schema is None:
+            # Other subclasses keep their fields in the instance dict
+            self._schema = get_schema(node)
         self._node: etree.Element = node
         self._level = level
-        self.getmatrix: typing.Callable[[], BWMatrix | None] = lambda: None
+        # Set while the object is in the search index of its level
+        self._search_index: SearchIndex = None
 
         self._attributes = {}
         self._custom_name = ""
@@ -549,7 +758,17 @@ class BattalionObject(object):
 
         self._referenced_by = set()
 
-        self.update_object_from_xml(self._node)
+        self._xml_dirty = True
+        self._xml_cache = None
+        self._xml_snapshot = None
+        self._tracked_fields = None
+
+        # Cached results of calc_hash and calc_hash_recursive
+        self._hash = None
+        self._hash_snapshot = None
+        self._hash_recursive = None
+
+        self.update_object_from_xml(self._node, lazy=lazy)
 
         self.height = None
         self.dirty = True
@@ -560,16 +779,147 @@ class BattalionObject(object):
     def choose_unique_id(self, level, preload):
         assert not self.deleted
 
-        while self.id in level.objects or self.id in preload.objects:
-            self._node.attrib["id"] = str(int(self.id)+7)
+        newid = self.id
+        while newid in level.objects or newid in preload.objects:
+            newid = str(int(newid)+7)
+        self.set_id(newid)
+
+    def set_id(self, newid):
+        self._node.attrib["id"] = str(newid)
+        self.mark_dirty()
+        # Objects that point to this one have the id in their XML
+        for obj in self._referenced_by:
+            obj._xml_dirty = True
 
     def delete(self):
         self._custom_name = "DELETED"
         self.deleted = True
 
+    def __setattr__(self, name, value):
+        if name[0] == "_" or name in RUNTIME_ATTRIBUTES:
+            object.__setattr__(self, name, value)
+            return
+
+        try:
+            # Fields of lazy objects that weren't decoded yet can't hold pointers
+            old = object.__getattribute__(self, name)
+        except AttributeError:
+            old = None
+        object.__setattr__(self, name, value)
+        self._field_changed(name, old, value)
+
+    def set_element(self, name, index, value):
+        """Sets one element of an array field. Use this instead of editing the list in place
+        so that the object notices the change."""
+        values = getattr(self, name)
+        old = values[index]
+        values[index] = value
+        self._field_changed(name, old, value)
+
+    def _field_changed(self, name, old, new):
+        self._xml_dirty = True
+        if self._hash is not None or self._hash_recursive is not None:
+            self.invalidate_hash()
+        if self._search_index is not None:
+            self._search_index.update(self, name)
+
+        # Keep the reverse reference index up to date when a pointer field is written.
+        for obj in pointees(new):
+            obj.add_reference(self)
+
+        removed = [obj for obj in pointees(old) if obj is not new]
+        if removed:
+            # The object can still point to them through other fields or list elements
+            references = set(self.references)
+            for obj in removed:
+                if obj not in references:
+                    obj.remove_reference(self)
+
+    def __getattr__(self, name):
+        # Only called when the attribute isn't set, i.e. for fields of lazy objects that weren't decoded yet
+        schema = type(self)._schema or self.__dict__.get("_schema")
+        if schema is None or name not in schema.index:
+            raise AttributeError("'{0}' object has no attribute '{1}'".format(type(self).__name__, name))
+
+        value = decode_field(self._node[schema.index[name]])
+        # Decoding doesn't change the object so this doesn't go through __setattr__
+        object.__setattr__(self, name, value)
+        return value
+
+    def has_field(self, name):
+        return name in self._schema.index
+
+    def is_decoded(self, name):
+        if name in self._slotted:
+            try:
+                # Doesn't fall back to __getattr__
+                object.__getattribute__(self, name)
+            except AttributeError:
+                return False
+            return True
+        return name in self.__dict__
+
+    def mark_dirty(self):
+        self._xml_dirty = True
+        self.invalidate_hash()
+        if self._search_index is not None:
+            self._search_index.update(self)
+
+    def invalidate_hash(self):
+        self._hash = None
+        self._hash_snapshot = None
+
+        # The recursive hashes of everything that points to this object depend on it. An object
+        # only has a recursive hash if everything it points to has one, so there's nothing to do
+        # for the referrers of objects that don't have one.
+        to_visit = [self]
+        while to_visit:
+            obj = to_visit.pop()
+            if obj._hash_recursive is not None:
+                obj._hash_recursive = None
+                to_visit.extend(obj._referenced_by)
+
+    def _take_xml_snapshot(self):
+        # Fields that can change without going through __setattr__: pointers (the id of the
+        # pointed to object can change), arrays and values that are edited in place. Used to
+        # notice in place edits that didn't call mark_dirty when the hash is requested.
+        if self._tracked_fields is None:
+            self._tracked_fields = [attr_node.attrib["name"] for attr_node in self._node
+                                    if (attr_node.tag in ("Pointer", "Resource")
+                                        or attr_node.attrib["elements"] != "1"
+                                        or attr_node.attrib["type"] in MUTABLE_TYPES)]
+
+        return (tuple(self._node.attrib.items()),
+                tuple(value_fingerprint(getattr(self, name)) for name in self._tracked_fields))
+
+    def _take_mutable_snapshot(self):
+        # Fields that weren't decoded can't have been edited
+        return tuple(value_fingerprint(getattr(self, name)) if self.is_decoded(name) else None
+                     for name in self._schema.mutable_fields(self._node))
+
+    def is_xml_dirty(self):
+        return self._xml_dirty or self._xml_snapshot != self._take_mutable_snapshot()
+
+    def serialize(self):
+        """Returns the XML of this object, reusing the result of the last call if nothing changed."""
+        if self.is_xml_dirty():
+            self.update_xml()
+            self._xml_cache = etree.tostring(self._node, encoding="utf-8", short_empty_elements=False)
+            self._xml_snapshot = self._take_mutable_snapshot()
+            self._xml_dirty = False
+
+        return self._xml_cache
+
     def add_reference(self, obj):
         self._referenced_by.add(obj)
 
+    def remove_reference(self, obj):
+        self._referenced_by.discard(obj)
+
+    @property
+    def referenced_by(self):
+        return [obj for obj in self._referenced_by if not obj.deleted]
+
     def set_mtx_override(self, values):
         if values is None:
             self.mtxoverride = None
@@ -577,23 +927,21 @@ class BattalionObject(object):
             self.mtxoverride = array(values, dtype=float32)
 
     def delete_references(self, references):
+        if not isinstance(references, set):
+            references = set(references)
         for attr_node in self._node:
             if attr_node.tag in ("Pointer", "Resource"):
                 fieldname = attr_node.attrib["name"]
-                pointers = [subnode.text for subnode in attr_node]
-                if len(pointers) == 1:
-                    for ref in references:
-                        obj = getattr(self, fieldname)
-                        if obj == ref or (obj is not None and obj.deleted):
-                            setattr(self, fieldname, None)
-                            break
-                elif len(pointers) > 1:
+                if int(attr_node.attrib["elements"]) == 1:
+                    obj = getattr(self, fieldname)
+                    if obj is not None and (obj in references or obj.deleted):
+                        setattr(self, fieldname, None)
+                else:
                     ptrlist = getattr(self, fieldname)
                     for i in range(len(ptrlist)):
                         obj = ptrlist[i]
-                        for ref in references:
-                            if obj == ref or (obj is not None and obj.deleted):
-                                ptrlist[i] = None
+                        if obj is not None and (obj in references or obj.deleted):
+                            self.set_element(fieldname, i, None)
         self.update_xml()
 
     def check_correctness(self, node, level, other):
@@ -621,35 +969,19 @@ class BattalionObject(object):
                     raise RuntimeError("Invalid value for type {0} in field {1}".format(attr_node.attrib["type"],
                                                                                         attr_node.attrib["name"]))
 
-    def update_object_from_xml(self, node):
-        for attr_node in node:
-            if attr_node.tag in ("Pointer", "Resource"):
-                elementcount = int(attr_node.attrib["elements"])
-                if elementcount == 1:
-                    setattr(self, attr_node.attrib["name"], PointerPlaceholder(attr_node[0].text))
-                else:
-                    setattr(self, attr_node.attrib["name"], [PointerPlaceholder(subnode.text for subnode in attr_node)])
-            else:
-                elementcount = int(attr_node.attrib["elements"])
-                if elementcount == 1:
-                    setattr(self,
-                            attr_node.attrib["name"],
-                            convert_from(attr_node.attrib["type"], attr_node[0].text))
-                else:
-                    setattr(self,
-                            attr_node.attrib["name"],
-                            [convert_from(attr_node.attrib["type"], subnode.text) for subnode in attr_node])
+    def update_object_from_xml(self, node, lazy=False):
+        # Lazy only works for the object's own node, fields are decoded from it on first access
+        assert not lazy or node is self._node
+
+        if not lazy:
+            for attr_node in node:
+                setattr(self, attr_node.attrib["name"], decode_field(attr_node))
                 #self._attributes[attr_node.attrib["name"]] = Attribute.from_node(attr_node, self._level)
 
-        if hasattr(self, "Mat"):
-            #setattr(self, "getmatrix", lambda: self.Mat)
-            self.getmatrix: typing.Callable[[], None | BWMatrix] = lambda: self.Mat
-        elif hasattr(self, "mMatrix"):
-            #setattr(self, "getmatrix", lambda: self.mMatrix)
-            self.getmatrix: typing.Callable[[], None | BWMatrix] = lambda: self.mMatrix
-        else:
-            #setattr(self, "getmatrix", lambda: None)
-            self.getmatrix: typing.Callable[[], None | BWMatrix] = lambda: None
+    def getmatrix(self) -> BWMatrix | None:
+        if self._schema.matrixfield is None:
+            return None
+        return getattr(self, self._schema.matrixfield)
 
     def getposition(self):
         return None
@@ -657,27 +989,25 @@ class BattalionObject(object):
     @property
     def references(self):
         result = []
-        for attr_node in self._node:
-            if attr_node.tag in ("Pointer", "Resource"):
-                pointers = getattr(self, attr_node.attrib["name"])
-                if isinstance(pointers, list):
-                    for val in pointers:
-                        if val is not None:
-                            result.append(val)
-                elif pointers is not None:
-                    result.append(pointers)
+        for name in self._schema.pointers:
+            pointers = getattr(self, name)
+            if isinstance(pointers, list):
+                for val in pointers:
+                    if val is not None:
+                        result.append(val)
+            elif pointers is not None:
+                result.append(pointers)
         return result
 
     @property
     def enums(self):
         result = []
-        for attr_node in self._node:
-            if attr_node.tag == "Enum":
-                enums = getattr(self, attr_node.attrib["name"])
-                if isinstance(enums, list):
-                    result.extend(enums)
-                else:
-                    result.append(enums)
+        for name in self._schema.enums:
+            enums = getattr(self, name)
+            if isinstance(enums, list):
+                result.extend(enums)
+            else:
+                result.append(enums)
         return result
 
     def resolve_pointers(self, level, other=None, othernode=None):
@@ -699,10 +1029,8 @@ class BattalionObject(object):
                                 raise RuntimeError("ID {0} not found in level or preload".format(subnode.text))
                             else:
                                 obj = other.objects[subnode.text]
-                                obj.add_reference(self)
                         else:
                             obj = level.objects[subnode.text]
-                            obj.add_reference(self)
                         result.append(obj)
 
                 if elementcount == 1:
@@ -858,6 +1186,10 @@ class BattalionObject(object):
 
     def update_xml(self):
         for attr_node in self._node:
+            if not self.is_decoded(attr_node.attrib["name"]):
+                # Never decoded so the node still has the current value
+                continue
+
             if attr_node.tag in ("Pointer", "Resource"):
                 elementcount = int(attr_node.attrib["elements"])
                 if elementcount == 1:
@@ -955,6 +1287,7 @@ class BattalionObject(object):
             del self._node.attrib["customName"]
         else:
             self._node.attrib["customName"] = customname
+        self.mark_dirty()
 
     @property
     def id(self):
@@ -1042,38 +1375,47 @@ class BattalionObject(object):
         else:
             return extradetail
 
-    def calculate_height(self, bwterrain, waterheight):
+    def terrain_height_query(self):
+        """Returns the x and z coordinates at which calculate_height needs the terrain height,
+        or None if the height of the object doesn't depend on the terrain."""
         currbwmtx = self.getmatrix()
         if currbwmtx is None:
             return None
 
-
-        currmtx = currbwmtx.mtx
-        h = currmtx[13]
-
         if self.type in ("cMapZone", ):
-            return h
-        #elif self.type == "cObjectiveMarker":
-        #    if self.
-
-        originalh = h
-        locktosurface = False
-        sticktofloor = False
+            return None
 
+        currmtx = currbwmtx.mtx
         if hasattr(self, "mStickToFloor"):
             if not self.mStickToFloor:
-                return h
-            else:
-                sticktofloor = True
+                return None
 
         if hasattr(self, "mLockToSurface"):
             if not self.mLockToSurface:
-                return h
+                return None
             else:
                 currmtx = self.spawnMatrix.mtx
-                locktosurface = True
 
-        height = bwterrain.check_height(currmtx[12], currmtx[14])
+        return currmtx[12], currmtx[14]
+
+    def calculate_height(self, bwterrain, waterheight):
+        query = self.terrain_height_query()
+        if query is None:
+            currbwmtx = self.getmatrix()
+            if currbwmtx is None:
+                return None
+            return currbwmtx.mtx[13]
+
+        return self.apply_terrain_height(bwterrain.check_height(*query), waterheight)
+
+    def apply_terrain_height(self, height, waterheight):
+        # height is the terrain height at the position from terrain_height_query, or None if there's no terrain
+        currmtx = self.getmatrix().mtx
+        originalh = currmtx[13]
+        locktosurface = hasattr(self, "mLockToSurface")
+        sticktofloor = hasattr(self, "mStickToFloor")
+        if locktosurface:
+            currmtx = self.spawnMatrix.mtx
 
         if height is None:
             if waterheight is not None and not sticktofloor:  # StickToFloor: Water height is ignored
@@ -1106,8 +1448,18 @@ class BattalionObject(object):
             yield attr_node.tag, attr_node.attrib["name"], attr_node.attrib["type"], int(attr_node.attrib["elements"])
 
     def calc_hash(self):
+        snapshot = self._take_xml_snapshot()
+        if self._hash is not None and self._hash_snapshot != snapshot:
+            # Edited in place
+            self.invalidate_hash()
+
+        if self._hash is None:
+            self._hash = self._calc_hash()
+            self._hash_snapshot = snapshot
+        return self._hash
+
+    def _calc_hash(self):
         hash = hashlib.new("md5")
-        result = []
         hash.update(bytes(self.type, encoding="ascii"))
 
         for attr_node in self._node:
@@ -1126,47 +1478,56 @@ class BattalionObject(object):
 
         return hash.digest()
 
-    def calc_hash_recursive(self, visited=None):
-        if visited is None:
-            visited = {}
+    def calc_hash_recursive(self):
+        return calc_hashes_recursive([self])[self]
 
-        if self.id in visited:
-            return self.calc_hash()
-        basehash = hashlib.new("md5")
-        basehash.update(self.calc_hash())
+    def _calc_hash_recursive(self, stack, memo):
+        # Returns the hash and whether it depends on an object further up the stack, i.e. it's part of
+        # a cycle. Those depend on where the cycle was entered so they are only remembered for this call.
+        if self._hash_recursive is not None:
+            return self._hash_recursive, False
+        elif self in memo:
+            return memo[self], True
+        elif self in stack:
+            return self._hash, True
 
-        for attr_node in self._node:
-            if attr_node.tag in ("Pointer", "Resource"):
-                attribname = attr_node.attrib["name"]
-                attribtype = attr_node.attrib["type"]
-                val = getattr(self, attribname)
-                if not isinstance(val, list):
-                    val = [val]
+        stack.add(self)
+        basehash = hashlib.new("md5")
+        basehash.update(self._hash)
+        cyclic = False
 
-                for value in val:
-                    if value is None:
-                        basehash.update(b"\x00")
-                    else:
-                        visited[self.id] = True
-                        basehash.update(value.calc_hash_recursive(visited))
+        for attribname in self._schema.pointers:
+            val = getattr(self, attribname)
+            if not isinstance(val, list):
+                val = [val]
 
-        return basehash.digest()
+            for value in val:
+                if value is None:
+                    basehash.update(b"\x00")
+                else:
+                    valuehash, valuecyclic = value._calc_hash_recursive(stack, memo)
+                    basehash.update(valuehash)
+                    cyclic = cyclic or valuecyclic
+
+        stack.discard(self)
+        result = basehash.digest()
+        if cyclic:
+            memo[self] = result
+        else:
+            self._hash_recursive = result
+        return result, cyclic
 
     def iterate_fields_recursive(self, path=[], visited=None):
         if visited is None:
             visited = {}
 
         if self.id not in visited:
-            nodes = [attr_node for attr_node in self._node]
-            nodes.sort(key=lambda x: x.tag in ("Pointer", "Resource"))
-
-            for attr_node in nodes:
-                attribname = attr_node.attrib["name"]
+            for attribname, ispointer in self._schema.recursive_order:
                 val = getattr(self, attribname)
 
                 yield path + [attribname]
 
-                if attr_node.tag in ("Pointer", "Resource"):
+                if ispointer:
                     if isinstance(val, list):
                         for i in range(len(val)):
                             if val[i] is None:
@@ -1297,6 +1658,50 @@ class BattalionObject(object):
         return same
 
 
+def calc_hashes_recursive(objects):
+    """Recursive hashes of the objects as a dict of object -> hash. Every object they point to is checked
+    for changes and hashed once, hashes of unchanged objects are reused from earlier calls."""
+    visited = set()
+    to_visit = list(objects)
+    while to_visit:
+        obj = to_visit.pop()
+        if obj in visited:
+            continue
+        visited.add(obj)
+
+        to_visit.extend(obj.references)
+
+    # Changes found here invalidate the recursive hashes of the referrers, so this has to happen
+    # for all objects before any recursive hash is reused
+    for obj in visited:
+        obj.calc_hash()
+
+    return {obj: obj._calc_hash_recursive(set(), {})[0] for obj in objects}
+
+
+def calculate_heights(objects, bwterrain, waterheight):
+    """Same as calling calculate_height on each object, but looks up the terrain heights in one go."""
+    queries = [obj.terrain_height_query() for obj in objects]
+    points = [query for query in queries if query is not None]
+
+    if points:
+        x, z = zip(*points)
+        terrainheights = iter(bwterrain.check_heights(x, z).tolist())
+
+    heights = []
+    for obj, query in zip(objects, queries):
+        if query is None:
+            currbwmtx = obj.getmatrix()
+            heights.append(None if currbwmtx is None else currbwmtx.mtx[13])
+        else:
+            height = next(terrainheights)
+            if height != height:  # NaN, no terrain at this point
+                height = None
+            heights.append(obj.apply_terrain_height(height, waterheight))
+
+    return heights
+
+
 def create_object(game, objname, level_data, preload_data):
     obj = BattalionObject.create_from_path(
         os.path.join("resources/basetemplates", game, objname+".xml"),
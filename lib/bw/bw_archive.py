@@ -267,6 +267,19 @@ class ScriptEntry(BWResource):
         return super().pack()
 
 
+# Resource type to the attribute holding the resources. Sounds are pairs of entries and handled separately.
+RESOURCE_LISTS = {
+    "sSampleResource": None,
+    "cTequilaEffectResource": "effects",
+    "cNodeHierarchyResource": "models",
+    "cTextureResource": "textures"
+}
+
+
+def resource_key(res_name):
+    return bytes(res_name).strip(b"\x00").upper()
+
+
 class BWArchive(BWArchiveBase):
     def __init__(self, f):
         super().__init__(f)
@@ -325,6 +338,7 @@ class BWArchive(BWArchiveBase):
         self.scripts = [x for x in filter(lambda k: k.name == b"PRCS", self.entries)]
         self.textures = [x for x in self.ftb.entries]
         self.game = self.get_game()
+        self.rebuild_index()
         """for nameentry, dataentry in self.models:
             print(bytes(nameentry.modelname))
         print(self.dnos.entries[0].count)
@@ -346,42 +360,35 @@ class BWArchive(BWArchiveBase):
             raise RuntimeError("Malformed res archive?")
         #self.entries.append(model)"""
 
+    # Needs to be called again when resources are added, removed or renamed
+    def rebuild_index(self):
+        self._index = {restype: {} for restype in RESOURCE_LISTS}
+
+        for nameentry, dataentry in self.sounds:
+            self._index["sSampleResource"].setdefault(resource_key(nameentry.res_name), (nameentry, dataentry))
+
+        for restype, attr in RESOURCE_LISTS.items():
+            if attr is None:
+                continue
+            for res in getattr(self, attr):
+                if hasattr(res, "res_name"):
+                    self._index[restype].setdefault(resource_key(res.res_name), res)
+
     # All resources have
     def get_resource(self, restype, name):
-        name = name.upper()
-        if restype == "sSampleResource":
-            reslist = self.sounds
-
-            for res, res_data in reslist:
-                if bytes(res.res_name).strip(b"\x00").upper() == name:
-                    return res, res_data
-            return None
-
-        elif restype == "cTequilaEffectResource":
-            reslist = self.effects
-        elif restype == "cNodeHierarchyResource":
-            reslist = self.models
-        elif restype == "cTextureResource":
-            reslist = self.textures
-        else:
+        if restype not in self._index:
             raise RuntimeError("Unknown resoure type: {0}".format(restype))
 
-        for i, res in enumerate(reslist):
-            #print(bytes(res.res_name).strip(b"\x00").upper(), name,bytes(res.res_name).strip(b"\x00").upper() == name)
-            #if hasattr(res, "res_name"):
-                #print("Comparing:", bytes(res.res_name).strip(b"\x00").upper(), name)
-            if hasattr(res, "res_name") and bytes(res.res_name).strip(b"\x00").upper() == name:
-                print("found", name, "at position", i)
-                return res
-
-        return None
+        if isinstance(name, str):
+            name = name.encode("ascii")
+        return self._index[restype].get(name.upper())
 
-    def pack(self):
+    def pack_pieces(self):
         # Adjust the amount of models in case models were taken away or added.
         # Every model has a HPSD entry and a DPSD entry in the DNOS section.
         self.hfsb.count = (len(self.dnos.entries) - 1) // 2
 
-        return super().pack()
+        return super().pack_pieces()
 
     def get_game(self):
         result = None
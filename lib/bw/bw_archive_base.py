@@ -1,4 +1,5 @@
 import io
+import mmap
 import struct
 from array import array
 
@@ -10,10 +11,13 @@ class BWResource(object):
         self.name = name
         self._size = size
         self._data = memview
-        self._fileobj = io.BytesIO(self._data)
+        # Created on first access, BytesIO copies the data
+        self._fileobj = None
 
     @property
     def fileobj(self):
+        if self._fileobj is None:
+            self._fileobj = io.BytesIO(self._data)
         return self._fileobj
 
     # File object and data object should be kept up to date together when
@@ -32,10 +36,11 @@ class BWResource(object):
 
     @data.setter
     def data(self, data):
-        self._fileobj.close()
+        if self._fileobj is not None:
+            self._fileobj.close()
 
         self._data = data
-        self._fileobj = io.BytesIO(self._data)
+        self._fileobj = None
     
     def write(self, file):
         name, length, data = self.pack()
@@ -70,37 +75,36 @@ class BWSection(BWResource):
 
         self.entries = []
         self._header = self._data[0:section_offset]
-        self._fileobj.seek(section_offset)
+        offset = section_offset
 
-        while self._fileobj.tell() < self._size:
-            name, size, entry_memview = read_section(self._fileobj, memview)
+        while offset < self._size:
+            name, size, entry_memview = read_section(self._data, offset)
             res_obj = BWResource(name, size, entry_memview)
 
             self.entries.append(res_obj)
+            offset += 8 + size
 
-    def pack(self):
-        packed = io.BytesIO()
-
-        packed.write(self._header)
-
-        section_size = len(self._header)
+    # Packs all entries and returns the pieces that make up the section's content in order,
+    # so the data can be written out or joined without going through a buffer first.
+    def pack_pieces(self):
+        pieces = [self._header]
 
         for entry in self.entries:
             name, size, data = entry.pack()
-
-            packed.write(name)
             assert size == len(data)
-            packed.write(struct.pack("I", size))
 
-            packed.write(data)
+            pieces.append(name)
+            pieces.append(struct.pack("I", size))
+            pieces.append(data)
 
-            # 4 bytes for the ID, 4 bytes for the length, and the rest is from the data
-            section_size += 4 + 4 + len(data)
+        return pieces
 
-        packed_data = packed.getvalue()
-        packed.close()
+    def pack(self):
+        pieces = self.pack_pieces()
+        # 4 bytes for the ID, 4 bytes for the length of every entry, and the rest is from the data
+        section_size = sum(len(piece) for piece in pieces)
 
-        return self.name, section_size, packed_data
+        return self.name, section_size, b"".join(pieces)
 
     def as_section(self, offset=0, cls=None):
         return self
@@ -109,27 +113,37 @@ class BWSection(BWResource):
 class BWArchiveBase(BWSection):
     # f should be a file open in binary mode
     def __init__(self, f):
-        # We read the content of the file into memory and put it in a bytearray,
-        # which is necessary so the content can be modified.
-        file_content = bytearray(f.read())
+        # The content has to be writable so it can be modified. Files on disk are mapped
+        # copy-on-write so only the pages that are actually changed get copied into memory,
+        # everything else (e.g. gzip files) is read into a bytearray.
+        self._mapping = None
+        file_content = None
+        if isinstance(f, (io.BufferedReader, io.FileIO)):
+            try:
+                self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            except (OSError, ValueError):
+                pass
+            else:
+                file_content = memoryview(self._mapping)[f.tell():]
+
+        if file_content is None:
+            file_content = memoryview(bytearray(f.read()))
         #file_content = array("B", f.read())
 
-
         super().__init__(name=None, size=len(file_content), memview=file_content)
 
     def write(self, f):
-        unused, size, data = self.pack()
-        f.write(data)
+        # Top level entries are written directly instead of joining the whole archive in memory
+        for piece in self.pack_pieces():
+            f.write(piece)
 
 
 
-def read_section(f, memview):
-    name = f.read(4)
-    size = read_uint32(f)
+def read_section(memview, offset):
+    name = bytes(memview[offset:offset+4])
+    size = struct.unpack_from("I", memview, offset+4)[0]
 
-    offset = f.tell()
-    data = memoryview(memview[offset:(offset+size)])#f.read(data_len)
-    f.seek(size, io.SEEK_CUR)
+    # Slicing a memoryview doesn't copy the data
+    data = memview[offset+8:(offset+8+size)]
 
-    #print(len(memview), len(f.getbuffer()))
     return name, size, data
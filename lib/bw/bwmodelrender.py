@@ -1,41 +1,132 @@
+import os
+import sys
 from functools import partial
 from OpenGL.GL import *
 from .model_rendering import BW1Model, BW2Model
 from .bw_archive import BWArchive
-from .texture import TextureArchive
-from lib.render.model_renderingv2 import BWModelV2
+from .texture import TextureArchive, get_worker_pool
+from .model_cache import ModelCache, DEFAULT_SIZE_BUDGET, read_cache_entry, write_cache_entry
+from lib.model_rendering import TexturedBWModel, TexturedBWMesh
+from lib.render.model_renderingv2 import BWModelV2, index_mesh
 from lib.lua.bwarchivelib import BattalionArchive
 from io import BytesIO
 
 
+model_cache_budget = DEFAULT_SIZE_BUDGET
+
+
+def set_model_cache_budget(size):
+    global model_cache_budget
+    model_cache_budget = size
+
+
+def parse_model(data, is_bw1, cachepath):
+    # Runs in a worker process. Returns the parsed model as plain data, see model_cache.
+    entry = read_cache_entry(cachepath)
+    if entry is not None:
+        return entry, True
+
+    if is_bw1:
+        model = BW1Model()
+    else:
+        model = BW2Model()
+    model.from_file(BytesIO(data))
+    texmodel = model.make_textured_model(None)
+
+    # Merging duplicate vertices happens here too so the main thread only has to upload the meshes
+    meshes = []
+    for mesh in texmodel.mesh_list:
+        vertices, indices = index_mesh(mesh.vertex_data(), 5)
+        meshes.append((mesh.texname, vertices, indices))
+
+    parsed = {
+        "textures": texmodel.all_textures,
+        "meshes": meshes,
+        "boundsphere": texmodel.boundsphere + (texmodel.boundsphereradius, )
+    }
+    write_cache_entry(cachepath, parsed)
+    return parsed, False
+
+
+def make_textured_model(parsed):
+    texmodel = TexturedBWModel()
+    texmodel.all_textures = parsed["textures"]
+    for texname, vertices, indices in parsed["meshes"]:
+        mesh = TexturedBWMesh(texname)
+        data = vertices[indices]
+        mesh.add_triangles(data[:, 0:3], data[:, 3:5])
+        texmodel.mesh_list.append(mesh)
+    texmodel.set_boundsphere(*parsed["boundsphere"])
+    return texmodel
+
+
 class BWModelHandler(object):
     def __init__(self):
         self.models = {}
         self.instancemodels = {}
         self.textures: TextureArchive = None
+        self.cache = ModelCache(os.path.join(os.path.dirname(sys.argv[0]), "model_cache"), model_cache_budget)
+
+    def start_parsing(self, bwarc, models):
+        # Models are parsed in the worker processes, or taken from the cache if the same
+        # model data was parsed before.
+        is_bw1 = bwarc.textures.is_bw1
+        jobs = []
+        for modeldata in models:
+            data = bytes(modeldata.data[8:])
+            cachepath = self.cache.path(self.cache.key(data, is_bw1))
+            jobs.append((modeldata.name, get_worker_pool().apply_async(parse_model, (data, is_bw1, cachepath))))
+        return jobs
+
+    def finish_parsing(self, jobs, callback=None):
+        # Only creating the render models happens here
+        for i, (name, job) in enumerate(jobs):
+            parsed, hit = job.get()
+            self.cache.record(hit)
+            texmodel = make_textured_model(parsed)
+            self.models[name] = texmodel
+            self.instancemodels[name] = BWModelV2.from_indexed_meshes(parsed["meshes"])
+            if callback is not None: callback(len(jobs), i)
+
+        if len(jobs) > 0:
+            self.cache.print_statistics()
+            self.print_mesh_statistics()
+
+    def detach(self):
+        # Models are copied out of the archive for parsing, only the textures keep its data
+        if self.textures is not None:
+            self.textures.detach()
+
+    def mesh_statistics(self):
+        return {name: model.mesh_statistics() for name, model in self.instancemodels.items()}
+
+    def print_mesh_statistics(self, per_model=False):
+        stats = self.mesh_statistics()
+        if per_model:
+            for name in sorted(stats):
+                model = stats[name]
+                print("{0}: {1} vertices before, {2} vertices and {3} indices after indexing".format(
+                    name, model["vertices_before"], model["vertices_after"], model["indices"]))
+
+        total = {key: sum(model[key] for model in stats.values())
+                 for key in ("vertices_before", "vertices_after", "indices", "bytes_before", "bytes_after")}
+        print("Model meshes: {0} vertices before, {1} vertices and {2} indices after indexing, "
+              "{3:.1f} KiB -> {4:.1f} KiB".format(
+                total["vertices_before"], total["vertices_after"], total["indices"],
+                total["bytes_before"]/1024, total["bytes_after"]/1024))
 
     @classmethod
     def from_archive(cls, bwarc, callback=None):
         bwmodels = cls()
+        evicted = bwmodels.cache.evict()
+        if evicted > 0:
+            print("Evicted", evicted, "entries from the model cache")
 
+        # Models are queued before the textures so the pool works on them first
+        jobs = bwmodels.start_parsing(bwarc, list(bwarc.models()))
         bwmodels.textures = TextureArchive(bwarc)
-        models = [x for x in bwarc.models()]
-        for i, modeldata in enumerate(models):
-            name = modeldata.name  # str(modeldata.res_name, encoding="ascii")
-            print(name)
-            if bwarc.textures.is_bw1:
-                model = BW1Model()
-            else:
-                model = BW2Model()
-            # data = modeldata.entries[0]
-            # data.fileobj.seek(0)
-            # f = data.fileobj
-            f = BytesIO(modeldata.data[8:])
-            model.from_file(f)
-            texmodel = model.make_textured_model(bwmodels.textures)
-            bwmodels.models[name] = texmodel  # model
-            bwmodels.instancemodels[name] = BWModelV2.from_textured_bw_model(texmodel)
-            if callback is not None: callback(len(models), i)
+        bwmodels.textures.decode_all()
+        bwmodels.finish_parsing(jobs, callback)
         return bwmodels
 
     @classmethod
@@ -44,24 +135,17 @@ class BWModelHandler(object):
         return cls.from_archive(bwarc, callback)
 
     def update_models(self, bwarc, force_update_models=[], force_update_textures=[]):
-        self.textures.update_textures(bwarc, force_update_textures)
-
-        for i, modeldata in enumerate(bwarc.models()):
+        models = []
+        for modeldata in bwarc.models():
             name = modeldata.name#str(modeldata.res_name, encoding="ascii")
             if name not in self.models or name in force_update_models:
                 print(name)
-                if bwarc.textures.is_bw1:
-                    model = BW1Model()
-                else:
-                    model = BW2Model()
-                #data = modeldata.entries[0]
-                #data.fileobj.seek(0)
-                #f = data.fileobj
-                f = BytesIO(modeldata.data[8:])
-                model.from_file(f)
-                texmodel = model.make_textured_model(self.textures)
-                self.models[name] = texmodel#model
-                self.instancemodels[name] = BWModelV2.from_textured_bw_model(texmodel)
+                models.append(modeldata)
+        jobs = self.start_parsing(bwarc, models)
+
+        self.textures.update_textures(bwarc, force_update_textures)
+        self.textures.decode_all()
+        self.finish_parsing(jobs)
 
     def rendermodel(self, name, mtx, bwterrain, offset):
         """pos = bwmatrix.position
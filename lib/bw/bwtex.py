@@ -328,7 +328,8 @@ class BW2Texture(Texture):
         
         #tex.mipmaps.append(f.read(size))
 
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        # decode_image zero pads mip data that is shorter than the last block row
+        imagedata = BytesIO(f.read(size))
         
         #assert size == len(imagedata.getbuffer())
         mip = decode_image(
@@ -346,7 +347,7 @@ class BW2Texture(Texture):
                 section = read_id(f)
                 size = read_uint32_le(f)
                 assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+                imagedata = BytesIO(f.read(size))
                 mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
                 mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
                 #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
@@ -564,7 +565,8 @@ class BW1Texture(Texture):
             assert section == MIP
  
         #tex.mipmaps.append(f.read(size))
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        # decode_image zero pads mip data that is shorter than the last block row
+        imagedata = BytesIO(f.read(size))
         
         #assert size == len(imagedata.getbuffer())
         #print(FORMAT[tex.fmt], hex(size), tex.size_x, tex.size_y)
@@ -583,7 +585,7 @@ class BW1Texture(Texture):
                 section = read_id(f)
                 size = read_uint32_le(f)
                 assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+                imagedata = BytesIO(f.read(size))
                 mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
                 mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
                 #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
@@ -1,4 +1,7 @@
 from enum import Enum, IntEnum
+from struct import unpack_from
+
+import numpy
 
 VTXFMT = Enum("VTXFMT", ["NOT_PRESENT", "DIRECT", "INDEX8", "INDEX16"], start=0)
 
@@ -116,4 +119,90 @@ class VertexDescriptor(object):
             self.texcoord[i] = (val & 0b1) == 1
             val = val >> 1
 
-        self.active = list(x for x in self._active_attributes())
\ No newline at end of file
+        self.active = list(x for x in self._active_attributes())
+
+
+_vertex_dtypes = {}
+
+
+def vertex_dtype(vertexdesc):
+    # Structured dtype for one vertex of a primitive in a display list, attributes are
+    # in the same order as in VertexDescriptor.active_attributes()
+    if vertexdesc in _vertex_dtypes:
+        return _vertex_dtypes[vertexdesc]
+
+    attribs = VertexDescriptor()
+    attribs.from_value(vertexdesc)
+
+    fields = []
+    for attrib, fmt in attribs.active_attributes():
+        if attrib == VTX.Position or attrib == VTX.Normal:
+            if fmt == VTXFMT.INDEX8:
+                fields.append((attrib.name, "u1"))
+            elif fmt == VTXFMT.INDEX16:
+                fields.append((attrib.name, ">u2"))
+            else:
+                raise RuntimeError("unknown {0} format".format(attrib.name.lower()))
+        elif fmt is not None:
+            # Direct colors aren't read
+            if fmt == VTXFMT.INDEX8:
+                fields.append((attrib.name, "u1"))
+            elif fmt == VTXFMT.INDEX16:
+                fields.append((attrib.name, ">u2"))
+        else:
+            fields.append((attrib.name, "u1"))
+
+    dtype = numpy.dtype(fields)
+    _vertex_dtypes[vertexdesc] = dtype
+    return dtype
+
+
+def read_display_list(data, vertexdesc=0):
+    # Returns the triangle strips in the display list as structured arrays with a field
+    # per attribute (named after VTX), and the vertex descriptor that is set at the end.
+    strips = []
+    offset = 0
+    end = len(data)
+
+    while offset < end:
+        opcode = data[offset]
+        offset += 1
+
+        if opcode == 0x00:  # NOP
+            pass
+        elif opcode == 0x8:  # Load CP Reg
+            command = data[offset]
+            val = unpack_from(">I", data, offset+1)[0]
+            offset += 5
+            if command == 0x50:
+                vertexdesc &= ~0x1FFFF
+                vertexdesc |= val
+            elif command == 0x60:
+                vertexdesc &= 0x1FFFF
+                vertexdesc |= (val << 17)
+            else:
+                raise RuntimeError("unknown CP command {0:x}".format(command))
+        elif opcode == 0x10:  # Load XF Reg
+            offset += 8
+        elif opcode & 0xFA == 0x98:  # Triangle strip
+            vertex_count = unpack_from(">H", data, offset)[0]
+            offset += 2
+            dtype = vertex_dtype(vertexdesc)
+            vertices = numpy.frombuffer(data, dtype, vertex_count, offset)
+            offset += vertex_count*dtype.itemsize
+            strips.append(vertices)
+        else:
+            raise RuntimeError("Unknown opcode: {0:x}".format(opcode))
+
+    return strips, vertexdesc
+
+
+def strip_triangles(vertex_count):
+    # Corner indices of the triangles in a strip, winding matches the order the meshes were built in before
+    k = numpy.arange(max(vertex_count-2, 0))
+    odd = k % 2 == 1
+    triangles = numpy.empty((len(k), 3), dtype=numpy.int64)
+    triangles[:, 0] = k+2
+    triangles[:, 1] = numpy.where(odd, k, k+1)
+    triangles[:, 2] = numpy.where(odd, k+1, k)
+    return triangles.reshape(-1)
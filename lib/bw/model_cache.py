@@ -0,0 +1,67 @@
+import os
+import json
+
+import numpy
+
+from .texture_cache import TextureCache
+
+
+# Bump this whenever parsing changes the output so old cache entries stop matching
+PARSER_VERSION = 2
+CACHE_EXTENSION = ".npz"
+DEFAULT_SIZE_BUDGET = 256*1024*1024
+
+
+# A parsed model is a dict of plain data that can be sent between processes:
+#   "textures": names of all textures used by the model
+#   "meshes": list of (texture name, float32 array of unique x, y, z, u, v rows, indices into the rows
+#             for every triangle corner). The indices are uint16 or uint32, see index_mesh.
+#   "boundsphere": (x, y, z, radius)
+def read_cache_entry(path):
+    # Returns the parsed model or None if there is no usable entry.
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with numpy.load(path, allow_pickle=False) as entry:
+            info = json.loads(str(entry["info"]))
+            meshes = [(texname, entry["vertices{0}".format(i)], entry["indices{0}".format(i)])
+                      for i, texname in enumerate(info["meshes"])]
+    except Exception as err:
+        print("Couldn't read model cache entry", path, err)
+        return None
+
+    # Reading an entry counts as using it for the LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return {"textures": info["textures"], "meshes": meshes, "boundsphere": tuple(info["boundsphere"])}
+
+
+def write_cache_entry(path, parsed):
+    info = {
+        "textures": parsed["textures"],
+        "meshes": [texname for texname, vertices, indices in parsed["meshes"]],
+        "boundsphere": list(parsed["boundsphere"])
+    }
+    arrays = {}
+    for i, (texname, vertices, indices) in enumerate(parsed["meshes"]):
+        arrays["vertices{0}".format(i)] = vertices
+        arrays["indices{0}".format(i)] = indices
+
+    # Write to a temporary file first so other processes never see half written entries
+    tmppath = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmppath, "wb") as f:
+        numpy.savez(f, info=numpy.array(json.dumps(info)), **arrays)
+    os.replace(tmppath, path)
+
+
+class ModelCache(TextureCache):
+    name = "Model cache"
+    version = PARSER_VERSION
+    extension = CACHE_EXTENSION
+
+    def __init__(self, folder, size_budget=DEFAULT_SIZE_BUDGET):
+        super().__init__(folder, size_budget, compress=False)
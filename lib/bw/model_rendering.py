@@ -1,11 +1,12 @@
 import os
 
+import numpy
 from OpenGL.GL import *
 from binascii import hexlify
 from struct import unpack
 from .vectors import Vector3, Matrix4x4
 from .read_binary import *
-from .gx import VertexDescriptor, VTX, VTXFMT
+from .gx import VertexDescriptor, VTX, VTXFMT, read_display_list, strip_triangles
 from math import floor, ceil
 from lib.model_rendering import TexturedBWModel, TexturedBWMesh
 from timeit import default_timer as timer
@@ -132,11 +133,9 @@ class BW2Model(Model):
             self.nodes[child].parent = self.nodes[parent]
 
         assert f.tell() == start+cnctsize
+        # Display lists are created when the nodes are first rendered so parsing needs no GL context
         self.render_order = []
         for node in self.nodes:
-            #start = timer()
-            node.create_displaylists()
-            #print("node", node.name, "took", timer() - start, "s")
             self.render_order.append(node )
 
     def _skip_section(self, f, secname):
@@ -197,13 +196,9 @@ class BW2Model(Model):
                         tex = texturename.strip(b"\x00").decode("ascii")
                         if tex not in model.all_textures:
                             model.all_textures.append(tex)
-        avgx = 0
-        avgy = 0
-        avgz = 0
+        total = numpy.zeros(3)
+        maximum = numpy.zeros(3)
         count = 0
-        maxx = 0
-        maxy = 0
-        maxz = 0
 
         for node in self.nodes:
             if node.do_skip():
@@ -219,32 +214,19 @@ class BW2Model(Model):
                 mvmat.inplace_multiply_mat4(currnode.transform.matrix4)
                 # normals_mvmat.inplace_multiply_mat4(currnode.transform.matrix4)
 
-            # print(mvmat)
-            vertices = []
-            for x, y, z in node.vertices:
-                newx, newy, newz, _ = mvmat.multiply_vec4(x * node.vscl, y * node.vscl, z * node.vscl, 1)
-                avgx += newx
-                avgy += newy
-                avgz += newz
-                count += 1
-
-                if abs(newx) > maxx:
-                    maxx = abs(newx)
-                if abs(newy) > maxy:
-                    maxy = abs(newy)
-                if abs(newz) > maxz:
-                    maxy = abs(newz)
-
-                vertices.append((newx, newy, newz))
-                #obj.write("v {0} {1} {2}\n".format(-newx, newy, newz))
-
-            # for x, y, z in node.normals:
-            #    newx, newy, newz, _ = mvmat.multiply_vec4(x, y, z, 0)
-            #    obj.write("vn {0} {1} {2}\n".format(newx, newy, newz))
-            uvs = []
-            for u, v in node.uvmaps[0]:
-                uvs.append((u,v))
+            vertices = numpy.zeros((len(node.vertices), 3))
+            if len(node.vertices) > 0:
+                x, y, z = (numpy.asarray(node.vertices, dtype=numpy.float64) * node.vscl).T
+                # Same operations in the same order as Matrix4x4.multiply_vec4
+                vertices[:, 0] = mvmat.a1 * x + mvmat.b1 * y + mvmat.c1 * z + mvmat.d1
+                vertices[:, 1] = mvmat.a2 * x + mvmat.b2 * y + mvmat.c2 * z + mvmat.d2
+                vertices[:, 2] = mvmat.a3 * x + mvmat.b3 * y + mvmat.c3 * z + mvmat.d3
 
+                total += vertices.sum(axis=0)
+                maximum = numpy.maximum(maximum, numpy.abs(vertices).max(axis=0))
+                count += len(vertices)
+
+            uvs = numpy.asarray(node.uvmaps[0], dtype=numpy.float64).reshape(-1, 2)
 
             for matindex, mesh in node.meshes:
 
@@ -260,55 +242,20 @@ class BW2Model(Model):
                     #    glBegin(GL_TRIANGLES)
                     else:
                         raise RuntimeError("woops unsupported prim type {0:x}".format(prim.type))
-                    i = 0
-                    vert1, vert2, vert3 = None, None, None
-
-                    for vertex in prim.vertices:
-                        if vert1 is None:
-                            vert1 = vertex
-                            continue
-                        elif vert2 is None:
-                            vert2 = vertex
-                            continue
-                        elif vert3 is None:
-                            vert3 = vertex
-                        else:
-                            vert1 = vert2
-                            vert2 = vert3
-                            vert3 = vertex
-                            i = (i + 1) % 2
-
-                        if i == 0:
-                            v1 = vert1
-                            v2 = vert2
-                            v3 = vert3
-                        else:
-                            v1 = vert2
-                            v2 = vert1
-                            v3 = vert3
-
-                        for v in (v3, v2, v1):
-                            posindex, normindex = v[0], v[1]
-                            tex0 = v[2]
-                            tex1 = v[3]
-                            hasNormals = False
-                            hasTexcoords = False
-
-                            if not tex1 is None:
-                                hasTexcoords = True
-                                # print(tex1, self.uvmaps[0])
-                                if not tex0 is None:
-                                    texcoordindex = tex0 << 8 | tex1
-                                else:
-                                    texcoordindex = tex1
-
-                                currmesh.trilist.append((vertices[posindex], uvs[texcoordindex]))
+
+                    # Vertices without texture coordinates were never added to the meshes
+                    texcoord_indices = prim.texcoord_indices()
+                    if texcoord_indices is None:
+                        continue
+
+                    corners = strip_triangles(len(prim.array))
+                    posindices = prim.attribute(VTX.Position)[corners]
+                    currmesh.add_triangles(vertices[posindices], uvs[texcoord_indices[corners]])
         if count == 0:
             count = 1
 
-        center_x = avgx/count
-        center_y = avgy/count
-        center_z = avgz/count
+        center_x, center_y, center_z = (total/count).tolist()
+        maxx, maxy, maxz = maximum.tolist()
 
         radius = ((center_x-maxx)**2 + (center_y-maxy)**2 + (center_z-maxz)**2)**0.5
 
@@ -330,7 +277,7 @@ class BW2Model(Model):
 
         for texturename in exported_textures:
             texname = str(texturename.strip(b"\x00"), encoding="ascii") + ".png"
-            result = texturearchive.get_texture(texturename.lower())
+            result = texturearchive.get_texture(texturename.lower(), wait=True)
             if result is not None:
                 tex, texid = result
                 tex.dump_to_file(os.path.join(outputpath, texname))
@@ -521,11 +468,7 @@ class BW1Model(BW2Model):
         assert f.tell() == start+cnctsize
         self.render_order = []
         for node in self.nodes:
-            start = timer()
-            node.create_displaylists()
-            #print("node", node.name, "took", timer() - start, "s")
             self.render_order.append(node )
-            #print(node._displaylists, node.meshes)
 
 
 class LODLevel(object):
@@ -536,9 +479,42 @@ class LODLevel(object):
 
 
 class Primitive(object):
-    def __init__(self, primtype):
+    def __init__(self, primtype, array=None):
         self.type = primtype
-        self.vertices = []
+        # Structured array of the vertex attributes as read from the display list
+        self.array = array
+        self._vertices = [] if array is None else None
+
+    # Per vertex lists of [position index, normal index, texcoord 0 to 7], None if not present.
+    # Only built when something asks for it, meshes are built from the array.
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            count = len(self.array)
+            columns = []
+            for attrib in (VTX.Position, VTX.Normal, VTX.Tex0Coord, VTX.Tex1Coord, VTX.Tex2Coord, VTX.Tex3Coord,
+                           VTX.Tex4Coord, VTX.Tex5Coord, VTX.Tex6Coord, VTX.Tex7Coord):
+                if attrib.name in self.array.dtype.names:
+                    columns.append(self.array[attrib.name].tolist())
+                else:
+                    columns.append([None]*count)
+            self._vertices = [list(vertex) for vertex in zip(*columns)]
+        return self._vertices
+
+    def attribute(self, attrib):
+        if self.array is None or attrib.name not in self.array.dtype.names:
+            return None
+        return self.array[attrib.name].astype(numpy.int64)
+
+    def texcoord_indices(self):
+        # Index into the first uv map, the first two texcoord attributes make up a 16 bit index
+        tex0, tex1 = self.attribute(VTX.Tex0Coord), self.attribute(VTX.Tex1Coord)
+        if tex1 is None:
+            return None
+        elif tex0 is not None:
+            return tex0 << 8 | tex1
+        else:
+            return tex1
 
 
 class NodeBW2(object):
@@ -587,6 +563,11 @@ class NodeBW2(object):
     def setparent(self, parent):
         self.parent = parent
 
+    def add_normals(self, normals):
+        if len(self.normals) > 0:
+            normals = numpy.concatenate((self.normals, normals))
+        self.normals = normals
+
     def from_file(self, f):
         nodename = f.read(4)
         assert nodename == b"EDON"
@@ -667,100 +648,19 @@ class NodeBW2(object):
             elif secname in (b"VUV1", b"VUV2", b"VUV3", b"VUV4"):
                 uvindex = secname[3] - b"1"[0]
 
-                for i in range(size // 4):
-                    scale = 2.0**11
-                    u_int = read_int16(f)
-                    v_int = read_int16(f)
-                    u, v = (u_int)/(scale), (v_int)/(scale)
-                    self.uvmaps[uvindex].append((u, v))
+                uvs = numpy.frombuffer(f.read(size // 4 * 4), ">i2").reshape(-1, 2)
+                self.uvmaps[uvindex] = uvs / 2.0**11
 
             elif secname == b"XBS2":
-                #eprint(hex(f.tell()))
                 materialindex = read_uint32(f)
                 unknown = (read_uint32(f), read_uint32(f))
                 gx_data_size = read_uint32(f)
                 gx_data_end = f.tell() + gx_data_size
-                #print(hex(gx_data_end), hex(gx_data_size))
 
-                mesh = []
+                strips, vertexdesc = read_display_list(f.read(gx_data_size), vertexdesc)
+                mesh = [Primitive(0x98, strip) for strip in strips]
                 self.meshes.append((materialindex, mesh))
 
-                while f.tell() < gx_data_end:
-                    opcode = read_uint8(f)
-
-                    if opcode == 0x8:  # Load CP Reg
-                        command = read_uint8(f)
-                        val = read_uint32(f)
-                        if command == 0x50:
-                            vertexdesc &= ~0x1FFFF
-                            vertexdesc |= val
-                        elif command == 0x60:
-                            vertexdesc &= 0x1FFFF
-                            vertexdesc |= (val << 17)
-                        else:
-                            raise RuntimeError("unknown CP command {0:x}".format(command))
-
-                    elif opcode == 0x10:  # Load XF Reg
-                        x = read_uint32(f)
-                        y = read_uint32(f)
-
-                    elif opcode & 0xFA == 0x98:  # Triangle strip
-                        attribs = VertexDescriptor()
-                        attribs.from_value(vertexdesc)
-
-                        vertex_count = read_uint16(f)
-                        prim = Primitive(0x98)
-                        #print(bin(vertexdesc))
-                        #print([x for x in attribs.active_attributes()])
-
-                        for i in range(vertex_count):
-                            primattrib = [None, None,
-                                          None,None,None,None,None,None,None,None]
-
-                            for attrib, fmt in attribs.active_attributes():
-                                # matindex = read_uint8(f)
-
-                                if attrib == VTX.Position:
-                                    if fmt == VTXFMT.INDEX8:
-                                        posIndex = read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        posIndex = read_uint16(f)
-                                    else:
-                                        raise RuntimeError("unknown position format")
-                                    primattrib[0] = posIndex
-                                elif attrib == VTX.Normal:
-                                    if fmt == VTXFMT.INDEX8:
-                                        normIndex = read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        normIndex = read_uint16(f)
-                                    else:
-                                        raise RuntimeError("unknown normal format")
-                                    primattrib[1] = normIndex
-                                elif attrib is not None and VTX.Tex0Coord <= attrib <= VTX.Tex7Coord:
-                                    coordindex = attrib - VTX.Tex0Coord
-                                    val = read_uint8(f)
-                                    primattrib[2+coordindex] = val
-                                elif fmt is not None:
-                                    if fmt == VTXFMT.INDEX8:
-                                        read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        read_uint16(f)
-                                    else:
-                                        RuntimeError("unknown fmt format")
-
-                                else:
-                                    read_uint8(f)
-
-                            prim.vertices.append(primattrib)
-
-                        #self.triprimitives.append(prim)
-                        mesh.append(prim)
-                    elif opcode == 0x00:
-                        pass
-                    else:
-                        #print(self.name, hex(f.tell()-nodestart))
-                        raise RuntimeError("Unknown opcode: {0:x}".format(opcode))
-
                 f.seek(gx_data_end)
 
             elif secname == b"VPOS":
@@ -772,26 +672,20 @@ class NodeBW2(object):
                 assert size%6 == 0
                 #assert size%4 == 0
 
-                for i in range(size//6):
-                    #self.vertices.append((read_float_le(f), read_float_le(f), read_float_le(f)))
-                    self.vertices.append(read_int16_tripple(f))
+                self.vertices = numpy.frombuffer(f.read(size), ">i2").reshape(-1, 3)
 
             elif secname == b"VNRM":
                 assert size%3 == 0
-                for i in range(size//3):
-                    self.normals.append(read_int8_tripple(f))
+                self.add_normals(numpy.frombuffer(f.read(size), "i1").reshape(-1, 3))
 
             elif secname == b"VNBT":
                 assert size%3 == 0
                 assert size%9 == 0
                 assert size % 36 == 0
-                for i in range(size//36):
-                    #self.normals.append((read_int8(f), read_int8(f), read_int8(f)))
-                    #f.read(6)
-                    self.normals.append(read_float_tripple(f))
-                    self.binormals.append(read_float_tripple(f))
-
-                    self.tangents.append(read_float_tripple(f))
+                nbt = numpy.frombuffer(f.read(size), ">f4").reshape(-1, 3, 3)
+                self.add_normals(nbt[:, 0])
+                self.binormals = nbt[:, 1]
+                self.tangents = nbt[:, 2]
 
             else:
                 f.read(size)
@@ -837,6 +731,9 @@ class NodeBW2(object):
         #matloc = glGetUniformLocation(shader, "modelview")
         #glUniformMatrix4fv(matloc, 1, False, self._mvmat)
 
+        if len(self._displaylists) == 0:
+            self.create_displaylists()
+
         for i, displist in self._displaylists:
             material = self.materials[i]
 
@@ -1052,99 +949,19 @@ class NodeBW1(NodeBW2):
             elif secname in (b"VUV1", b"VUV2", b"VUV3", b"VUV4"):
                 uvindex = secname[3] - b"1"[0]
 
-                for i in range(size // 4):
-                    scale = 2.0 ** 11
-                    u_int = read_int16(f)
-                    v_int = read_int16(f)
-                    u, v = (u_int) / (scale), (v_int) / (scale)
-                    self.uvmaps[uvindex].append((u, v))
+                uvs = numpy.frombuffer(f.read(size // 4 * 4), ">i2").reshape(-1, 2)
+                self.uvmaps[uvindex] = uvs / 2.0**11
 
             elif secname == b"XBST":
-                # eprint(hex(f.tell()))
                 materialindex = read_uint32(f)
                 unknown = (read_uint32(f),)
                 gx_data_size = read_uint32(f)
                 gx_data_end = f.tell() + gx_data_size
-                # print(hex(gx_data_end), hex(gx_data_size))
 
-                mesh = []
+                strips, vertexdesc = read_display_list(f.read(gx_data_size), vertexdesc)
+                mesh = [Primitive(0x98, strip) for strip in strips]
                 self.meshes.append((materialindex, mesh))
 
-                while f.tell() < gx_data_end:
-                    opcode = read_uint8(f)
-
-                    if opcode == 0x8:  # Load CP Reg
-                        command = read_uint8(f)
-                        val = read_uint32(f)
-                        if command == 0x50:
-                            vertexdesc &= ~0x1FFFF
-                            vertexdesc |= val
-                        elif command == 0x60:
-                            vertexdesc &= 0x1FFFF
-                            vertexdesc |= (val << 17)
-                        else:
-                            raise RuntimeError("unknown CP command {0:x}".format(command))
-                    elif opcode == 0x10:  # Load XF Reg
-                        x = read_uint32(f)
-                        y = read_uint32(f)
-
-                    elif opcode & 0xFA == 0x98:  # Triangle strip
-                        attribs = VertexDescriptor()
-                        attribs.from_value(vertexdesc)
-
-                        vertex_count = read_uint16(f)
-                        prim = Primitive(0x98)
-                        # print(bin(vertexdesc))
-                        # print([x for x in attribs.active_attributes()])
-
-                        for i in range(vertex_count):
-                            primattrib = [None, None,
-                                          None, None, None, None, None, None, None, None]
-
-                            for attrib, fmt in attribs.active_attributes():
-                                # matindex = read_uint8(f)
-
-                                if attrib == VTX.Position:
-                                    if fmt == VTXFMT.INDEX8:
-                                        posIndex = read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        posIndex = read_uint16(f)
-                                    else:
-                                        raise RuntimeError("unknown position format")
-                                    primattrib[0] = posIndex
-                                elif attrib == VTX.Normal:
-                                    if fmt == VTXFMT.INDEX8:
-                                        normIndex = read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        normIndex = read_uint16(f)
-                                    else:
-                                        raise RuntimeError("unknown normal format")
-                                    primattrib[1] = normIndex
-                                elif attrib is not None and VTX.Tex0Coord <= attrib <= VTX.Tex7Coord:
-                                    coordindex = attrib - VTX.Tex0Coord
-                                    val = read_uint8(f)
-                                    primattrib[2 + coordindex] = val
-                                elif fmt is not None:
-                                    if fmt == VTXFMT.INDEX8:
-                                        read_uint8(f)
-                                    elif fmt == VTXFMT.INDEX16:
-                                        read_uint16(f)
-                                    else:
-                                        RuntimeError("unknown fmt format")
-
-                                else:
-                                    read_uint8(f)
-
-                            prim.vertices.append(primattrib)
-
-                        # self.triprimitives.append(prim)
-                        mesh.append(prim)
-                    elif opcode == 0x00:
-                        pass
-                    else:
-                        #print(self.name, hex(f.tell() - nodestart))
-                        raise RuntimeError("Unknown opcode: {0:x}".format(opcode))
-
                 f.seek(gx_data_end)
 
             elif secname == b"VPOS":
@@ -1156,26 +973,20 @@ class NodeBW1(NodeBW2):
                 assert size % 6 == 0
                 # assert size%4 == 0
 
-                for i in range(size // 6):
-                    # self.vertices.append((read_float_le(f), read_float_le(f), read_float_le(f)))
-                    self.vertices.append(read_int16_tripple(f))
+                self.vertices = numpy.frombuffer(f.read(size), ">i2").reshape(-1, 3)
 
             elif secname == b"VNRM":
                 assert size % 3 == 0
-                for i in range(size // 3):
-                    self.normals.append(read_int8_tripple(f))
+                self.add_normals(numpy.frombuffer(f.read(size), "i1").reshape(-1, 3))
 
             elif secname == b"VNBT":
                 assert size % 3 == 0
                 assert size % 9 == 0
                 assert size % 36 == 0
-                for i in range(size // 36):
-                    # self.normals.append((read_int8(f), read_int8(f), read_int8(f)))
-                    # f.read(6)
-                    self.normals.append(read_float_tripple(f))
-                    self.binormals.append(read_float_tripple(f))
-
-                    self.tangents.append(read_float_tripple(f))
+                nbt = numpy.frombuffer(f.read(size), ">f4").reshape(-1, 3, 3)
+                self.add_normals(nbt[:, 0])
+                self.binormals = nbt[:, 1]
+                self.tangents = nbt[:, 2]
 
             else:
                 f.read(size)
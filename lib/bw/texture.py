@@ -2,7 +2,7 @@ import os
 import sys
 import multiprocessing as mp
 
-from lib.lua.bwarchivelib import BattalionArchive
+from lib.lua.bwarchivelib import BattalionArchive, detach_data
 from OpenGL.GL import *
 from io import BytesIO
 from array import array
@@ -16,23 +16,62 @@ from timeit import default_timer
 
 from .read_binary import *
 from lib.bw.bwtex import Texture, BW1Texture, BW2Texture
+from lib.bw.texture_cache import TextureCache, DEFAULT_SIZE_BUDGET, read_cache_entry, write_cache_entry
 
 
-def process(queuein, queueout):
-    while True:
-        tex = queuein.get()
+# Hack for mission 5.2: The cave uses a mostly transparent texture that has a rock texture
+# hidden in the transparent parts. Force the alpha to be fully opaque to render it correctly.
+FORCE_OPAQUE = ("c1sncave", "c1snstalactite")
+
+_worker_pool = None
+texture_cache_budget = DEFAULT_SIZE_BUDGET
+
+
+# Worker processes shared by texture decoding and model parsing
+def get_worker_pool():
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = mp.Pool(max(1, (os.cpu_count() or 2) - 1))
+    return _worker_pool
+
+
+def set_texture_cache_budget(size):
+    global texture_cache_budget
+    texture_cache_budget = size
+
+
+def decode_texture(texname, name, data, is_bw1, cachepath, compress):
+    # Runs in a worker process. Only plain data goes in and out, the GL upload
+    # happens when the result is picked up on the GL thread.
+    entry = read_cache_entry(cachepath)
+    hit = entry is not None
+    if hit:
+        size_x, size_y, rgba = entry
+    else:
+        f = BytesIO(data)
+        if is_bw1:
+            tex = BW1Texture.from_file(name, f, ignoremips=True)
+        else:
+            tex = BW2Texture.from_file(name, f, ignoremips=True)
+        image = tex.texture
+        size_x, size_y, rgba = image.width, image.height, image.tobytes()
+        write_cache_entry(cachepath, size_x, size_y, rgba, compress)
+
+    if texname in FORCE_OPAQUE:
+        image = Image.frombytes("RGBA", (size_x, size_y), rgba)
+        image.putalpha(255)
+        rgba = image.tobytes()
+
+    return size_x, size_y, rgba, hit
 
 
 class TextureArchive(object):
     def __init__(self, archive: "BattalionArchive"):
-        self.cachefolder = os.path.join(os.path.dirname(sys.argv[0]), "texture_cache")
-        if not os.path.exists(self.cachefolder):
-            os.mkdir(self.cachefolder)
-
-        self.cached_textures = {}
-        for filename in os.listdir(self.cachefolder):
-            if filename.endswith(".png"):
-                self.cached_textures[filename.replace(".png", "")] = True
+        self.cache = TextureCache(os.path.join(os.path.dirname(sys.argv[0]), "texture_cache"),
+                                  texture_cache_budget)
+        evicted = self.cache.evict()
+        if evicted > 0:
+            print("Evicted", evicted, "entries from the texture cache")
 
         self.is_bw1 = archive.textures.is_bw1
 
@@ -45,12 +84,12 @@ class TextureArchive(object):
 
         self._cached = {}
         self.tex = glGenTextures(1)
-        self.placeholder = Texture("PlaceHolder")
-        self.placeholder.create_dummy(64, 64)
+        self.placeholder = Texture.create_dummy("PlaceHolder", 64, 64)
 
-        self.texture_queue = mp.Queue()
-        self.result_queue = mp.Queue()
-        self.texture_processor = mp.Process(target=process, args=(self.texture_queue, self.result_queue))
+        self._decoding = {}  # Texture name -> result of the pool job
+        self._waiting = set()  # Initialized textures that still show the placeholder
+        # Changes whenever textures are reloaded so renderers know their resolved handles are stale
+        self.generation = 0
 
     def register_texture(self, texture):
         self.textures[texture.name.lower()] = texture
@@ -61,16 +100,61 @@ class TextureArchive(object):
             name2 = name.ljust(0x20, b"\x00")
         self.textures[name2] = texture
 
+    def decode_all(self):
+        # Start decoding every texture of the archive so they are ready by the time they are drawn
+        for texname, texture in self.textures.items():
+            if isinstance(texname, str):
+                self.start_decoding(texname)
+
+    def start_decoding(self, texname):
+        if texname in self._decoding or texname in self.texture_decoded_data:
+            return
+
+        texture = self.textures[texname]
+        cachepath = self.cache.path(self.cache.key(texture.data, self.is_bw1))
+        # Texture data can be a memoryview into the mapped archive which can't be sent to the pool
+        self._decoding[texname] = get_worker_pool().apply_async(
+            decode_texture,
+            (texname, texture.name, bytes(texture.data), self.is_bw1, cachepath, self.cache.compress))
+
+    def take_decoded(self, texname, wait=False):
+        if texname not in self.texture_decoded_data:
+            result = self._decoding.get(texname)
+            if result is None or not (wait or result.ready()):
+                return None
+
+            del self._decoding[texname]
+            try:
+                size_x, size_y, rgba, hit = result.get()
+                self.texture_decoded_data[texname] = (size_x, size_y, rgba)
+                self.cache.record(hit)
+            except Exception as err:
+                print("Decoding", texname, "failed:", err)
+                dummy = Texture.create_dummy(texname)
+                self.texture_decoded_data[texname] = (32, 32, dummy.texture.tobytes())
+
+        return self.texture_decoded_data.pop(texname)
+
+    def has_pending(self):
+        return len(self._waiting) > 0
+
+    def update_pending(self):
+        # Uploads textures that finished decoding since the last frame
+        for texname in list(self._waiting):
+            self.load_texture(texname)
+
     def clear_cache(self, textures=tuple()):
         for texname in textures:
             texname = texname.lower()
             print("Clearing", texname)
-            if texname in self.cached_textures:
-                os.remove(os.path.join(self.cachefolder, texname+".png"))
-                del self.cached_textures[texname]
+            self._decoding.pop(texname, None)
+            self.texture_decoded_data.pop(texname, None)
+            if texname in self.textures:
+                self.cache.remove(self.cache.key(self.textures[texname].data, self.is_bw1))
                 if texname in self._cached:
                     tex, ID = self._cached[texname]
                     tex.loaded = False
+                    self.generation += 1
             else:
                 print(texname, "not found")
 
@@ -80,6 +164,8 @@ class TextureArchive(object):
             lower = texture.name.lower()
             if lower not in self.textures or lower in force_update_lower:
                 texture.data_ready = False
+                self._decoding.pop(lower, None)
+                self.texture_decoded_data.pop(lower, None)
 
                 self.textures[texture.name.lower()] = texture
                 name = bytes(texture.name, encoding="ascii").lower()
@@ -88,12 +174,19 @@ class TextureArchive(object):
                 else:
                     name2 = name.ljust(0x20, b"\x00")
                 self.textures[name2] = texture
+                self.generation += 1
+
+    def detach(self):
+        # Textures can still point into the mapped archive file, also ones that were replaced since
+        for texture in self.textures.values():
+            detach_data(texture)
 
     def reset(self):
         for name, val in self._cached.items():
             del val
 
         self._cached = {}
+        self.generation += 1
 
     def initialize_texture(self, texname, mipmap=False):
         dummy = False
@@ -107,19 +200,15 @@ class TextureArchive(object):
             # Sometimes level terrain uses a dummy texture or the texture is missing
             dummy = True
 
-        # f = self.textures[texname].fileobj
-
         tex = Texture(texname)
         tex.loaded = False
-        tex.processed = False
-        tex.in_progress = False
-        #tex.from_file(f)
+        tex.mipmap = mipmap
         ID = glGenTextures(1)
         self._cached[texname] = (tex, ID)
         self.load_texture(texname, dummy, mipmap)
         return self._cached[texname]
 
-    def load_texture(self, texname, dummy=False, mipmap=False):
+    def load_texture(self, texname, dummy=False, mipmap=False, wait=False):
         if texname not in self._cached:
             return None
 
@@ -130,83 +219,62 @@ class TextureArchive(object):
         if tex.loaded: #tex.is_loaded():
             return self._cached[texname]
 
+        mipmap = mipmap or tex.mipmap
         if dummy:
-            tex.processed = True
             print("Generating dummy texture for", texname)
             tex.generate_dummy(32, 32)
             tex.loaded = True
-        else:
-            print("Loading", texname)
-            if texname in self.cached_textures:
-                print("from cache")
-                tex = Texture.from_png(texname, os.path.join(self.cachefolder, texname+".png"))
-            else:
-                print("from resource")
-                f = BytesIO(self.textures[texname].data)
-                f.seek(0)
-
-                if self.is_bw1:
-                    tex = BW1Texture.from_file(self.textures[texname].name, f, ignoremips=True)
-                else:
-                    tex = BW2Texture.from_file(self.textures[texname].name, f, ignoremips=True)
+            image = tex.texture
+            self.upload(ID, image.width, image.height, image.tobytes(), mipmap)
+            return self._cached[texname]
 
-                tex.dump_to_file(os.path.join(self.cachefolder, texname+".png"))
-                self.cached_textures[texname] = True
+        if texname not in self._waiting:
+            # Show the placeholder until the decoded texture arrives from the pool
+            self._waiting.add(texname)
+            self.start_decoding(texname)
+            tex.mipmaps = [self.placeholder.texture]
+            image = tex.texture
+            self.upload(ID, image.width, image.height, image.tobytes(), False)
 
-            # Hack for mission 5.2: The cave uses a mostly transparent texture that has a rock texture
-            # hidden in the transparent parts. Force the alpha to be fully opaque to render it correctly.
-            if texname == "c1sncave" or texname == "c1snstalactite":
-                texdata = tex.texture
-                texdata.putalpha(255)
-            self._cached[texname] = (tex, ID)
-            tex.loaded = True
+        decoded = self.take_decoded(texname, wait)
+        if decoded is None:
+            return self._cached[texname]
 
-        if len(tex.mipmaps) > 0:#tex.success:
-            #tex.dump_to_file(str(texname.strip(b"\x00"), encoding="ascii")+".png")
-            glBindTexture(GL_TEXTURE_2D, ID)
-            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        size_x, size_y, rgba = decoded
+        tex.mipmaps = [Image.frombytes("RGBA", (size_x, size_y), rgba)]
+        tex.loaded = True
+        self._waiting.discard(texname)
+        self.upload(ID, size_x, size_y, rgba, mipmap)
+        if not self._waiting:
+            self.cache.print_statistics()
 
-            if mipmap:
-                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
-                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-            else:
-                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
-                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 0)
+        return self._cached[texname]
 
-            # glPixelStorei(GL_UNPACK_ROW_LENGTH, tex.size_x)
-            #print("call info", tex.size_x, tex.size_y, tex.size_x * tex.size_y * 4, len(tex.rgba))
-            #print(ID)
-            image = tex.texture
-            size_x, size_y = image.width, image.height
-            rgba = image.tobytes()
-            glTexImage2D(GL_TEXTURE_2D, 0, 4, size_x, size_y, 0, GL_RGBA, GL_UNSIGNED_BYTE, rgba)# b"\x00"*tex.size_x*tex.size_y*4)#tex.rgba)
-            if mipmap:
-                glGenerateMipmap(GL_TEXTURE_2D)
-            #glTexImage2D(GL_TEXTURE_2D, 0, 4, tex.size_x, tex.size_y, 0, GL_RGBA, GL_UNSIGNED_BYTE, b"\x7F"*tex.size_x*tex.size_y*4)
-            #testsize = 32
-            #glTexImage2D(GL_TEXTURE_2D, 0, 4, testsize, testsize, 0, GL_RGBA, GL_UNSIGNED_BYTE,
-            #             b"\x7F" * testsize * testsize * 4)
-            #print("error after call", glGetError())
-            #self._cached[texname] = (tex, ID)
+    def upload(self, ID, size_x, size_y, rgba, mipmap=False):
+        glBindTexture(GL_TEXTURE_2D, ID)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
 
-            return self._cached[texname]
+        if mipmap:
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         else:
-            print("loading tex wasn't successful", texname)
-            return None
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 0)
+
+        glTexImage2D(GL_TEXTURE_2D, 0, 4, size_x, size_y, 0, GL_RGBA, GL_UNSIGNED_BYTE, rgba)
+        if mipmap:
+            glGenerateMipmap(GL_TEXTURE_2D)
 
-    def get_texture(self, texname):
+    def get_texture(self, texname, wait=False):
         if texname in self._cached:
-            #tex, id = self._cached[texname]
-            #if tex.success:
-            #    tex.dump_to_file(str(texname.strip(b"\x00"), encoding="ascii")+".png")
             tex, id = self._cached[texname]
             if tex.loaded:
                 return self._cached[texname]
             else:
-                return self.load_texture(texname)
+                return self.load_texture(texname, wait=wait)
         else:
             self.initialize_texture(texname)
-            return self.load_texture(texname)
+            return self.load_texture(texname, wait=wait)
 
 
 class OpenGLTexture(object):
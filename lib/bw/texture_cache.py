@@ -0,0 +1,143 @@
+import os
+import zlib
+import hashlib
+from struct import Struct
+
+
+# Bump this whenever decoding changes the output so old cache entries stop matching
+DECODER_VERSION = 2
+CACHE_EXTENSION = ".rgba"
+DEFAULT_SIZE_BUDGET = 512*1024*1024
+
+HEADER = Struct(">4sIIB")
+MAGIC = b"RGBA"
+FLAG_ZLIB = 1
+
+
+def read_cache_entry(path):
+    # Returns (width, height, rgba) or None if there is no usable entry.
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            magic, width, height, flags = HEADER.unpack(f.read(HEADER.size))
+            data = f.read()
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+    except Exception as err:
+        print("Couldn't read texture cache entry", path, err)
+        return None
+
+    if magic != MAGIC or len(data) != width*height*4:
+        return None
+
+    # Reading an entry counts as using it for the LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return width, height, data
+
+
+def write_cache_entry(path, width, height, rgba, compress=True):
+    flags = 0
+    if compress:
+        rgba = zlib.compress(rgba, 1)
+        flags |= FLAG_ZLIB
+
+    # Write to a temporary file first so other processes never see half written entries
+    tmppath = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmppath, "wb") as f:
+        f.write(HEADER.pack(MAGIC, width, height, flags))
+        f.write(rgba)
+    os.replace(tmppath, path)
+
+
+class TextureCache(object):
+    name = "Texture cache"
+    version = DECODER_VERSION
+    extension = CACHE_EXTENSION
+
+    def __init__(self, folder, size_budget=DEFAULT_SIZE_BUDGET, compress=True):
+        self.folder = folder
+        self.size_budget = size_budget
+        self.compress = compress
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+
+    @classmethod
+    def key(cls, data, is_bw1):
+        sha = hashlib.sha1()
+        sha.update("{0} {1}".format(cls.version, "bw1" if is_bw1 else "bw2").encode("ascii"))
+        sha.update(data)
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key+self.extension)
+
+    def remove(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def entries(self):
+        # Everything in the folder takes part in the eviction, including png files from older versions
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        if total <= self.size_budget:
+            return 0
+
+        evicted = 0
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.size_budget:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        self.evicted += evicted
+        return evicted
+
+    def statistics(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/lookups if lookups > 0 else 0.0,
+            "evicted": self.evicted,
+            "size": self.size(),
+            "size_budget": self.size_budget
+        }
+
+    def print_statistics(self):
+        stats = self.statistics()
+        print(self.name+": {0} hits, {1} misses ({2:.0%} hit rate), {3} evicted, {4:.1f} of {5:.1f} MiB used".format(
+            stats["hits"], stats["misses"], stats["hit_rate"], stats["evicted"],
+            stats["size"]/(1024*1024), stats["size_budget"]/(1024*1024)))
@@ -3,10 +3,31 @@ from dataclasses import dataclass
 from struct import pack, unpack, unpack_from, Struct
 from lib.vectors import Triangle, Vector3, Quad, Line, PlanarQuad
 from OpenGL import *
+import numpy
 from numpy import array, ndarray, zeros
 from math import inf
 
 
+# Layout of the terrain sections for parsing them in bulk with numpy
+TILE_DTYPE = numpy.dtype([
+    ("heights", ">u2", (16,)),
+    ("vertex_colors", "u1", (16, 4)),
+    ("surface_coordinates", ">u2", (4, 2)),
+    ("detail_coordinates", ">u2", (16, 2)),
+    ("material_index", ">u4")
+])
+assert TILE_DTYPE.itemsize == 180
+
+MAP_DTYPE = numpy.dtype([
+    ("a", "u1"),
+    ("b", "u1"),
+    ("chunkindex", ">u2")
+])
+
+# Quads of a tile as indices into its 4x4 vertices
+TILE_QUADS = [(4*y + x, 4*y + x+1, 4*(y+1) + x+1, 4*(y+1) + x) for y in range(3) for x in range(3)]
+
+
 def read_uint32(f):
     return unpack("I", f.read(4))[0]
 
@@ -51,6 +72,10 @@ class Color:
     def from_array(cls, section, i):
         return cls(*(x/255.0 for x in unpack_from("BBBB", section, i*cls.size)))
 
+    @classmethod
+    def from_record(cls, record):
+        return cls(*(x/255.0 for x in record.tolist()))
+
 
 @dataclass
 class UVPoint:
@@ -63,6 +88,11 @@ class UVPoint:
         x, y = unpack_from(">HH", section, i*cls.size)
         return cls(x/4096.0, y/4096.0)
 
+    @classmethod
+    def from_record(cls, record):
+        x, y = record.tolist()
+        return cls(x/4096.0, y/4096.0)
+
 
 @dataclass
 class Vertex:
@@ -84,7 +114,18 @@ class AABB(object):
         self.min = min
         self.max = max
         self.middle = (self.min + self.max)*0.5
-        self.quads = []
+        self._quads = None
+
+    @property
+    def quads(self):
+        # Only needed for ray tests so they are created on first use
+        if self._quads is None:
+            self._quads = self._make_quads()
+        return self._quads
+
+    def _make_quads(self):
+        min, max = self.min, self.max
+        quads = []
 
         corner11 = Vector3(min.x, max.y, min.z)
         corner12 = Vector3(max.x, max.y, min.z)
@@ -97,16 +138,18 @@ class AABB(object):
         corner24 = Vector3(max.x, min.y, max.z)
 
         # Top
-        self.quads.append(PlanarQuad(corner11, corner12, corner13, corner14))
+        quads.append(PlanarQuad(corner11, corner12, corner13, corner14))
 
         # Sides
-        self.quads.append(PlanarQuad(corner13, corner14, corner23, corner24))
-        self.quads.append(PlanarQuad(corner11, corner13, corner21, corner23))
-        self.quads.append(PlanarQuad(corner12, corner11, corner22, corner21))
-        self.quads.append(PlanarQuad(corner14, corner12, corner24, corner22))
+        quads.append(PlanarQuad(corner13, corner14, corner23, corner24))
+        quads.append(PlanarQuad(corner11, corner13, corner21, corner23))
+        quads.append(PlanarQuad(corner12, corner11, corner22, corner21))
+        quads.append(PlanarQuad(corner14, corner12, corner24, corner22))
 
         # Bottom
-        self.quads.append(PlanarQuad(corner21, corner22, corner23, corner24))
+        quads.append(PlanarQuad(corner21, corner22, corner23, corner24))
+
+        return quads
 
     def ray_hits_box(self, line: Line, d_filter=inf):
         for quad in self.quads:
@@ -143,69 +186,53 @@ class AABB(object):
 
 
 class TileModel(object):
-    def __init__(self, tile, materials, offsetx, offsety):
-        self.vertices = []
-        self.quads = []
-        self.material = materials[tile.material_index]
-        self.quads_collision = []
-
-        br = tile.surface_coordinates[0]
-        bl = tile.surface_coordinates[1]
-        tr = tile.surface_coordinates[2]
-        tl = tile.surface_coordinates[3]
-
-        aabb_max = Vector3(-inf, -inf, -inf)
-        aabb_min = Vector3(inf, inf, inf)
-
-        for y in range(4):
-            y_comp = (y+offsety)*4*(4/3)-2048
-            fy = y / 3.0
-
-            for x in range(4):
-                fx = x/3.0
-
-                u = fy*(fx*tl.x + (1-fx)*tr.x) + (1-fy)*(fx*bl.x + (1-fx)*br.x)
-                v = fy*(fx*tl.y + (1-fx)*tr.y) + (1-fy)*(fx*bl.y + (1-fx)*br.y)
-
-                index = 4*y + x
-                height = tile.heights[index]
-                position = array([(x+offsetx)*4*(4/3)-2048, height, y_comp])
-                uv1 = UVPoint(u, v)
-                uv2 = tile.detail_coordinates[index]
-                color = tile.vertex_colors[index]
-
-                self.vertices.append(Vertex(position, color, uv1, uv2))
-
-                if x != 3 and y != 3:
-                    indexr = 4*y + x+1
-                    indexb = 4*(y+1) + x
-                    indexbr = 4*(y+1) + x+1
-
-                    self.quads.append((index, indexr, indexbr, indexb))
-
-        v1 = Vector3(*self.vertices[0].pos)
-        v2 = Vector3(*self.vertices[3].pos)
-        v3 = Vector3(*self.vertices[3*4+0].pos)
-        v4 = Vector3(*self.vertices[3*4+3].pos)
-        self.lod_quad = Quad(v1, v2, v3, v4)
-
-        for v1i, v2i, v4i, v3i in self.quads:
-            v1 = Vector3(*self.vertices[v1i].pos)
-            v2 = Vector3(*self.vertices[v2i].pos)
-            v3 = Vector3(*self.vertices[v3i].pos)
-            v4 = Vector3(*self.vertices[v4i].pos)
-            quad = Quad(v1, v2, v3, v4)
-            self.quads_collision.append(quad)
-
-            aabb_min.x = min(aabb_min.x, v1.x, v2.x, v3.x, v4.x)
-            aabb_min.y = min(aabb_min.y, v1.y, v2.y, v3.y, v4.y)
-            aabb_min.z = min(aabb_min.z, v1.z, v2.z, v3.z, v4.z)
-            aabb_max.x = max(aabb_max.x, v1.x, v2.x, v3.x, v4.x)
-            aabb_max.y = max(aabb_max.y, v1.y, v2.y, v3.y, v4.y)
-            aabb_max.z = max(aabb_max.z, v1.z, v2.z, v3.z, v4.z)
-
+    def __init__(self, positions, colors, uv1, uv2, material, aabb_min: Vector3, aabb_max: Vector3):
+        # positions, colors, uv1 and uv2 are the rows of the 16 vertices of this tile
+        # in the terrain's vertex arrays
+        self.positions = positions
+        self.colors = colors
+        self.uv1 = uv1
+        self.uv2 = uv2
+        self.quads = TILE_QUADS
+        self.material = material
         self.aabb = AABB(aabb_min, aabb_max)
 
+        self._vertices = None
+        self._lod_quad = None
+        self._quads_collision = None
+
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices = [Vertex(pos, Color(*color), UVPoint(*uv1), UVPoint(*uv2))
+                              for pos, color, uv1, uv2 in zip(self.positions,
+                                                              self.colors.tolist(),
+                                                              self.uv1.tolist(),
+                                                              self.uv2.tolist())]
+        return self._vertices
+
+    @property
+    def lod_quad(self):
+        if self._lod_quad is None:
+            v1 = Vector3(*self.positions[0])
+            v2 = Vector3(*self.positions[3])
+            v3 = Vector3(*self.positions[3*4+0])
+            v4 = Vector3(*self.positions[3*4+3])
+            self._lod_quad = Quad(v1, v2, v3, v4)
+        return self._lod_quad
+
+    @property
+    def quads_collision(self):
+        if self._quads_collision is None:
+            self._quads_collision = []
+            for v1i, v2i, v4i, v3i in self.quads:
+                v1 = Vector3(*self.positions[v1i])
+                v2 = Vector3(*self.positions[v2i])
+                v3 = Vector3(*self.positions[v3i])
+                v4 = Vector3(*self.positions[v4i])
+                self._quads_collision.append(Quad(v1, v2, v3, v4))
+        return self._quads_collision
+
     def ray_collide(self, line: Line, d_filter=inf):
         hit = self.aabb.ray_hits_box(line, d_filter)
 
@@ -266,6 +293,14 @@ class Tile:
 
         return cls(heights, vertex_colors, surface_coordinates, detail_coordinates, material_index)
 
+    @classmethod
+    def from_record(cls, record):
+        return cls([x/16.0 for x in record["heights"].tolist()],
+                   [Color.from_record(x) for x in record["vertex_colors"]],
+                   [UVPoint.from_record(x) for x in record["surface_coordinates"]],
+                   [UVPoint.from_record(x) for x in record["detail_coordinates"]],
+                   int(record["material_index"]))
+
 
 @dataclass
 class Chunk(object):
@@ -278,6 +313,10 @@ class Chunk(object):
         tiles = initiate_from_section(Tile, chunkdata)
         return cls(tiles)
 
+    @classmethod
+    def from_records(cls, records):
+        return cls([Tile.from_record(record) for record in records])
+
 
 @dataclass
 class TerrainData:
@@ -414,63 +453,104 @@ class BWTerrainV2(BWSectionedFile):
         timer.time("Start")
         #width, height, unk1, unk2 = unpack("IIII", self.sections[b"RRET"])
         self.terrain_data = TerrainData.from_section(self.sections[b"RRET"])
-        self.chunks = initiate_from_section(Chunk, self.sections[b"KNHC"])
-        self.map = initiate_from_section(MapChunkReference, self.sections[b"PAMC"])
-        self.materials = initiate_from_section(MapMaterial, self.sections[b"LTAM"])
-        timer.time("Data parsed")
         assert self.terrain_data.chunks_x == self.terrain_data.chunks_y == 64
 
-        points_x = self.terrain_data.chunks_y * 16 + 1
-        points_y = self.terrain_data.chunks_y * 16 + 1
-
-        self.pointdata = zeros(shape=[points_x, points_y]) #[[None for y in range(self.terrain_data.chunks_y * 16 + 1)] for x in range(self.terrain_data.chunks_y * 16 + 1)]
-        self.pointdata[True] = -1
-        self.grids = []
-        chunk_group = []
-
-        self.meshes: dict[TileModel] = {}
-
-        timer.time("Data initialized")
-
-        for chunkx in range(64):
-            chunk_xx = chunkx*16
-
-            for chunky in range(64):
-                chunk_yy = chunky*16
-
-                mapchunk = self.map[chunky*64 + chunkx]
-                if mapchunk.b == 1:
-                    chunk = self.chunks[mapchunk.chunkindex]
+        assert len(self.sections[b"KNHC"]) % Chunk.size == 0
+        # Raw tile data per chunk and the chunk placed at each map position, indexed as [chunky, chunkx]
+        self.tile_records = numpy.frombuffer(self.sections[b"KNHC"], dtype=TILE_DTYPE).reshape(-1, 16)
+        self.chunk_map = numpy.frombuffer(self.sections[b"PAMC"], dtype=MAP_DTYPE).reshape(64, 64)
+        self.materials = initiate_from_section(MapMaterial, self.sections[b"LTAM"])
+        self._chunks = None
+        self._map = None
+        timer.time("Data parsed")
 
-                    #chunk_tiles = []
+        self._create_vertex_data()
+        timer.time("Vertex data created")
 
-                    for tilex in range(4):
-                        tile_xx = chunk_xx + tilex*4
+        self.meshes: dict[int, list[TileModel]] = {}
+        self._tilemodels = []
+        self._chunk_group = None
 
-                        for tiley in range(4):
-                            tile_yy = chunk_yy + tiley*4
-                            tile = chunk.tiles[tiley*4+tilex]
+        aabb_min = self.tile_positions.min(axis=1).tolist()
+        aabb_max = self.tile_positions.max(axis=1).tolist()
 
-                            if tile.material_index not in self.meshes:
-                                self.meshes[tile.material_index] = []
+        for i, material_index in enumerate(self.tile_materials.tolist()):
+            if material_index not in self.meshes:
+                self.meshes[material_index] = []
 
-                            for x in range(4):
-                                for y in range(4):
-                                    index = y*4 + x
-                                    #self.pointdata[chunkx*16 + tilex*4 + x][chunky*16+tiley*4+y] = tile.heights[index]/16.0
-                                    self.pointdata[tile_xx+x, tile_yy+y] = tile.heights[index]# / 16.0
+            tilemodel = TileModel(self.tile_positions[i],
+                                  self.tile_colors[i],
+                                  self.tile_uv1[i],
+                                  self.tile_uv2[i],
+                                  self.materials[material_index],
+                                  Vector3(*aabb_min[i]),
+                                  Vector3(*aabb_max[i]))
+            self.meshes[material_index].append(tilemodel)
+            self._tilemodels.append(tilemodel)
 
-                            tilemodel = TileModel(tile,
-                                                  self.materials,
-                                                  tile_xx - tilex - chunkx*4,
-                                                  tile_yy - tiley - chunky*4)
-                            self.meshes[tile.material_index].append(tilemodel)
-                            #chunk_tiles.append(tilemodel)
-                            chunk_group.append(tilemodel)
         timer.time("Chunks created")
-        self.chunk_group = AABBGroup(chunk_group)
-        self.chunk_group.subdivide(5)
-        timer.time("AABBs generated")
+
+    @property
+    def chunk_group(self) -> AABBGroup:
+        # Quadtree over the tiles, ray picking uses the height grid instead so this is only built when needed
+        if self._chunk_group is None:
+            self._chunk_group = AABBGroup(self._tilemodels)
+            self._chunk_group.subdivide(5)
+        return self._chunk_group
+
+    def _create_vertex_data(self):
+        # Tiles of all placed chunks, ordered by chunk x, chunk y, tile x, tile y
+        placed = (self.chunk_map["b"] == 1).T
+        chunkx, chunky = numpy.nonzero(placed)
+        chunk_indices = self.chunk_map["chunkindex"].T[placed]
+
+        chunk_tiles = self.tile_records[chunk_indices].reshape(-1, 4, 4)  # [chunk, tiley, tilex]
+        tiles = chunk_tiles.transpose(0, 2, 1).reshape(-1)
+        tilex, tiley = numpy.meshgrid(numpy.arange(4), numpy.arange(4), indexing="ij")
+        tilex = numpy.tile(tilex.reshape(-1), len(chunk_indices))
+        tiley = numpy.tile(tiley.reshape(-1), len(chunk_indices))
+        chunkx = numpy.repeat(chunkx, 16)
+        chunky = numpy.repeat(chunky, 16)
+
+        heights = tiles["heights"]/16.0
+
+        # Height grid, indexed as [x, y] with 4 points per tile in each direction
+        grid = numpy.full((64, 64, 4, 4, 4, 4), -1.0)  # [chunkx, chunky, tilex, tiley, y, x]
+        grid[chunkx, chunky, tilex, tiley] = heights.reshape(-1, 4, 4)
+        self.pointdata = zeros(shape=[64*16 + 1, 64*16 + 1])
+        self.pointdata[True] = -1
+        self.pointdata[:64*16, :64*16] = grid.transpose(0, 2, 5, 1, 3, 4).reshape(64*16, 64*16)
+
+        # Vertex positions, neighbouring tiles share their border vertices
+        vtx_x, vtx_y = numpy.arange(16) % 4, numpy.arange(16) // 4
+        offsetx = (chunkx*12 + tilex*3)[:, None]
+        offsety = (chunky*12 + tiley*3)[:, None]
+        self.tile_positions = numpy.empty((len(tiles), 16, 3))
+        self.tile_positions[:, :, 0] = (vtx_x + offsetx)*4*(4/3)-2048
+        self.tile_positions[:, :, 1] = heights
+        self.tile_positions[:, :, 2] = (vtx_y + offsety)*4*(4/3)-2048
+
+        # Surface UVs are interpolated from the tile's corners
+        surface = tiles["surface_coordinates"]/4096.0
+        br, bl, tr, tl = (surface[:, None, i] for i in range(4))
+        fx = (vtx_x/3.0)[None, :, None]
+        fy = (vtx_y/3.0)[None, :, None]
+        self.tile_uv1 = fy*(fx*tl + (1-fx)*tr) + (1-fy)*(fx*bl + (1-fx)*br)
+        self.tile_uv2 = tiles["detail_coordinates"]/4096.0
+        self.tile_colors = tiles["vertex_colors"]/255.0
+        self.tile_materials = tiles["material_index"].astype(numpy.uint32)
+
+    @property
+    def chunks(self) -> list[Chunk]:
+        if self._chunks is None:
+            self._chunks = [Chunk.from_records(records) for records in self.tile_records]
+        return self._chunks
+
+    @property
+    def map(self) -> list[MapChunkReference]:
+        if self._map is None:
+            self._map = [MapChunkReference(*entry) for entry in self.chunk_map.reshape(-1).tolist()]
+        return self._map
 
     def check_height(self, x, y):
         mapx = int((x + 2048)*0.1875)
@@ -496,6 +576,47 @@ class BWTerrainV2(BWSectionedFile):
         else:
             return None
 
+    def check_heights(self, x, y):
+        """Batched version of check_height for arrays of coordinates.
+        Points outside of the terrain are NaN."""
+        mapx = numpy.trunc((numpy.asarray(x, dtype=float) + 2048)*0.1875)
+        mapy = numpy.trunc((numpy.asarray(y, dtype=float) + 2048)*0.1875)
+        return self._check_heights(mapx, mapy)
+
+    def _check_heights(self, mapx, mapy):
+        valid = (0 <= mapx) & (mapx < 768) & (0 <= mapy) & (mapy < 768)
+        mapx = numpy.where(valid, mapx, 0).astype(int)
+        mapy = numpy.where(valid, mapy, 0).astype(int)
+        mapx = mapx + mapx // 3
+        mapy = mapy + mapy // 3
+
+        heights = self.pointdata[mapx, mapy]
+        heights[~valid | (heights == -1)] = numpy.nan
+        return heights
+
+    def check_heights_interpolate(self, x, y):
+        """Batched version of check_height_interpolate for arrays of coordinates.
+        Points outside of the terrain are NaN."""
+        base_x = (numpy.asarray(x, dtype=float) + 2048)*0.1875
+        prev_x = numpy.trunc(base_x)
+        x_fac = (base_x - prev_x) % 1
+
+        base_y = (numpy.asarray(y, dtype=float) + 2048)*0.1875
+        prev_y = numpy.trunc(base_y)
+        y_fac = (base_y - prev_y) % 1
+
+        p1_1 = self._check_heights(prev_x, prev_y)
+        p2_1 = self._check_heights(prev_x+1, prev_y)
+        p1_2 = self._check_heights(prev_x, prev_y+1)
+        p2_2 = self._check_heights(prev_x+1, prev_y+1)
+
+        p1_avg = p1_1*(1-x_fac) + p2_1*x_fac
+        p2_avg = p1_2 * (1 - y_fac) + p2_2 * y_fac
+        fin = p1_avg*(1-y_fac) + p2_avg*y_fac
+
+        missing = numpy.isnan(p1_1) | numpy.isnan(p2_1) | numpy.isnan(p1_2) | numpy.isnan(p2_2)
+        return numpy.where(missing, p1_1, fin)
+
     def check_height_interpolate(self, x, y):
         base_x = (x + 2048)*0.1875
         prev_x = int(base_x)
@@ -521,24 +642,104 @@ class BWTerrainV2(BWSectionedFile):
             fin = p1_avg*(1-y_fac) + p2_avg*y_fac
             return fin
 
-    def ray_collide(self, line: Line):
-        timer = Timer()
-        timer.time("Ray collide start")
-        point, dist = None, inf
-        result = self.chunk_group.ray_collide(line)
-        if result is not False:
-            p, d = result
-            dist = d
-            point = p
-
+    def _ray_cells(self, origin, direction):
+        # Walks the grid cells (4x4 per chunk tile, 768x768 in total) that the ray passes over
+        # in the XZ plane, in grid coordinates.
+        grid_origin = (origin[[0, 2]] + 2048)*0.1875
+        grid_dir = direction[[0, 2]]*0.1875
+
+        t_start, t_end = 0.0, inf
+        for o, d in zip(grid_origin, grid_dir):
+            if d == 0:
+                if not 0 <= o < 768:
+                    return None
+            else:
+                t1, t2 = (0 - o)/d, (768 - o)/d
+                t_start = max(t_start, min(t1, t2))
+                t_end = min(t_end, max(t1, t2))
 
-        timer.time(f"Ray collide end with result {str(point)}")
+        if t_start > t_end:
+            return None
 
-        if point is not None:
-            return point, dist
+        if t_end == inf:  # Straight up or down
+            cells = numpy.floor(grid_origin).reshape(1, 2)
         else:
+            crossings = [numpy.array([t_start, t_end])]
+            for o, d in zip(grid_origin, grid_dir):
+                if d != 0:
+                    g1, g2 = sorted((o + d*t_start, o + d*t_end))
+                    lines = numpy.arange(numpy.ceil(g1), numpy.floor(g2)+1)
+                    crossings.append((lines - o)/d)
+            t = numpy.unique(numpy.concatenate(crossings))
+            t_middle = (t[:-1] + t[1:])*0.5 if len(t) > 1 else t
+            cells = numpy.floor(grid_origin + grid_dir*t_middle[:, None])
+
+        cells = numpy.clip(cells, 0, 767).astype(int)
+        return cells[:, 0], cells[:, 1]
+
+    def ray_collide(self, line: Line):
+        origin = numpy.array([line.origin.x, line.origin.y, line.origin.z], dtype=float)
+        direction = numpy.array([line.direction.x, line.direction.y, line.direction.z], dtype=float)
+
+        cells = self._ray_cells(origin, direction)
+        if cells is None:
+            return False
+        cellx, celly = cells
+
+        # Corner heights of each cell come from the tile the cell belongs to
+        px = (cellx // 3)*4 + cellx % 3
+        py = (celly // 3)*4 + celly % 3
+        h00 = self.pointdata[px, py]
+        h10 = self.pointdata[px+1, py]
+        h01 = self.pointdata[px, py+1]
+        h11 = self.pointdata[px+1, py+1]
+
+        exists = (h00 != -1) & (h10 != -1) & (h01 != -1) & (h11 != -1)
+        if not numpy.any(exists):
+            return False
+        cellx, celly = cellx[exists], celly[exists]
+        h00, h10, h01, h11 = h00[exists], h10[exists], h01[exists], h11[exists]
+
+        x0 = cellx*4*(4/3)-2048
+        x1 = (cellx+1)*4*(4/3)-2048
+        y0 = celly*4*(4/3)-2048
+        y1 = (celly+1)*4*(4/3)-2048
+        p1 = numpy.stack((x0, h00, y0), axis=-1)
+        p2 = numpy.stack((x1, h10, y0), axis=-1)
+        p3 = numpy.stack((x0, h01, y1), axis=-1)
+        p4 = numpy.stack((x1, h11, y1), axis=-1)
+
+        # Same split of each quad into two triangles as TileModel's collision quads
+        d1 = ray_triangles_intersect(origin, direction, p1, p2, p3)
+        d2 = ray_triangles_intersect(origin, direction, p2, p4, p3)
+        dist = numpy.where(numpy.isnan(d1), d2, d1)
+
+        if numpy.all(numpy.isnan(dist)):
             return False
 
+        d = float(numpy.nanmin(dist))
+        point = origin + direction*d
+        return Vector3(*point.tolist()), d
+
+
+def ray_triangles_intersect(origin, direction, p1, p2, p3):
+    # Vectorized version of Line.collide for many triangles, returns the distance along
+    # the ray for each triangle or NaN if it isn't hit.
+    p1_to_p2 = p2 - p1
+    normal = numpy.cross(p1_to_p2, p3 - p1)
+
+    denom = normal @ direction
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        d = numpy.einsum("ij,ij->i", p1 - origin, normal) / denom
+    point = origin + direction*d[:, None]
+
+    hit = (denom != 0) & (d >= 0)
+    hit &= numpy.einsum("ij,ij->i", normal, numpy.cross(p1_to_p2, point - p1)) > 0
+    hit &= numpy.einsum("ij,ij->i", normal, numpy.cross(p3 - p2, point - p2)) > 0
+    hit &= numpy.einsum("ij,ij->i", normal, numpy.cross(p1 - p3, point - p3)) > 0
+
+    return numpy.where(hit, d, numpy.nan)
+
 
 class BWTerrain(BWSectionedFile):
     def __init__(self, f):
@@ -1,12 +1,14 @@
 import json
 import numpy
-from math import sin, cos, pi, tan
+from math import sin, cos, pi, tan, sqrt
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from lib.vectors import Vector3
-from lib.render.model_renderingv2 import LineDrawing
+from lib.render.model_renderingv2 import LineDrawing, render_state
+from lib.render.culling import Frustum, CulledInstances
 from typing import TYPE_CHECKING
 from lib.bw_types import BWMatrix
+from lib.BattalionXMLLib import calculate_heights, BattalionObject
 from plugins.plugin_scenery_render import SceneryHandler, SceneryComponent
 
 if TYPE_CHECKING:
@@ -41,52 +43,86 @@ ZONECOLORS = {
     "ZONETYPE_FORD": (0/255.0, 76/255.0, 255/255.0, 1.0)
 }
 
+# Bounding sphere radius for culling that fits the object cubes and the icons above them
+OBJECT_RADIUS = 25.0
+
+
+def scaled_matrix(mtx, x, y, z):
+    mtx = mtx.copy()
+    mtx[0:4] *= x
+    mtx[4:8] *= y
+    mtx[8:12] *= z
+    return mtx
+
+
+def matrix_scale(mtx):
+    return sqrt(max(mtx[0]**2 + mtx[1]**2 + mtx[2]**2,
+                    mtx[4]**2 + mtx[5]**2 + mtx[6]**2,
+                    mtx[8]**2 + mtx[9]**2 + mtx[10]**2))
+
+
+class SelectionBuffer(object):
+    # Offscreen target that stores a 32 bit object id per pixel, 0 where no object was drawn
+    def __init__(self):
+        self.fbo = None
+        self.idbuffer = None
+        self.depthbuffer = None
+        self.width = 0
+        self.height = 0
+
+    def bind(self, width, height):
+        if self.fbo is None:
+            self.fbo = glGenFramebuffers(1)
+            self.idbuffer, self.depthbuffer = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+
+        if self.width != width or self.height != height:
+            glBindRenderbuffer(GL_RENDERBUFFER, self.idbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_R32UI, width, height)
+            glBindRenderbuffer(GL_RENDERBUFFER, self.depthbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+            glBindRenderbuffer(GL_RENDERBUFFER, 0)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.idbuffer)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depthbuffer)
+            self.width, self.height = width, height
+
+        glClearBufferuiv(GL_COLOR, 0, numpy.zeros(4, dtype=numpy.uint32))
+        glClear(GL_DEPTH_BUFFER_BIT)
+
+    def read(self, x, y, width, height):
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        data = glReadPixels(x, y, width, height, GL_RED_INTEGER, GL_UNSIGNED_INT)
+        if isinstance(data, bytes):
+            return numpy.frombuffer(data, dtype=numpy.uint32)
+        return numpy.asarray(data, dtype=numpy.uint32).reshape(-1)
+
 
 class Scene(object):
     def __init__(self):
-        self.objects = {}
         self.model = {}
 
         self.modelinstances = {}
         self.renderedmodels = []
-        self.wireframeboxes = []
-        self.wireframecylinders = []
+        self.waypoints = []
 
         self.lines = LineDrawing()
         self.not_startpoint = {}
 
-        self.is_empty = {}
-
-    def add_matrix(self, modelname, mtx):
+    def add_model(self, modelname, model):
         if modelname not in self.modelinstances:
             self.renderedmodels.append(modelname)
-            self.modelinstances[modelname] = [mtx]
-        else:
-            self.modelinstances[modelname].append(mtx)
+            self.modelinstances[modelname] = model
+            model.instances.begin()
 
     def fullreset(self):
         self.renderedmodels = []
-        self.wireframeboxes = []
-        self.wireframecylinders = []
-        self.lines.reset_lines()
-        for type in self.is_empty:
-            self.is_empty[type] = True
-
-    def reset(self):
-        for key in list(self.objects.keys()):
-            del self.objects[key]
-            self.objects[key] = ([], [])
-        del self.modelinstances
         self.modelinstances = {}
+        self.waypoints = []
+        self.lines.reset_lines()
         self.not_startpoint = {}
 
     def set_model(self, type, model):
-        self.objects[type] = None
         self.model[type] = model
-        self.is_empty[type] = True
-
-    def set_not_empty(self, type):
-        self.is_empty[type] = False
 
 
 class Graphics(object):
@@ -100,33 +136,31 @@ class Graphics(object):
         self.models_scene = []
 
         self._dirty = True
+        # Objects whose instances need to be updated on the next frame, see set_dirty_limited
+        self._dirty_objects = set()
+        # Selection at the last update, objects that are no longer selected need to be updated too
+        self._rendered_selection = set()
 
         self.render_everything_once = True
 
         self.scenery = SceneryHandler()
         self.scenery_simple = False
 
-    def set_dirty(self):
-        self.rw.models.cubev2.mtxdirty = True
-        self.rw.models.camera.mtxdirty = True
-        self.rw.models.billboard.mtxdirty = True
-        for model in self.rw.bwmodelhandler.instancemodels.values():
-            model.mtxdirty = True
+        # Objects outside of the view are left out of the instance batches. Its grid is
+        # also used for selecting objects in the topdown view.
+        self.culling = CulledInstances()
+        self.selectionbuffer = SelectionBuffer()
 
+    def set_dirty(self):
         self._dirty = True
 
-    def set_dirty_limited(self, modelnames):
-        self.rw.models.cubev2.mtxdirty = True
-        self.rw.models.camera.mtxdirty = True
-        self.rw.models.billboard.mtxdirty = True
-        for modelname in modelnames:
-            model = self.rw.bwmodelhandler.instancemodels[modelname]
-            model.mtxdirty = True
-
-        self._dirty = True
+    def set_dirty_limited(self, objects):
+        # Only the instances of these objects are updated on the next frame
+        self._dirty_objects.update(objects)
 
     def reset_dirty(self):
         self._dirty = False
+        self._dirty_objects = set()
 
     def is_dirty(self):
         return self._dirty
@@ -217,34 +251,51 @@ class Graphics(object):
         rw.camera_direction = Vector3(look_direction.x * fac, look_direction.y * fac, look_direction.z)
 
     def render_select(self, objlist):
+        # Draws the object cubes with index+1 of the object in objlist as the id into the
+        # selection buffer. Use read_select afterwards.
         rw = self.rw
         vismenu = self.rw.visibility_menu
 
-        extradataarrays = {}
-        for key in self.scene.objects:
-            extradataarrays[key] = []
-
-        if len(objlist) > 0xFFFF:
-            raise RuntimeError("More than 64k objects, cannot select.")
+        objectidarrays = {}
+        for key, model in self.scene.model.items():
+            objectidarrays[key] = numpy.zeros(model.instances.count, dtype=numpy.uint32)
 
         for i, obj in enumerate(objlist):
             if vismenu.object_visible(obj.type, obj):
-                colorid = (0x10000100 + (i << 12))
-                if obj.type not in extradataarrays:
-                    extradataarrays["generic"].append(colorid)
-                else:
-                    extradataarrays[obj.type].append(colorid)
+                key = obj.type if obj.type in objectidarrays else "generic"
+                slot = self.scene.model[key].instances.slots.get(obj)
+                if slot is not None:
+                    objectidarrays[key][slot] = i + 1
+
+        x, y, width, height = glGetIntegerv(GL_VIEWPORT)
+        self.selectionbuffer.bind(width, height)
+        glDisable(GL_ALPHA_TEST)
+        glDisable(GL_BLEND)
+
         for key, model in self.scene.model.items():
             if key == "generic" or vismenu.object_visible(key, None):
-                extradataarray = extradataarrays[key]
-                if len(extradataarray) > 0:
-                    extradata = numpy.array(extradataarray, dtype=numpy.uint32)
-                    model.bind_colorid(extradata)
+                objectidarray = objectidarrays[key]
+                if len(objectidarray) > 0:
+                    model.bind_colorid(objectidarray)
                     model.instancedrender()
                     model.unbind()
 
         print("We queued up", len(objlist))
 
+    def read_select(self, x, y, width, height, framebuffer):
+        # Returns the ids in the area and switches back to the given framebuffer
+        ids = self.selectionbuffer.read(x, y, width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+        return ids
+
+    def select_rectangle(self, minx, minz, maxx, maxz):
+        return [key for key in self.culling.grid.query_rectangle(minx, minz, maxx, maxz)
+                if isinstance(key, BattalionObject)]
+
+    def select_circle(self, x, z, radius):
+        return [key for key in self.culling.grid.query_circle(x, z, radius)
+                if isinstance(key, BattalionObject)]
+
     def is_active(self, obj: "BattalionObject"):
         if obj in self.rw.selected:
             return True
@@ -257,20 +308,190 @@ class Graphics(object):
         else:
             return False
 
+    def add_scenery_components(self):
+        components = [component for component in self.scenery.components if component.modeltype is not None]
+        if not components:
+            return
+
+        matrices = [component.mtx.mtx.copy() for component in components]
+        heights = self.rw.bwterrain.check_heights([mtx[12] for mtx in matrices],
+                                                  [mtx[14] for mtx in matrices])
+
+        # Components are regenerated on every update, so they are keyed by their
+        # position in the list to keep the instance slots stable.
+        for i, (component, currmtx, height) in enumerate(zip(components, matrices, heights.tolist())):
+            if height == height:  # Not NaN
+                currmtx[13] = height
+            radius = self.add_model_instance(component.modeltype, ("scenery", i), currmtx)
+            if radius is not None:
+                self.culling.set_bounds(("scenery", i), (currmtx[12], currmtx[13], currmtx[14]), radius)
+
+    def add_model_instance(self, modelname, key, mtx):
+        # Returns the radius of the model's bounding sphere around the matrix position
+        bwmodelhandler = self.rw.bwmodelhandler
+        if bwmodelhandler and modelname in bwmodelhandler.instancemodels:
+            model = bwmodelhandler.instancemodels[modelname]
+            self.scene.add_model(modelname, model)
+            self.culling.add(key, model.instances, mtx)
+
+            texmodel = bwmodelhandler.models[modelname]
+            bx, by, bz = texmodel.boundsphere
+            return (sqrt(bx*bx + by*by + bz*bz) + texmodel.boundsphereradius)*matrix_scale(mtx)
+        return None
+
+    def add_object(self, obj, height, selected, scenery_simple, selected_scenery):
+        # Adds the instances of the object to the culling batches
+        rw = self.rw
+        culling = self.culling
+        visible3d = rw.visibility_menu.object_3d_visible
+
+        if obj.type in self.scene.model:
+            instances = self.scene.model[obj.type].instances
+        else:
+            instances = self.scene.model["generic"].instances
+
+        if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
+            currmtx = obj.mtxoverride.copy()
+        else:
+            currmtx = obj.getmatrix().mtx.copy()
+            if height is not None:
+                currmtx[13] = height
+
+            obj.height = currmtx[13]
+        if obj.type == "cTroop":
+            BWMatrix.static_rotate_y(currmtx, pi)
+
+        position = (currmtx[12], currmtx[13], currmtx[14])
+        radius = OBJECT_RADIUS
+
+        flag = 0
+        if obj in selected:
+            flag |= 1
+
+        if obj.type in ("cMapZone", "cCoastZone", "cDamageZone", "cNogoHintZone"):
+            if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
+                mtx = obj.mtxoverride
+            else:
+                mtx = obj.getmatrix().mtx
+            if obj.mZoneType in ZONECOLORS:
+                color = ZONECOLORS[obj.mZoneType]
+            else:
+                color = (0.0, 0.0, 1.0, 1.0)
+            zonedata = (flag, int(color[0]*255), int(color[1]*255), int(color[2]*255))
+            zoneradius = obj.mRadius
+            size = obj.mSize
+            scale = matrix_scale(mtx)
+
+            if zoneradius > 0:
+                culling.add(obj, rw.models.wireframe_cylinder.instances,
+                            scaled_matrix(mtx, zoneradius, zoneradius, zoneradius), zonedata)
+                radius = max(radius, zoneradius*2*scale)
+            if size.x > 0 and size.y >= 0 and size.z > 0:
+                culling.add(obj, rw.models.wireframe_cube.instances,
+                            scaled_matrix(mtx, size.x/2.0, size.y/2.0, size.z/2.0), zonedata)
+                radius = max(radius, sqrt(size.x**2 + size.y**2 + size.z**2)/2.0*scale)
+
+        if obj.type == "cWaypoint":
+            radius = max(radius, self.waypoint_radius(obj, position))
+
+        iconoffset = obj.iconoffset
+
+        modelname = obj._modelname
+        if modelname is not None and visible3d(obj.type):
+            if (obj.type != "cSceneryCluster"
+                    or scenery_simple and obj not in selected_scenery):
+                modelradius = self.add_model_instance(modelname, obj, currmtx)
+                if modelradius is not None:
+                    radius = max(radius, modelradius)
+
+        r, g, b, a = object_colors[obj.type]
+        culling.add(obj, instances, currmtx, (flag, int(r * 255), int(g * 255), int(b * 255)))
+
+        if iconoffset is not None:
+            x, y = iconoffset
+            culling.add(obj, rw.models.billboard.instances, currmtx, (flag, int(x), int(y), int(b * 255)))
+
+        culling.set_bounds(obj, position, radius)
+
+    def update_objects(self, objects, selected, frustum):
+        # Updates the instances of some objects without rebuilding the others. Returns False if
+        # that isn't possible and everything needs to be rebuilt.
+        rw = self.rw
+        visible = rw.visibility_menu.object_visible
+        objects_with_positions = rw.level_file.objects_with_positions
+
+        objects = [obj for obj in objects if isinstance(obj, BattalionObject)]
+        # Scenery components are generated from the clusters
+        if any(obj.type == "cSceneryCluster" for obj in objects):
+            return False
+
+        # Waypoint lines and bounds depend on the waypoints they connect to
+        waypoints = set(obj for obj in objects if obj.type == "cWaypoint")
+        for obj in list(waypoints):
+            waypoints.update(referrer for referrer in obj.referenced_by if referrer.type == "cWaypoint")
+        objects = set(objects) | waypoints
+
+        shown = [obj for obj in objects
+                 if objects_with_positions.get(obj.id) is obj and visible(obj.type, obj)]
+        shownset = set(shown)
+        for obj in objects:
+            if obj in shownset:
+                self.culling.replace(obj)
+            else:
+                self.culling.remove(obj)
+
+        heights = calculate_heights(shown, rw.bwterrain, rw.waterheight)
+        for obj, height in zip(shown, heights):
+            self.add_object(obj, height, selected, True, ())
+        self.culling.update_replaced(frustum)
+
+        if waypoints:
+            self.scene.waypoints = [obj for obj in self.scene.waypoints if obj not in waypoints]
+            self.scene.waypoints.extend(obj for obj in shown if obj in waypoints)
+            self.update_waypoint_links()
+            self.update_waypoint_lines()
+        return True
+
+    def update_waypoint_links(self):
+        self.scene.not_startpoint = {}
+        for obj in self.scene.waypoints:
+            if obj.NextWP is not None:
+                self.scene.not_startpoint[obj.NextWP] = True
+            if obj.mOptionalNextWP1 is not None:
+                self.scene.not_startpoint[obj.mOptionalNextWP1] = True
+            if obj.mOptionalNextWP2 is not None:
+                self.scene.not_startpoint[obj.mOptionalNextWP2] = True
+
+    def update_waypoint_lines(self):
+        self.scene.lines.reset_lines()
+        for obj in self.scene.waypoints:
+            if self.culling.is_visible(obj):
+                self.render_waypoint(self.rw, obj)
+
+    def waypoint_radius(self, obj, position):
+        # Distance to the furthest waypoint this one connects to, so the sphere covers the lines
+        radius = 0
+        for nextwp in (obj.NextWP, obj.mOptionalNextWP1, obj.mOptionalNextWP2):
+            if nextwp is None:
+                continue
+            if self.rw.dolphin.do_visualize() and nextwp.mtxoverride is not None:
+                mtx = nextwp.mtxoverride
+            else:
+                mtx = nextwp.getmatrix().mtx
+            dx, dy, dz = mtx[12] - position[0], mtx[13] - position[1], mtx[14] - position[2]
+            # The line ends at the terrain height of the next waypoint which isn't known yet
+            radius = max(radius, sqrt(dx*dx + dz*dz) + abs(dy) + OBJECT_RADIUS)
+        return radius
+
     def render_scene(self):
         rw = self.rw
+        render_state.reset()
 
         selected = rw.selected
         positions = rw.selected_positions
 
         glEnable(GL_CULL_FACE)
-        # mtx = numpy.concatenate([obj.getmatrix().mtx for obj in self.level_file.objects_with_positions.values()])
-        self.scene.reset()
-        default_matrices, default_extradata = self.scene.objects["generic"]
-
-        # self.models.cubev2.mtxdirty = True
-        globalmtx = None
-        globalextradata = None
+        billboard_instances = rw.models.billboard.instances
 
         globalsetting = 0
         if self.rw.is_topdown():
@@ -281,21 +502,39 @@ class Graphics(object):
         if self.render_everything_once:
             vismenu.visibility_override = True
 
+        # The first frame puts every object into the batches
+        frustum = None
+        if not self.render_everything_once:
+            frustum = Frustum.from_matrices(glGetFloatv(GL_PROJECTION_MATRIX), glGetFloatv(GL_MODELVIEW_MATRIX))
+        self.culling.enabled = vismenu.frustum_culling()
+
+        # Objects that were changed or (de)selected since the last frame
+        selection = set(selected)
+        changed = self._dirty_objects | (selection ^ self._rendered_selection)
+        if changed and not self.is_dirty():
+            if not self.render_everything_once and self.update_objects(changed, selection, frustum):
+                self._dirty_objects = set()
+            else:
+                self.set_dirty()
 
-
-        empty = False
         #self.set_dirty()
         if self.is_dirty():
+            previous_modelinstances = self.scene.modelinstances
             self.scene.fullreset()
-            globalmtx = []
-            globalextradata = []
+            for model in self.scene.model.values():
+                model.instances.begin()
+            billboard_instances.begin()
+            wireframe_cube, wireframe_cylinder = rw.models.wireframe_cube, rw.models.wireframe_cylinder
+            wireframe_cube.instances.begin()
+            wireframe_cylinder.instances.begin()
+            culling = self.culling
+            culling.begin()
 
             self.models_scene = []
 
 
             bwterrain = self.rw.bwterrain
             waterheight = self.rw.waterheight
-            empty = True
             waypoints = []
             scenery_simple = vismenu.show_full_scenery() is False
             selected_scenery = []
@@ -303,14 +542,7 @@ class Graphics(object):
                 self.scenery.set_scenery(rw.level_file,
                                          vismenu.object_visible,
                                          rw.level_file.is_bw2())
-
-                for component in self.scenery.components:
-                    if component.modeltype is not None:
-                        currmtx = component.mtx.mtx.copy()
-                        height = bwterrain.check_height(currmtx[12], currmtx[14])
-                        if height is not None:
-                            currmtx[13] = height
-                        self.scene.add_matrix(component.modeltype, currmtx)
+                self.add_scenery_components()
             elif scenery_simple and visible3d("cSceneryCluster"):
 
                 for obj in selected:
@@ -320,104 +552,38 @@ class Graphics(object):
                     self.scenery.set_scenery(selected_scenery,
                                              vismenu.object_visible,
                                              rw.level_file.is_bw2())
+                    self.add_scenery_components()
 
-                    for component in self.scenery.components:
-                        if component.modeltype is not None:
-                            currmtx = component.mtx.mtx.copy()
-                            height = bwterrain.check_height(currmtx[12], currmtx[14])
-                            if height is not None:
-                                currmtx[13] = height
-                            self.scene.add_matrix(component.modeltype, currmtx)
-
-
-            for obj in rw.level_file.objects_with_positions.values():
-                if not visible(obj.type, obj):
-                    continue
-                empty = False
-
-                if obj.type in self.scene.objects:
-                    mtx, extradata = self.scene.objects[obj.type]
-                    self.scene.set_not_empty(obj.type)
-                else:
-                    mtx, extradata = default_matrices, default_extradata
-                    self.scene.set_not_empty("generic")
-
-                if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
-                    currmtx = obj.mtxoverride.copy()
-                else:
-                    currmtx = obj.getmatrix().mtx.copy()
-                    height = obj.calculate_height(bwterrain, self.rw.waterheight)
-                    if height is not None:
-                        currmtx[13] = height
-
-                    obj.height = currmtx[13]
-                if obj.type == "cTroop":
-                    BWMatrix.static_rotate_y(currmtx, pi)
-                mtx.append(currmtx)
-
-                if obj.type in ("cMapZone", "cCoastZone", "cDamageZone", "cNogoHintZone"):
-                    if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
-                        mtx = obj.mtxoverride
-                    else:
-                        mtx = obj.getmatrix().mtx
-                    if obj in selected:
-                        color = object_colors["SelectionColor"]
-                    else:
-                        if obj.mZoneType in ZONECOLORS:
-                            color = ZONECOLORS[obj.mZoneType]
-                        else:
-                            color = (0.0, 0.0, 1.0, 1.0)
-                    radius = obj.mRadius
-                    size = obj.mSize
-
-                    if radius > 0:
-                        self.scene.wireframecylinders.append((mtx, color, (radius, radius, radius, 1)))
-                    if size.x > 0 and size.y >= 0 and size.z > 0:
-                        self.scene.wireframeboxes.append((mtx, color, (size.x/2.0, size.y/2.0, size.z/2.0, 1)))
+            visible_objects = [obj for obj in rw.level_file.objects_with_positions.values()
+                               if visible(obj.type, obj)]
+            heights = calculate_heights(visible_objects, bwterrain, waterheight)
 
+            for obj, height in zip(visible_objects, heights):
+                self.add_object(obj, height, selection, scenery_simple, selected_scenery)
                 if obj.type == "cWaypoint":
-                    if obj.NextWP is not None:
-                        self.scene.not_startpoint[obj.NextWP] = True
-                    if obj.mOptionalNextWP1 is not None:
-                        self.scene.not_startpoint[obj.mOptionalNextWP1] = True
-                    if obj.mOptionalNextWP2 is not None:
-                        self.scene.not_startpoint[obj.mOptionalNextWP2] = True
-
                     waypoints.append(obj)
 
-
-                iconoffset = obj.iconoffset
-
-                modelname = obj._modelname
-                if modelname is not None and visible3d(obj.type):
-                    if (obj.type != "cSceneryCluster"
-                            or scenery_simple and obj not in selected_scenery):
-                        self.scene.add_matrix(modelname, currmtx)
-
-                flag = 0
-                if obj in selected:
-                    flag |= 1
-                extradata.append(flag)
-
-                r, g, b, a = object_colors[obj.type]
-                extradata.append(int(r * 255))
-                extradata.append(int(g * 255))
-                extradata.append(int(b * 255))
-
-                if iconoffset is not None:
-                    globalmtx.append(currmtx)
-                    flag = 0
-                    if obj in selected:
-                        flag |= 1
-
-                    globalextradata.append(flag)
-                    x,y = iconoffset
-                    globalextradata.append(int(x))
-                    globalextradata.append(int(y))
-                    globalextradata.append(int(b * 255))
-            for obj in waypoints:
-                self.render_waypoint(rw, obj)
+            culling.end()
+            culling.update(frustum, rebuild=True)
+            self.scene.waypoints = waypoints
+            self.update_waypoint_links()
+            self.update_waypoint_lines()
+
+            # Objects that weren't visited this time give up their slots
+            for model in self.scene.model.values():
+                model.instances.end()
+            billboard_instances.end()
+            wireframe_cube.instances.end()
+            wireframe_cylinder.instances.end()
+            for modelname, model in self.scene.modelinstances.items():
+                model.instances.end()
+            for modelname, model in previous_modelinstances.items():
+                if modelname not in self.scene.modelinstances:
+                    model.instances.clear()
             self.reset_dirty()
+        elif self.culling.update(frustum):
+            self.update_waypoint_lines()
+        self._rendered_selection = selection
 
         # self.models.cubev2.mtxdirty = True
 
@@ -431,21 +597,16 @@ class Graphics(object):
             for mtx, x, z, modelname in self.models_scene:
                 rw.bwmodelhandler.rendermodel(modelname, mtx, rw.bwterrain, 0)
 
-        for meshname in self.scene.renderedmodels:
-            if meshname in self.scene.modelinstances:
-                mtxlist = self.scene.modelinstances[meshname]
-                if not mtxlist:
-                    mtx, extradata = None, None
-                else:
-                    mtx = numpy.concatenate(mtxlist)
-            else:
-                mtx, extradata = None, None
+        if self.scene.renderedmodels:
+            textures = self.rw.bwmodelhandler.textures
+            textures.update_pending()
+            render_state.invalidate()
 
-            #if len(mtx) > 0:
-            if self.rw.bwmodelhandler and meshname in self.rw.bwmodelhandler.instancemodels:
-                model = self.rw.bwmodelhandler.instancemodels[meshname]
-                model.bind(mtx, numpy.array([], dtype=numpy.uint8))
-                model.instancedrender(self.rw.bwmodelhandler.textures)
+            models = [self.scene.modelinstances[meshname] for meshname in self.scene.renderedmodels]
+            models.sort(key=lambda model: model.texture_sortkey(textures))
+            for model in models:
+                model.bind_instances()
+                model.instancedrender(textures)
                 model.unbind()
 
         if self.rw.is_topdown():
@@ -457,23 +618,11 @@ class Graphics(object):
         for objtype, model in self.scene.model.items():
             if not visible(objtype, obj=None) or not rw.cubes_visible:
                 continue
-            if self.scene.is_empty[objtype]:
+            if len(model.instances) == 0:
                 continue
 
-            mtx, extradata = self.scene.objects[objtype]
-
-            if empty:
-                mtx = numpy.array([], dtype=numpy.uint8)
-                extradata = numpy.array([], dtype=numpy.uint8)
-            elif not mtx:
-                mtx, extradata = None, None
-            else:
-                mtx = numpy.concatenate(mtx)
-                extradata = numpy.array(extradata, dtype=numpy.uint8)
-
-            model.bind(mtx, extradata)
-            coloruniform = model.program.getuniformlocation("selectioncolor")
-            glUniform4f(coloruniform, *object_colors["SelectionColor"])
+            model.bind_instances()
+            model.program.set_uniform(glUniform4f, "selectioncolor", *object_colors["SelectionColor"])
             model.instancedrender()
             model.unbind()
 
@@ -486,34 +635,20 @@ class Graphics(object):
         glActiveTexture(GL_TEXTURE1)
         rw.models.billboard.outlinetex.bind()
 
-        if globalmtx is None:
-            rw.models.billboard.bind(None, None)
-        elif len(globalmtx) == 0:
-            rw.models.billboard.bind(numpy.array(globalmtx, dtype=numpy.uint8),
-                                     numpy.array(globalextradata, dtype=numpy.uint8))
-        else:
-            rw.models.billboard.bind(numpy.concatenate(globalmtx),
-                                     numpy.array(globalextradata, dtype=numpy.uint8))
-        texuniform = rw.models.billboard.program.getuniformlocation("tex")
-        outlinetexuniform = rw.models.billboard.program.getuniformlocation("outlinetex")
-        coloruniform = rw.models.billboard.program.getuniformlocation("selectioncolor")
+        rw.models.billboard.bind_instances()
+        program = rw.models.billboard.program
 
-        glUniform1i(texuniform, 0)
-        glUniform1i(outlinetexuniform, 1)
-        glUniform4f(coloruniform, *object_colors["SelectionColor"])
+        program.set_uniform(glUniform1i, "tex", 0)
+        program.set_uniform(glUniform1i, "outlinetex", 1)
+        program.set_uniform(glUniform4f, "selectioncolor", *object_colors["SelectionColor"])
 
-        mtxuniform = rw.models.billboard.program.getuniformlocation("mvmtx")
-        projuniform = rw.models.billboard.program.getuniformlocation("proj")
-        glUniformMatrix4fv(mtxuniform, 1, False, glGetFloatv(GL_MODELVIEW_MATRIX))
-        glUniformMatrix4fv(projuniform, 1, False, glGetFloatv(GL_PROJECTION_MATRIX))
+        program.set_uniform(glUniformMatrix4fv, "mvmtx", 1, False, glGetFloatv(GL_MODELVIEW_MATRIX))
+        program.set_uniform(glUniformMatrix4fv, "proj", 1, False, glGetFloatv(GL_PROJECTION_MATRIX))
 
-        globaluniform = rw.models.billboard.program.getuniformlocation("globalsetting")
-        glUniform1i(globaluniform, globalsetting)
+        program.set_uniform(glUniform1i, "globalsetting", globalsetting)
 
         zoomscale = lerp(0.28, 0.64, 1.0, 2.8, self.rw.zoom_factor)
-        #zoomuniform =
-        facuniform = rw.models.billboard.program.getuniformlocation("scalefactor")
-        glUniform1f(facuniform, zoomscale)
+        program.set_uniform(glUniform1f, "scalefactor", zoomscale)
         if rw.cubes_visible:
             rw.models.billboard.instancedrender()
         rw.models.billboard.unbind()
@@ -530,35 +665,16 @@ class Graphics(object):
         self.scene.lines.render()
         self.scene.lines.unbind()
 
-        #if visible("cMapZone"):
-        if True:
-            glLineWidth(2.0)
-            if len(self.scene.wireframeboxes) > 0:
-                self.rw.models.wireframe_cube.bind()
-                mtxuniform = rw.models.wireframe_cube.program.getuniformlocation("modelmtx")
-                sizeuniform = rw.models.wireframe_cube.program.getuniformlocation("size")
-                coloruniform = rw.models.wireframe_cube.program.getuniformlocation("color")
-
-                for mtx, color, size in self.scene.wireframeboxes:
-                    glUniformMatrix4fv(mtxuniform, 1, False, mtx)
-                    glUniform4f(sizeuniform, size[0], size[1], size[2], size[3])
-                    glUniform4f(coloruniform, color[0], color[1], color[2], color[3])
-                    rw.models.wireframe_cube.render()
-                self.rw.models.wireframe_cube.unbind()
-            if len(self.scene.wireframecylinders) > 0:
-                self.rw.models.wireframe_cylinder.bind()
-                mtxuniform = rw.models.wireframe_cylinder.program.getuniformlocation("modelmtx")
-                sizeuniform = rw.models.wireframe_cylinder.program.getuniformlocation("size")
-                coloruniform = rw.models.wireframe_cylinder.program.getuniformlocation("color")
-
-                for mtx, color, size in self.scene.wireframecylinders:
-                    glUniformMatrix4fv(mtxuniform, 1, False, mtx)
-                    glUniform4f(sizeuniform, size[0], size[1], size[2], size[3])
-                    glUniform4f(coloruniform, color[0], color[1], color[2], color[3])
-                    rw.models.wireframe_cylinder.render()
-                self.rw.models.wireframe_cylinder.unbind()
-
-            glLineWidth(1.0)
+        glLineWidth(2.0)
+        for model in (rw.models.wireframe_cube, rw.models.wireframe_cylinder):
+            if len(model.instances) == 0:
+                continue
+
+            model.bind_instances()
+            model.program.set_uniform(glUniform4f, "selectioncolor", *object_colors["SelectionColor"])
+            model.instancedrender()
+            model.unbind()
+        glLineWidth(1.0)
 
         if self.render_everything_once:
             self.render_everything_once = False
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from timeit import default_timer
+
+
+class LoadTask(object):
+    def __init__(self, name, func, dependencies, main_thread, progress):
+        self.name = name
+        self.func = func
+        self.dependencies = dependencies
+        self.main_thread = main_thread
+        self.wants_progress = progress
+
+        self.result = None
+        self.progress = 0.0
+        self.start = None
+        self.end = None
+        self.future = None
+        self.on_progress = None
+
+    @property
+    def done(self):
+        return self.end is not None
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return None
+        end = self.end if self.end is not None else default_timer()
+        return end - self.start
+
+    def callback(self, max, i):
+        # Same signature as the progress callbacks used while loading
+        self.progress = min(i/max, 1.0) if max > 0 else 1.0
+        if self.on_progress is not None:
+            self.on_progress()
+
+
+class LoadPipeline(object):
+    """Runs the steps of loading a level as soon as the steps they depend on are finished.
+    Steps run in worker threads unless they are marked as main_thread, e.g. because they need
+    the GL context or touch widgets. Those run on the thread that calls run()."""
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, name, func, dependencies=(), main_thread=False, progress=False):
+        # func is called with the results of the dependencies in the given order. With
+        # progress the task's progress callback is passed as the callback keyword argument.
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise RuntimeError("Load step {0} depends on unknown step {1}".format(name, dependency))
+        task = LoadTask(name, func, tuple(dependencies), main_thread, progress)
+        self.tasks[name] = task
+        return task
+
+    def run(self, update=None, poll=0.02):
+        # update is called on this thread regularly while waiting, and while main thread steps report progress.
+        # The first error of any step is raised once the running steps are finished.
+        pending = list(self.tasks.values())
+        running = {}
+
+        executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="LevelLoad")
+        try:
+            while pending or running:
+                ready = [task for task in pending
+                         if all(self.tasks[dependency].done for dependency in task.dependencies)]
+
+                for task in ready:
+                    if not task.main_thread:
+                        pending.remove(task)
+                        task.future = executor.submit(self._run_task, task)
+                        running[task.future] = task
+
+                mainready = [task for task in ready if task.main_thread]
+                if mainready:
+                    pending.remove(mainready[0])
+                    mainready[0].on_progress = update
+                    self._run_task(mainready[0])
+                    self._check_finished(running, 0)
+                else:
+                    if update is not None:
+                        update()
+                    self._check_finished(running, poll)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return {name: task.result for name, task in self.tasks.items()}
+
+    def _check_finished(self, running, timeout):
+        if not running:
+            return
+        finished, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in finished:
+            del running[future]
+            future.result()  # Raises the error of the step if there was one
+
+    def _run_task(self, task):
+        args = [self.tasks[dependency].result for dependency in task.dependencies]
+        task.start = default_timer()
+        if task.wants_progress:
+            task.result = task.func(*args, callback=task.callback)
+        else:
+            task.result = task.func(*args)
+        task.progress = 1.0
+        task.end = default_timer()
+
+    def progress(self):
+        if not self.tasks:
+            return 1.0
+        return sum(task.progress for task in self.tasks.values())/len(self.tasks)
+
+    def timings(self):
+        # (name, seconds or None if it didn't start yet, whether it's finished) for every step
+        return [(task.name, task.duration, task.done) for task in self.tasks.values()]
+
+    def print_timings(self):
+        for name, duration, done in self.timings():
+            if duration is not None:
+                print("{0}: {1:.3f}s".format(name, duration))
@@ -1,5 +1,7 @@
+import io
 import os
 import gzip
+import mmap
 from struct import unpack, pack
 
 
@@ -18,7 +20,69 @@ def unpack_uint32(data, offset):
 
 def write_uint32(fileobj, val):
     fileobj.write(pack("I", val))
-    
+
+
+# Resource payloads are read with this so that archives opened through a BufferReader
+# hand out memoryviews into the file mapping instead of copies.
+def read_data(fileobj, size):
+    if isinstance(fileobj, BufferReader):
+        return fileobj.read_view(size)
+    else:
+        return fileobj.read(size)
+
+
+def map_file(f):
+    # Memory map plain files on disk. Anything else (gzip files, BytesIO) is read into memory.
+    if isinstance(f, (io.BufferedReader, io.FileIO)):
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files can't be mapped
+            pass
+        else:
+            return mapped, memoryview(mapped)[f.tell():]
+
+    return None, memoryview(f.read())
+
+
+def detach_data(res):
+    # Replaces data that points into a file mapping with a copy
+    if isinstance(res.data, memoryview):
+        view = res.data
+        res.data = bytes(view)
+        view.release()
+
+
+class BufferReader(object):
+    # Minimal read-only file interface over a memoryview. read() returns bytes
+    # for headers and names, read_view() returns a slice without copying.
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def read(self, size=-1):
+        return bytes(self.read_view(size))
+
+    def read_view(self, size=-1):
+        start = self.offset
+        if size < 0:
+            self.offset = len(self.buffer)
+        else:
+            self.offset = min(start+size, len(self.buffer))
+        return self.buffer[start:self.offset]
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.offset = offset
+        elif whence == io.SEEK_CUR:
+            self.offset += offset
+        elif whence == io.SEEK_END:
+            self.offset = len(self.buffer)+offset
+        return self.offset
+
     
 class Section(object):
     def __init__(self, secname, data):
@@ -29,9 +93,13 @@ class Section(object):
     def from_file(cls, f):
         secname = f.read(4)
         size = read_uint32(f)
-        data = f.read(size)
+        data = read_data(f, size)
         return cls(secname, data)
     
+    # Size of the section when written, including the 8 byte header
+    def packed_size(self):
+        return 8 + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         write_uint32(f, len(self.data))
@@ -73,10 +141,15 @@ class TextureArchive(Section):
 
         return cls(secname, level_name, textures, is_bw1)
 
+    def packed_size(self):
+        return 24 + len(self.level_name) + sum(tex.packed_size() for tex in self.textures)
+
     def write(self, f):
+        # Sizes are calculated up front so the archive can be written without seeking back
+        texture_size = sum(tex.packed_size() for tex in self.textures)
+
         f.write(self.secname)
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        write_uint32(f, 16 + len(self.level_name) + texture_size)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
 
@@ -85,19 +158,11 @@ class TextureArchive(Section):
         else:
             f.write(b"FTBG")
 
-        subarchive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)
+        write_uint32(f, 4 + texture_size)
         write_uint32(f, len(self.textures))
         for tex in self.textures:
             tex.write(f)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(subarchive_size)
-        write_uint32(f, end-(subarchive_size+4))
-        f.seek(end)
-
     def get_texture(self, texname):
         for tex in self.textures:
             if tex.name.lower() == texname.lower():
@@ -118,7 +183,7 @@ class TextureBW1(Section):
         size = read_uint32(f)
 
         texname = str(f.read(0x10).strip(b"\x00"), encoding="ascii")
-        data = f.read(size-0x10)
+        data = read_data(f, size-0x10)
 
         return cls(name, texname, data)
 
@@ -151,6 +216,9 @@ class TextureBW1(Section):
 
         return cls(b"TXET", fname.replace(".texture", ""), data)
 
+    def packed_size(self):
+        return 8 + 0x10 + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x10, b"\x00")
@@ -173,7 +241,7 @@ class TextureBW2(Section):
         size = read_uint32(f)
 
         texname = str(f.read(0x20).strip(b"\x00"), encoding="ascii")
-        data = f.read(size-0x20)
+        data = read_data(f, size-0x20)
 
         return cls(name, texname, data)
 
@@ -206,6 +274,9 @@ class TextureBW2(Section):
 
         return cls(b"DXTG", fname.replace(".texture", ""), data)
 
+    def packed_size(self):
+        return 8 + 0x20 + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x20, b"\x00")
@@ -247,10 +318,12 @@ class SoundArchive(Section):
         f.seek(curr+totalsize)
         return cls(level_name, sounds)
 
+    def packed_size(self):
+        return 24 + len(self.level_name) + sum(sound.packed_size() for sound in self.sounds) + self._padding
+
     def write(self, f):
         f.write(b"DNOS")
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        write_uint32(f, self.packed_size()-8)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
         f.write(b"HFSB")
@@ -263,11 +336,6 @@ class SoundArchive(Section):
         if self._padding > 0:
             f.write(b"\x00"*self._padding)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(end)
-
 
 class Sound(Section):
     def __init__(self, sound_name, data):
@@ -286,7 +354,7 @@ class Sound(Section):
         secname = f.read(4)
         assert secname == b"DPSD"
         size = read_uint32(f)
-        data = f.read(size)
+        data = read_data(f, size)
 
         return cls(sound_name, data)
 
@@ -303,6 +371,9 @@ class Sound(Section):
 
         return cls(fname.replace(".adp", ""), data)
 
+    def packed_size(self):
+        return 8 + 0x20 + 8 + len(self.data)
+
     def write(self, f):
         f.write(b"HPSD")
         write_uint32(f, 0x20)
@@ -328,7 +399,7 @@ class Model(Section):
         namelength = read_uint32(f)
         nm = f.read(namelength)
         modelname = str(nm, encoding="ascii")
-        data = f.read(size-namelength-4)
+        data = read_data(f, size-namelength-4)
 
         return cls(modelname, data)
 
@@ -347,6 +418,9 @@ class Model(Section):
 
         return cls(fname.replace(".modl", ""), prefix+data)
 
+    def packed_size(self):
+        return 8 + 4 + len(bytes(self.name, "ascii")) + len(self.data)
+
     def write(self, f):
         f.write(b"LDOM")
         encoded_name = bytes(self.name, "ascii")
@@ -369,7 +443,7 @@ class Animation(Section):
         size = read_uint32(f)
         namelenght = read_uint32(f)
         animname = str(f.read(namelenght), encoding="ascii")
-        data = f.read(size-namelenght-4)
+        data = read_data(f, size-namelenght-4)
 
         return cls(animname, data)
 
@@ -386,6 +460,9 @@ class Animation(Section):
 
         return cls(fname.replace(".anim", ""), data)
 
+    def packed_size(self):
+        return 8 + 4 + len(bytes(self.name, "ascii")) + len(self.data)
+
     def write(self, f):
         f.write(b"MINA")
         encoded_name = bytes(self.name, "ascii")
@@ -408,7 +485,7 @@ class Effect(Section):
         size = read_uint32(f)
         namelength = read_uint32(f)
         effect_name = str(f.read(namelength), encoding="ascii")
-        data = f.read(size-namelength-4)
+        data = read_data(f, size-namelength-4)
 
         return cls(effect_name, data)
 
@@ -425,6 +502,9 @@ class Effect(Section):
 
         return cls(fname.replace(".txt", ""), data)
 
+    def packed_size(self):
+        return 8 + 4 + len(bytes(self.name, "ascii")) + len(self.data)
+
     def write(self, f):
         f.write(b"FEQT")
         encoded_name = bytes(self.name, "ascii")
@@ -446,7 +526,7 @@ class LuaScript(Section):
         size = read_uint32(f)
         name_length = read_uint32(f)
         script_name = str(f.read(name_length), encoding="ascii")
-        data = f.read(size-4-name_length)
+        data = read_data(f, size-4-name_length)
         
         return cls(name, script_name, data)
     
@@ -467,6 +547,9 @@ class LuaScript(Section):
             
         return cls(b"PRCS", script_name, data)
     
+    def packed_size(self):
+        return 8 + 4 + len(bytes(self.name, "ascii")) + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii")
@@ -479,16 +562,28 @@ class LuaScript(Section):
 ORDERLIST = [b"RXET", b"DNOS", b"LDOM", b"MINA", b"PRCS", b"FEQT"]
 ORDER = {v: i for i,v in enumerate(ORDERLIST)}
 
+# Resource types that can be looked up by name with get_resource
+RESOURCE_TYPES = (b"DXTG", b"TXET", b"HPSD", b"MINA", b"LDOM", b"FEQT")
+
 
 class BattalionArchive(object):
     def __init__(self):
         self.sections = []
         self.textures = None
         self.sounds = None
+        self._mapping = None
+
+        # Name lookups per resource type, case insensitive for resources and exact for scripts.
+        # Built on first use and kept up to date by the methods that add, remove or rename resources.
+        self._index = None
+        self._script_index = None
     
     @classmethod
     def from_file(cls, f):
         arc = cls()
+        # Resource data stays in the file mapping as memoryviews until it is replaced
+        arc._mapping, buffer = map_file(f)
+        f = BufferReader(buffer)
         while True:
             curr = f.tell()
             peek = f.read(4)
@@ -515,7 +610,8 @@ class BattalionArchive(object):
                 arc.sections.append(section)
             else:
                 break 
-                
+
+        arc._build_index()
         return arc
     
     def write(self, f):
@@ -523,28 +619,102 @@ class BattalionArchive(object):
         for section in self.sections:
             section.write(f)
 
+    def packed_size(self):
+        return sum(section.packed_size() for section in self.sections)
+
+    def all_resources(self):
+        yield from self.sections
+        if self.textures is not None:
+            yield from self.textures.textures
+        if self.sounds is not None:
+            yield from self.sounds.sounds
+
+    def detach(self):
+        # Copy all data that still points into the file mapping and close the mapping.
+        # Has to be done before the file the archive was read from is overwritten.
+        # Anything else that took resources out of the archive has to detach them first.
+        for res in self.all_resources():
+            detach_data(res)
+
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                raise RuntimeError("Cannot close the resource archive file: parts of it are still in use. "
+                                   "The file can't be overwritten while it is mapped.")
+            self._mapping = None
+
+    def invalidate_index(self):
+        # Needs to be called when sections or resource lists are changed without going through the archive
+        self._index = None
+        self._script_index = None
+
+    def _build_index(self):
+        self._index = {restype: {} for restype in RESOURCE_TYPES}
+        self._script_index = {}
+
+        for res in self.all_resources():
+            self._index_add(res)
+
+    def _get_index(self, restype):
+        if self._index is None:
+            self._build_index()
+
+        if restype == b"PRCS":
+            return self._script_index
+        else:
+            return self._index.get(restype)
+
+    @staticmethod
+    def _index_key(res):
+        if res.secname == b"PRCS":
+            return res.name
+        else:
+            return res.name.lower()
+
+    def _index_add(self, res):
+        index = self._get_index(res.secname)
+        if index is not None:
+            # The first resource with a name wins, same as with a linear search
+            index.setdefault(self._index_key(res), res)
+
+    def _index_remove(self, res):
+        if self._index is None:
+            return
+
+        index = self._get_index(res.secname)
+        key = self._index_key(res) if index is not None else None
+        if index is not None and index.get(key) is res:
+            del index[key]
+            # Another resource with the same name can take its place
+            if res.secname == b"PRCS":
+                candidates = self.scripts()
+            else:
+                candidates = self._get_resource_list(res.secname)
+
+            for other in candidates:
+                if other is not res and other.secname == res.secname and self._index_key(other) == key:
+                    index[key] = other
+                    break
+
     def add_script(self, script: LuaScript):
-        for sec in self.sections:
-            if sec.secname == b"PRCS" and sec.name == script.name:
-                sec.data = script.data 
-                break 
+        sec = self.get_script(script.name)
+        if sec is not None:
+            sec.data = script.data
         else:
             self.sections.append(script)
             self.sections.sort(key=lambda x: ORDER[x.secname])
+            if self._index is not None:
+                self._index_add(script)
     
     def delete_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                self.sections.pop(i)
-                break
+        sec = self.get_script(script_name)
+        if sec is not None:
+            self.sections.remove(sec)
+            self._index_remove(sec)
 
     def get_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                return self.sections[i]
-        return None
+        return self._get_index(b"PRCS").get(script_name)
     
     def iter_sections(self, secname):
         for sec in self.sections:
@@ -579,20 +749,20 @@ class BattalionArchive(object):
         return resource_list
 
     def resource_exists(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
-
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return True
-        return False
+        return self.get_resource(restype, resname) is not None
 
     def get_resource(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return res
+        index = self._get_index(restype)
+        if index is None:
+            return None
 
-        return None
+        return index.get(resname.lower())
+
+    def rename_resource(self, resource, newname):
+        self._index_remove(resource)
+        resource.name = newname
+        if self._index is not None:
+            self._index_add(resource)
 
     def add_resource(self, resource):
         if isinstance(resource, TextureBW1):
@@ -605,6 +775,11 @@ class BattalionArchive(object):
             self.sounds.sounds.append(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.append(resource)
+        else:
+            return
+
+        if self._index is not None:
+            self._index_add(resource)
 
     def delete_resource(self, resource):
         if isinstance(resource, TextureBW1):
@@ -617,6 +792,10 @@ class BattalionArchive(object):
             self.sounds.sounds.remove(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.remove(resource)
+        else:
+            return
+
+        self._index_remove(resource)
 
     def sort_sections(self):
         self.sections.sort(key=lambda x: ORDER[x.secname])
@@ -1,5 +1,6 @@
 import json
 from time import time
+import numpy
 from OpenGL.GL import *
 from .vectors import Vector3, Triangle
 from struct import unpack
@@ -155,11 +156,39 @@ class TexturedMesh(object):
 class TexturedBWMesh(object):
     def __init__(self, texname):
         self.trilist = []
-
+        # Triangles that were added as arrays of corner positions and uvs
+        self._positions = []
+        self._uvs = []
 
         self.texname = texname
         self._displist = None
 
+    def add_triangles(self, positions, uvs):
+        assert len(positions) == len(uvs) and len(positions) % 3 == 0
+        if len(positions) > 0:
+            self._positions.append(positions)
+            self._uvs.append(uvs)
+
+    def vertex_count(self):
+        return len(self.trilist) + sum(len(positions) for positions in self._positions)
+
+    def vertex_data(self):
+        # All triangle corners as rows of x, y, z, u, v
+        data = numpy.zeros((self.vertex_count(), 5), dtype=numpy.float32)
+        offset = 0
+        for vtxpos, uv in self.trilist:
+            data[offset, 0:3] = vtxpos
+            if uv is not None:
+                data[offset, 3:5] = uv
+            offset += 1
+
+        for positions, uvs in zip(self._positions, self._uvs):
+            data[offset:offset+len(positions), 0:3] = positions
+            data[offset:offset+len(positions), 3:5] = uvs
+            offset += len(positions)
+
+        return data
+
     def generate_displist(self):
         if self._displist is not None:
             glDeleteLists(self._displist, 1)
@@ -168,12 +197,18 @@ class TexturedBWMesh(object):
         glNewList(displist, GL_COMPILE)
         glBegin(GL_TRIANGLES)
 
-        assert len(self.trilist) % 3 == 0
+        assert self.vertex_count() % 3 == 0
         for vtxpos, uv in self.trilist:
             if self.texname is not None and uv is not None:
                 glTexCoord2f(*uv)
             glVertex3f(*vtxpos)
 
+        for positions, uvs in zip(self._positions, self._uvs):
+            for vtxpos, uv in zip(positions.tolist(), uvs.tolist()):
+                if self.texname is not None:
+                    glTexCoord2f(*uv)
+                glVertex3f(*vtxpos)
+
         glEnd()
         glEndList()
         self._displist = displist
@@ -142,15 +142,6 @@ class ObjectModels(object):
         self.cylinder.render()
         glPopMatrix()
 
-    def draw_wireframe_cube(self, position, rotation, scale):
-        glPushMatrix()
-        glTranslatef(position.x, -position.z, position.y)
-        mtx = rotation.mtx
-        glMultMatrixf(mtx)
-        glScalef(-scale.z, scale.x, scale.y)
-        self.wireframe_cube.render()
-        glPopMatrix()
-
     def draw_cylinder_last_position(self, radius, height):
         glPushMatrix()
 
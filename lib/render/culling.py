@@ -0,0 +1,361 @@
+import numpy
+
+
+# Swaps y and z like the mtx matrix in the object shaders, so planes work on object positions directly
+OBJECT_TO_GL = numpy.array([[1.0, 0.0, 0.0, 0.0],
+                            [0.0, 0.0, 1.0, 0.0],
+                            [0.0, 1.0, 0.0, 0.0],
+                            [0.0, 0.0, 0.0, 1.0]], dtype=numpy.float64)
+
+DEFAULT_CELL_SIZE = 128.0
+
+OUTSIDE = 0
+INTERSECTING = 1
+INSIDE = 2
+
+
+class Frustum(object):
+    def __init__(self, planes):
+        # (6, 4) array of normalized planes, a point p is inside if dot(plane[:3], p) + plane[3] >= 0
+        self.planes = planes
+
+    @classmethod
+    def from_matrices(cls, projection, modelview):
+        # Takes the matrices as returned by glGetFloatv, i.e. column major
+        projection = numpy.asarray(projection, dtype=numpy.float64).reshape(4, 4).T
+        modelview = numpy.asarray(modelview, dtype=numpy.float64).reshape(4, 4).T
+        clip = projection @ modelview @ OBJECT_TO_GL
+
+        planes = numpy.array([clip[3] + clip[0], clip[3] - clip[0],
+                              clip[3] + clip[1], clip[3] - clip[1],
+                              clip[3] + clip[2], clip[3] - clip[2]])
+        planes /= numpy.linalg.norm(planes[:, :3], axis=1)[:, numpy.newaxis]
+        return cls(planes)
+
+    def key(self):
+        return self.planes.tobytes()
+
+    def spheres_visible(self, centers, radii):
+        distances = centers @ self.planes[:, :3].T + self.planes[:, 3]
+        return numpy.all(distances >= -radii[:, numpy.newaxis], axis=1)
+
+    def boxes_state(self, minimum, maximum):
+        # Per box whether it's outside, intersecting or completely inside the frustum
+        normals = self.planes[:, :3]
+        positive = numpy.where(normals >= 0, maximum[:, numpy.newaxis, :], minimum[:, numpy.newaxis, :])
+        negative = numpy.where(normals >= 0, minimum[:, numpy.newaxis, :], maximum[:, numpy.newaxis, :])
+        far = numpy.sum(positive*normals, axis=2) + self.planes[:, 3]
+        near = numpy.sum(negative*normals, axis=2) + self.planes[:, 3]
+
+        state = numpy.full(len(minimum), INTERSECTING, dtype=numpy.uint8)
+        state[numpy.all(near >= 0, axis=1)] = INSIDE
+        state[numpy.any(far < 0, axis=1)] = OUTSIDE
+        return state
+
+
+class SpatialGrid(object):
+    """Uniform grid on the ground plane over bounding spheres. Each sphere belongs to the cell
+    of its center and cell bounds grow to contain their spheres, so only the spheres of cells
+    that cross the frustum border need to be tested one by one. Cells also know their keys
+    so that area queries only look at the cells they overlap."""
+    def __init__(self, cellsize=DEFAULT_CELL_SIZE, capacity=256):
+        self.cellsize = cellsize
+        self.centers = numpy.zeros((capacity, 3), dtype=numpy.float64)
+        self.radii = numpy.zeros(capacity, dtype=numpy.float64)
+        self.itemcells = numpy.full(capacity, -1, dtype=numpy.int64)  # -1 for unused slots
+        self.keys = [None]*capacity
+        self.slots = {}
+        self.free = []
+        self.count = 0
+
+        self.cells = {}  # (x, z) cell coordinates -> cell index
+        self.cellkeys = []  # cell index -> set of keys whose center is in the cell
+        self.cellmin = numpy.zeros((0, 3), dtype=numpy.float64)
+        self.cellmax = numpy.zeros((0, 3), dtype=numpy.float64)
+        self._bounds_dirty = True
+        self._touched = set()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def begin(self):
+        self._touched = set()
+
+    def end(self):
+        # Everything that wasn't updated since begin() is gone
+        for key in [key for key in self.slots if key not in self._touched]:
+            self.remove(key)
+        self._touched = set()
+
+    def update(self, key, center, radius):
+        self._touched.add(key)
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+        elif self.radii[slot] == radius and tuple(self.centers[slot]) == tuple(center):
+            return
+
+        self.centers[slot] = center
+        self.radii[slot] = radius
+        oldcell = self.itemcells[slot]
+        cell = self._cell(center[0], center[2])
+        if cell != oldcell:
+            if oldcell >= 0:
+                self.cellkeys[oldcell].discard(key)
+            self.cellkeys[cell].add(key)
+            self.itemcells[slot] = cell
+        self._bounds_dirty = True
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        self.keys[slot] = None
+        self.cellkeys[self.itemcells[slot]].discard(key)
+        self.itemcells[slot] = -1
+        self.free.append(slot)
+        self._bounds_dirty = True
+
+    def query(self, frustum):
+        # Returns the keys of every sphere that is at least partially inside the frustum
+        if len(self.slots) == 0:
+            return []
+        self._update_bounds()
+
+        itemcells = self.itemcells[:self.count]
+        used = itemcells >= 0
+        cellstate = frustum.boxes_state(self.cellmin, self.cellmax)
+        state = numpy.where(used, cellstate[itemcells], OUTSIDE)
+
+        visible = state == INSIDE
+        check = numpy.flatnonzero(state == INTERSECTING)
+        if len(check) > 0:
+            visible[check] = frustum.spheres_visible(self.centers[check], self.radii[check])
+
+        keys = self.keys
+        return [keys[slot] for slot in numpy.flatnonzero(visible).tolist()]
+
+    def query_rectangle(self, minx, minz, maxx, maxz):
+        # Returns the keys whose center is inside the rectangle on the ground plane
+        cellsize = self.cellsize
+        startx, endx = int(minx//cellsize), int(maxx//cellsize)
+        startz, endz = int(minz//cellsize), int(maxz//cellsize)
+
+        if (endx - startx + 1)*(endz - startz + 1) > len(self.cells):
+            cells = [(cellx, cellz, cell) for (cellx, cellz), cell in self.cells.items()
+                     if startx <= cellx <= endx and startz <= cellz <= endz]
+        else:
+            cells = [(cellx, cellz, self.cells[cellx, cellz])
+                     for cellx in range(startx, endx + 1) for cellz in range(startz, endz + 1)
+                     if (cellx, cellz) in self.cells]
+
+        result = []
+        for cellx, cellz, cell in cells:
+            keys = self.cellkeys[cell]
+            if (minx <= cellx*cellsize and (cellx + 1)*cellsize <= maxx
+                    and minz <= cellz*cellsize and (cellz + 1)*cellsize <= maxz):
+                result.extend(keys)
+            else:
+                for key in keys:
+                    x, y, z = self.centers[self.slots[key]]
+                    if minx <= x <= maxx and minz <= z <= maxz:
+                        result.append(key)
+        return result
+
+    def query_circle(self, x, z, radius):
+        # Returns the keys whose center is within radius of the point on the ground plane
+        result = []
+        for key in self.query_rectangle(x - radius, z - radius, x + radius, z + radius):
+            centerx, centery, centerz = self.centers[self.slots[key]]
+            if (centerx - x)**2 + (centerz - z)**2 <= radius**2:
+                result.append(key)
+        return result
+
+    def _cell(self, x, z):
+        cellkey = (int(x//self.cellsize), int(z//self.cellsize))
+        cell = self.cells.get(cellkey)
+        if cell is None:
+            cell = self.cells[cellkey] = len(self.cells)
+            self.cellkeys.append(set())
+        return cell
+
+    def _update_bounds(self):
+        if not self._bounds_dirty:
+            return
+
+        cellcount = len(self.cells)
+        itemcells = self.itemcells[:self.count]
+        used = numpy.flatnonzero(itemcells >= 0)
+        radii = self.radii[used][:, numpy.newaxis]
+
+        # Empty cells end up with inverted bounds which are always outside
+        self.cellmin = numpy.full((cellcount, 3), numpy.inf)
+        self.cellmax = numpy.full((cellcount, 3), -numpy.inf)
+        numpy.minimum.at(self.cellmin, itemcells[used], self.centers[used] - radii)
+        numpy.maximum.at(self.cellmax, itemcells[used], self.centers[used] + radii)
+        self._bounds_dirty = False
+
+    def _allocate(self, key):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.count == len(self.keys):
+                self._grow()
+            slot = self.count
+            self.count += 1
+
+        self.slots[key] = slot
+        self.keys[slot] = key
+        return slot
+
+    def _grow(self):
+        capacity = len(self.keys)*2
+        centers = numpy.zeros((capacity, 3), dtype=numpy.float64)
+        radii = numpy.zeros(capacity, dtype=numpy.float64)
+        itemcells = numpy.full(capacity, -1, dtype=numpy.int64)
+        centers[:self.count] = self.centers[:self.count]
+        radii[:self.count] = self.radii[:self.count]
+        itemcells[:self.count] = self.itemcells[:self.count]
+
+        self.centers = centers
+        self.radii = radii
+        self.itemcells = itemcells
+        self.keys.extend([None]*(capacity - len(self.keys)))
+
+
+class CulledInstances(object):
+    """Instance submissions of the scene grouped by the object they belong to. Only objects
+    whose bounding sphere is in view are put into the instance batches."""
+    def __init__(self):
+        self.grid = SpatialGrid()
+        self.enabled = True
+
+        self.submissions = {}  # key -> [(instance slots, matrix, extra data), ...]
+        self.visible = set()
+        self.replaced = {}  # key -> instance slots of the submissions it had before replace()
+        self._frustumkey = None
+
+        self.visible_objects = 0
+        self.culled_objects = 0
+        self.submitted_instances = 0
+        self.culled_instances = 0
+
+    def begin(self):
+        self.grid.begin()
+        self.submissions = {}
+        self.replaced = {}
+
+    def add(self, key, instances, mtx, extradata=None):
+        self.submissions.setdefault(key, []).append((instances, mtx, extradata))
+
+    def set_bounds(self, key, center, radius):
+        self.grid.update(key, center, radius)
+
+    def end(self):
+        self.grid.end()
+
+    def replace(self, key):
+        # Drops the submissions of the key so that it can be added again outside of begin/end.
+        # The instance slots are updated by update_replaced.
+        old = self.submissions.pop(key, ())
+        self.replaced.setdefault(key, []).extend(instances for instances, mtx, extradata in old)
+
+    def remove(self, key):
+        self.replace(key)
+        self.grid.remove(key)
+
+    def update_replaced(self, frustum):
+        # Puts the keys that were added again since replace() into their instance slots if they are
+        # visible and takes them out of the slots they don't use anymore
+        if not self.replaced:
+            return
+        culling = self.enabled and frustum is not None
+        grid = self.grid
+
+        for key, oldinstances in self.replaced.items():
+            submissions = self.submissions.get(key, ())
+            if not submissions:
+                visible = False
+            elif culling and key in grid:
+                slot = grid.slots[key]
+                visible = bool(frustum.spheres_visible(grid.centers[slot:slot+1], grid.radii[slot:slot+1])[0])
+            else:
+                visible = True
+
+            used = set()
+            if visible:
+                self.visible.add(key)
+                for instances, mtx, extradata in submissions:
+                    instances.set(key, mtx, extradata)
+                    used.add(instances)
+            else:
+                self.visible.discard(key)
+
+            for instances in oldinstances:
+                if instances not in used:
+                    instances.remove(key)
+
+        self.replaced = {}
+        self._update_statistics()
+
+    def is_visible(self, key):
+        return key in self.visible or key not in self.grid
+
+    def update(self, frustum, rebuild=False):
+        # Puts the visible objects into their instance slots. With rebuild every visible object is
+        # submitted, the caller takes care of removing the rest with InstanceSlots.begin/end.
+        # Otherwise only objects that came into or went out of view are changed.
+        # Returns whether the visible objects changed.
+        culling = self.enabled and frustum is not None
+        frustumkey = frustum.key() if culling else b""
+        if not rebuild and frustumkey == self._frustumkey:
+            return False
+        self._frustumkey = frustumkey
+
+        if culling:
+            visible = set(self.grid.query(frustum))
+            visible.update(key for key in self.submissions if key not in self.grid)
+        else:
+            visible = set(self.submissions)
+
+        if rebuild:
+            shown, hidden = visible, ()
+        else:
+            shown, hidden = visible - self.visible, self.visible - visible
+        changed = rebuild or len(shown) > 0 or len(hidden) > 0
+
+        for key in hidden:
+            for instances, mtx, extradata in self.submissions.get(key, ()):
+                instances.remove(key)
+        for key in shown:
+            for instances, mtx, extradata in self.submissions.get(key, ()):
+                instances.set(key, mtx, extradata)
+        self.visible = visible
+
+        if changed:
+            self._update_statistics()
+        return changed
+
+    def _update_statistics(self):
+        submitted = culled = 0
+        for key, submissions in self.submissions.items():
+            if key in self.visible:
+                submitted += len(submissions)
+            else:
+                culled += len(submissions)
+
+        self.visible_objects = len(self.visible)
+        self.culled_objects = len(self.submissions) - len(self.visible)
+        self.submitted_instances = submitted
+        self.culled_instances = culled
+
+    def statistics(self):
+        return {
+            "visible_objects": self.visible_objects,
+            "culled_objects": self.culled_objects,
+            "submitted_instances": self.submitted_instances,
+            "culled_instances": self.culled_instances
+        }
@@ -12,6 +12,7 @@ import os
 import numpy
 from OpenGL.GL import *
 import ctypes
+import heapq
 
 from PyQt6 import QtGui
 
@@ -21,6 +22,53 @@ with open("lib/color_coding.json") as f:
 selectioncolor = colors["SelectionColor"]
 
 
+class RenderState(object):
+    # Remembers the bound texture while drawing a frame so redundant binds are skipped,
+    # and counts binds, draw calls and uniform updates of the frame.
+    UNKNOWN = -1
+
+    def __init__(self):
+        self.texture = self.UNKNOWN
+        self.reset()
+
+    def reset(self):
+        self.texture_binds = 0
+        self.skipped_binds = 0
+        self.draw_calls = 0
+        self.uniform_updates = 0
+        self.skipped_uniforms = 0
+
+    def invalidate(self):
+        # Call this when textures were bound without going through bind_texture
+        self.texture = self.UNKNOWN
+
+    def bind_texture(self, texture):
+        if texture == self.texture:
+            self.skipped_binds += 1
+            return
+
+        if texture is None:
+            glDisable(GL_TEXTURE_2D)
+        else:
+            if self.texture is None or self.texture == self.UNKNOWN:
+                glEnable(GL_TEXTURE_2D)
+            glBindTexture(GL_TEXTURE_2D, texture)
+            self.texture_binds += 1
+        self.texture = texture
+
+    def statistics(self):
+        return {
+            "texture_binds": self.texture_binds,
+            "skipped_binds": self.skipped_binds,
+            "draw_calls": self.draw_calls,
+            "uniform_updates": self.uniform_updates,
+            "skipped_uniforms": self.skipped_uniforms
+        }
+
+
+render_state = RenderState()
+
+
 class Shader(object):
     def __init__(self, filename, fileline, text):
         self.filename = filename
@@ -46,11 +94,15 @@ class Program(object):
         self.vtxshader = vtxshader
         self.fragshader = fragshader
         self.program = None
+        self._uniformlocations = {}
+        self._uniformvalues = {}
 
     def compiled(self):
         return self.program is not None
 
     def compile(self):
+        self._uniformlocations = {}
+        self._uniformvalues = {}
         try:
             self.program = create_shader(self.vtxshader.text, self.fragshader.text)
         except ShaderCompilationError as err:
@@ -73,7 +125,21 @@ class Program(object):
         glUseProgram(self.program)
 
     def getuniformlocation(self, uniform):
-        return glGetUniformLocation(self.program, uniform)
+        if uniform not in self._uniformlocations:
+            self._uniformlocations[uniform] = glGetUniformLocation(self.program, uniform)
+        return self._uniformlocations[uniform]
+
+    def set_uniform(self, setter, uniform, *args):
+        # Uniform values stay with the program, so only changed values are sent.
+        # The program needs to be bound.
+        value = tuple(arg.tobytes() if isinstance(arg, numpy.ndarray) else arg for arg in args)
+        if self._uniformvalues.get(uniform) == value:
+            render_state.skipped_uniforms += 1
+            return
+
+        setter(self.getuniformlocation(uniform), *args)
+        self._uniformvalues[uniform] = value
+        render_state.uniform_updates += 1
 
 
 def get_location(shaderstring, varname):
@@ -248,6 +314,8 @@ class Material(object):
 
 
 class VertexBuffer(object):
+    target = GL_ARRAY_BUFFER
+
     def __init__(self):
         self._buffer = None
         self._attributes = []
@@ -275,7 +343,11 @@ class VertexBuffer(object):
 
     def load_data(self, data):
         assert self.initialized()
-        glBufferData(GL_ARRAY_BUFFER, data, GL_DYNAMIC_DRAW)
+        glBufferData(self.target, data, GL_DYNAMIC_DRAW)
+
+    def update_data(self, offset, data):
+        assert self.initialized()
+        glBufferSubData(self.target, offset, data.nbytes, data)
 
     def initialized(self):
         return self._buffer is not None
@@ -287,7 +359,7 @@ class VertexBuffer(object):
 
     def bind(self):
         assert self.initialized()
-        glBindBuffer(GL_ARRAY_BUFFER, self._buffer)
+        glBindBuffer(self.target, self._buffer)
 
 
 class VertexPositionBuffer(VertexBuffer):
@@ -333,11 +405,198 @@ class ExtraBuffer(VertexBuffer):
         self.add_attribute(extra_attr_index,  4,  GL_UNSIGNED_BYTE, normalize, 4, 0, divisor=1)
 
 
+class IDBuffer(VertexBuffer):
+    # One unsigned integer per instance that reaches the shader without being converted to float
+    def __init__(self, id_attr_index):
+        super().__init__()
+        self.add_attribute(id_attr_index, 1, GL_UNSIGNED_INT, GL_FALSE, 4, 0, divisor=1)
+
+    def attr_init(self):
+        for index, count, attrtype, normalize, stride, offset, divisor in self._attributes:
+            glEnableVertexAttribArray(index)
+            glVertexAttribIPointer(index, count, attrtype, stride, ctypes.c_void_p(offset))
+            if divisor is not None:
+                glVertexAttribDivisor(index, divisor)
+
+
+class IndexBuffer(VertexBuffer):
+    # Element buffers are part of the VAO state, so bind it while the VAO is bound
+    target = GL_ELEMENT_ARRAY_BUFFER
+
+    def load_data(self, data):
+        assert self.initialized()
+        glBufferData(self.target, data, GL_STATIC_DRAW)
+
+
+def index_vertices(vertexdata, stride):
+    # Merges identical vertices. Returns the unique vertices in the order they are first used
+    # and for every original vertex the index of its unique vertex.
+    rows = numpy.ascontiguousarray(vertexdata, dtype=numpy.float32).reshape(-1, stride)
+    if len(rows) == 0:
+        return rows, numpy.zeros(0, dtype=numpy.int64)
+
+    keys = rows.view(numpy.dtype((numpy.void, rows.itemsize*stride))).reshape(-1)
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    remap = numpy.empty(len(order), dtype=numpy.int64)
+    remap[order] = numpy.arange(len(order))
+    return rows[first[order]], remap[inverse.reshape(-1)]
+
+
+def index_mesh(vertexdata, stride):
+    # Indexes the triangle list vertex data of one mesh. The indices start at 0 for every mesh
+    # and are 16 bit if they are enough, so this can run before the mesh is placed in a buffer.
+    unique, indices = index_vertices(vertexdata, stride)
+    if len(unique) <= 0x10000:
+        return unique, indices.astype(numpy.uint16)
+    else:
+        return unique, indices.astype(numpy.uint32)
+
+
+class InstanceSlots(object):
+    """Per-model instance data where every object keeps a stable slot.
+    Only slots that changed since the last upload are sent to the GPU."""
+    COMPACT_MIN_FREE = 64
+    MERGE_RANGES = 16
+
+    def __init__(self, capacity=64):
+        self.matrices = numpy.zeros((capacity, 16), dtype=numpy.float32)
+        self.extradata = numpy.zeros((capacity, 4), dtype=numpy.uint8)
+        self.slots = {}
+        self.keys = [None]*capacity
+        self.free = []
+        self.count = 0  # Slots in use including freed holes, i.e. the instance count to draw
+
+        self.dirty = set()
+        self.resized = True
+        self._touched = set()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def begin(self):
+        self._touched = set()
+
+    def set(self, key, mtx, extradata=None):
+        self._touched.add(key)
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._allocate(key)
+        elif (self.matrices[slot].tobytes() == mtx.tobytes()
+              and (extradata is None or self.extradata[slot].tobytes() == bytes(extradata))):
+            return
+
+        self.matrices[slot] = mtx
+        if extradata is not None:
+            self.extradata[slot] = extradata
+        self.dirty.add(slot)
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        # A zero matrix collapses the instance to a point so holes are never visible
+        self.keys[slot] = None
+        self.matrices[slot] = 0
+        self.extradata[slot] = 0
+        heapq.heappush(self.free, slot)
+        self.dirty.add(slot)
+
+    def end(self):
+        for key in [key for key in self.slots if key not in self._touched]:
+            self.remove(key)
+        self._touched = set()
+
+        if not self.slots:
+            self.clear()
+        elif len(self.free) >= self.COMPACT_MIN_FREE and len(self.free)*2 > self.count:
+            self.compact()
+
+    def clear(self):
+        if self.count > 0:
+            self.matrices[:self.count] = 0
+            self.extradata[:self.count] = 0
+            self.keys = [None]*len(self.keys)
+            self.dirty = set()
+            self.resized = True
+        self.slots = {}
+        self.free = []
+        self.count = 0
+
+    def compact(self):
+        live = sorted(self.slots.values())
+        keys = [self.keys[slot] for slot in live]
+        livecount = len(live)
+
+        self.matrices[:livecount] = self.matrices[live]
+        self.extradata[:livecount] = self.extradata[live]
+        self.matrices[livecount:self.count] = 0
+        self.extradata[livecount:self.count] = 0
+
+        self.keys = keys + [None]*(len(self.keys) - livecount)
+        self.slots = {key: i for i, key in enumerate(keys)}
+        self.free = []
+        self.count = livecount
+        self.dirty = set()
+        self.resized = True
+
+    def _allocate(self, key):
+        if self.free:
+            slot = heapq.heappop(self.free)
+        else:
+            if self.count == len(self.keys):
+                self._grow()
+            slot = self.count
+            self.count += 1
+
+        self.slots[key] = slot
+        self.keys[slot] = key
+        return slot
+
+    def _grow(self):
+        capacity = len(self.keys)*2
+        matrices = numpy.zeros((capacity, 16), dtype=numpy.float32)
+        extradata = numpy.zeros((capacity, 4), dtype=numpy.uint8)
+        matrices[:self.count] = self.matrices[:self.count]
+        extradata[:self.count] = self.extradata[:self.count]
+
+        self.matrices = matrices
+        self.extradata = extradata
+        self.keys.extend([None]*(capacity - len(self.keys)))
+        self.resized = True
+
+    def dirty_ranges(self):
+        if not self.dirty:
+            return []
+
+        slots = sorted(self.dirty)
+        ranges = []
+        start = prev = slots[0]
+        for slot in slots[1:]:
+            if slot != prev + 1:
+                ranges.append((start, prev + 1))
+                start = slot
+            prev = slot
+        ranges.append((start, prev + 1))
+
+        # Many small uploads cost more than one bigger one
+        if len(ranges) > self.MERGE_RANGES:
+            ranges = [(slots[0], slots[-1] + 1)]
+        return ranges
+
+    def reset_dirty(self):
+        self.dirty = set()
+        self.resized = False
+
+
 class ModelV2(object):
     def __init__(self, uvcoords=False):
-        self.mesh_list = []
-        self._triangles = []
+        self.mesh_list = []  # (index offset in bytes, index count, index type, base vertex) for every mesh
+        self._vertices = numpy.zeros(0, dtype=numpy.float32)
+        self._indices = numpy.zeros(0, dtype=numpy.uint8)
         self._uvcoords = uvcoords  #Whether to use UV coordinates or not
+        self._stride = 8 if uvcoords else 6
+        self._rawvertexcount = 0
 
 
         self.vertexshader = Shader.create("""
@@ -381,11 +640,11 @@ void main(void)
 layout(location = 0) in vec3 vert;
 layout(location = 1) in vec4 color;
 layout(location = 2) in mat4 instanceMatrix;
-layout(location = 6) in vec4 data;
+layout(location = 6) in uint objectid;
 
 uniform int globalsetting;
 
-out vec4 fragColor;
+flat out uint fragId;
 
 mat4 mtx = mat4(1.0, 0.0, 0.0, 0.0,
                 0.0, 0.0, 1.0, 0.0,
@@ -395,8 +654,7 @@ mat4 mtx = mat4(1.0, 0.0, 0.0, 0.0,
 
 void main(void)
 {   
-    fragColor = vec4(data.g/255, data.b/255, data.a/255, 1.0);
-    //fragColor = vec4(1.0, 0.0, 0.0, 1.0);
+    fragId = objectid;
     gl_Position = gl_ModelViewProjectionMatrix* mtx*instanceMatrix*vec4(vert, 1.0);
     //gl_Position = gl_ModelViewProjectionMatrix* mtx*vec4(vert, 1.0);
 }   """)
@@ -410,31 +668,94 @@ void main (void)
 {
     finalColor = fragColor;
 }  
+""")
+
+        self.fragshader_colorid = Shader.create("""
+#version 330
+flat in uint fragId;
+out uint finalId;
+
+void main (void)
+{
+    finalId = fragId;
+}  
 """)
         if uvcoords:
             self.vbo = VertexColorUVBuffer(*self.vertexshader.get_locations("vert", "color", "uv"))
         else:
             self.vbo = VertexColorBuffer(*self.vertexshader.get_locations("vert", "color"))
+        self.ibo = IndexBuffer()
 
         self.vao = None
         self.vao_colorid = None
         self.mtxloc = None
         self.program = Program(self.vertexshader, self.fragshader)
-        self.program_colorid = Program(self.vertexshader_colorid, self.fragshader)
+        self.program_colorid = Program(self.vertexshader_colorid, self.fragshader_colorid)
         self.mtxbuffer = MatrixBuffer(self.vertexshader.get_location( "instanceMatrix"))
         self.mtxdirty = True
         self.extrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
-        self.coloridbuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
+        self.coloridbuffer = IDBuffer(self.vertexshader_colorid.get_location("objectid"))
         self._count = None
+        self.instances = InstanceSlots()
+
+    def set_meshes(self, meshes):
+        # Takes the triangle list vertex data of every mesh and stores it indexed, with
+        # duplicate vertices merged.
+        self.set_indexed_meshes([index_mesh(vertexdata, self._stride) for vertexdata in meshes])
+
+    def set_indexed_meshes(self, meshes):
+        # Takes the unique vertices and indices of every mesh, see index_mesh, and puts them
+        # one after another into the vertex and index data. Meshes are drawn with their first
+        # vertex as the base vertex so their indices don't need to be changed.
+        vertices = []
+        indexdata = []
+        vertexcount = 0
+        indexoffset = 0
+        self.mesh_list = []
+        self._rawvertexcount = 0
+
+        for unique, indices in meshes:
+            indextype = GL_UNSIGNED_SHORT if indices.dtype == numpy.uint16 else GL_UNSIGNED_INT
+            self.mesh_list.append((indexoffset, len(indices), indextype, vertexcount))
+            vertices.append(unique.reshape(-1))
+            indexdata.append(indices.tobytes())
+            # Keep the offsets aligned for 32 bit indices
+            padding = -indices.nbytes % 4
+            if padding:
+                indexdata.append(b"\x00"*padding)
+
+            vertexcount += len(unique)
+            indexoffset += indices.nbytes + padding
+            self._rawvertexcount += len(indices)
+
+        if len(vertices) > 0:
+            self._vertices = numpy.concatenate(vertices)
+        self._indices = numpy.frombuffer(b"".join(indexdata), dtype=numpy.uint8)
+
+    def mesh_statistics(self):
+        vertexsize = self._stride*4
+        vertexcount = len(self._vertices)//self._stride
+        return {
+            "vertices_before": self._rawvertexcount,
+            "vertices_after": vertexcount,
+            "indices": sum(indexcount for offset, indexcount, indextype, basevertex in self.mesh_list),
+            "bytes_before": self._rawvertexcount*vertexsize,
+            "bytes_after": vertexcount*vertexsize + self._indices.nbytes
+        }
+
+    def upload_mesh(self):
+        # The VAO needs to be bound
+        self.vbo.init()
+        self.vbo.load_data(self._vertices)
+        self.ibo.init()
+        self.ibo.load_data(self._indices)
 
     def build_mesh(self, array, extradata):
-        assert len(self._triangles) % 3 * 3 == 0
         if self.vao is None:
             self.vao = glGenVertexArrays(1)
         glBindVertexArray(self.vao)
 
-        self.vbo.init()
-        self.vbo.load_data(numpy.array(self._triangles, dtype=numpy.float32))
+        self.upload_mesh()
 
         self.rebuild_instance_array(array, extradata)
 
@@ -451,6 +772,38 @@ void main (void)
 
             self.mtxdirty = False
 
+    def upload_instances(self):
+        instances = self.instances
+        if instances.resized:
+            self.mtxbuffer.init()
+            self.mtxbuffer.load_data(instances.matrices)
+            self.extrabuffer.init()
+            self.extrabuffer.load_data(instances.extradata)
+        else:
+            for start, end in instances.dirty_ranges():
+                self.mtxbuffer.init()
+                self.mtxbuffer.update_data(start*4*16, instances.matrices[start:end])
+                self.extrabuffer.init()
+                self.extrabuffer.update_data(start*4, instances.extradata[start:end])
+        instances.reset_dirty()
+
+    def bind_instances(self):
+        if not self.program.compiled():
+            self.program.compile()
+
+        if self.vao is None:
+            self.vao = glGenVertexArrays(1)
+            glBindVertexArray(self.vao)
+            self.upload_mesh()
+        else:
+            glBindVertexArray(self.vao)
+
+        self.upload_instances()
+        self._count = self.instances.count
+        self.program.bind()
+
+        glBindVertexArray(self.vao)
+
     def bind(self, array, extradata, render_one=False):
         if array is not None:
             self._count = len(array)//16
@@ -467,7 +820,7 @@ void main (void)
     def bind_single(self):
         self.bind(None, None, render_one=True)
 
-    def bind_colorid(self, extradata):
+    def bind_colorid(self, objectids):
         if  not self.program_colorid.compiled():
             self.program_colorid.compile()
 
@@ -476,6 +829,7 @@ void main (void)
             glBindVertexArray(self.vao_colorid)
             self.vbo.bind()
             self.vbo.attr_init()
+            self.ibo.bind()
             self.mtxbuffer.bind()
             self.mtxbuffer.attr_init()
 
@@ -486,7 +840,7 @@ void main (void)
         self.vbo.bind()
         self.mtxbuffer.bind()
         self.coloridbuffer.init()
-        self.coloridbuffer.load_data(extradata)
+        self.coloridbuffer.load_data(objectids)
         self.program_colorid.bind()
 
         glBindVertexArray(self.vao_colorid)
@@ -498,14 +852,16 @@ void main (void)
 
     def render(self, mtx):
         glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
-        for offset, vertexcount in self.mesh_list:
-            glDrawArrays(GL_TRIANGLES, offset, vertexcount)
+        for offset, indexcount, indextype, basevertex in self.mesh_list:
+            glDrawElementsBaseVertex(GL_TRIANGLES, indexcount, indextype, ctypes.c_void_p(offset), basevertex)
 
     def instancedrender(self):
         #glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
-        for offset, vertexcount in self.mesh_list:
+        for offset, indexcount, indextype, basevertex in self.mesh_list:
             if self._count is not None and self._count > 0:
-                glDrawArraysInstanced(GL_TRIANGLES, offset, vertexcount, self._count)
+                glDrawElementsInstancedBaseVertex(GL_TRIANGLES, indexcount, indextype, ctypes.c_void_p(offset),
+                                                  self._count, basevertex)
+                render_state.draw_calls += 1
 
     def render_coloredid(self, id):
         glColor3ub((id >> 16) & 0xFF, (id >> 8) & 0xFF, (id >> 0) & 0xFF)
@@ -606,8 +962,7 @@ void main (void)
                     count += 3
                     #curr_mesh.triangles.append(((v1[0] - 1, None), (v3[0] - 1, None), (v2[0] - 1, None)))
         #model.add_mesh(curr_mesh)
-        model.mesh_list.append((offset, count))
-        model._triangles = triangles
+        model.set_meshes([numpy.array(triangles, dtype=numpy.float32)])
         return model
         # elif cmd == "vn":
         #    nx, ny, nz = map(float, args[1:4])
@@ -697,16 +1052,25 @@ class Billboard(ModelV2):
         }  
         """)
         self.program = Program(self.vertexshader, self.fragshader)
-        self.program_colorid = Program(self.vertexshader_colorid, self.fragshader)
+        self.program_colorid = Program(self.vertexshader_colorid, self.fragshader_colorid)
 
 
 class BWModelV2(ModelV2):
     def __init__(self):
         self.texnames = []
         self.mesh_list = []
-        self._triangles = []
+        self._vertices = numpy.zeros(0, dtype=numpy.float32)
+        self._indices = numpy.zeros(0, dtype=numpy.uint8)
+        self._stride = 5
+        self._rawvertexcount = 0
         self.lowestpoint = None
 
+        # Texture handles of the meshes, resolved once from texnames and again after textures are reloaded
+        self._textures = []
+        self._texarchive = None
+        self._texgeneration = None
+        self.draworder = []
+
         self.vertexshader = Shader.create("""
         #version 330 compatibility
         layout(location = 0) in vec3 vert;
@@ -755,6 +1119,7 @@ class BWModelV2(ModelV2):
         }  
         """)
         self.vbo = VertexUVBuffer(*self.vertexshader.get_locations("vert", "uv"))
+        self.ibo = IndexBuffer()
 
         self.vao = None
         self.vao_colorid = None
@@ -764,23 +1129,35 @@ class BWModelV2(ModelV2):
         self.mtxdirty = True
         #self.extrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
         self._count = None
+        self.instances = InstanceSlots()
 
     @classmethod
     def from_textured_bw_model(cls, bwmodel):
         model = cls()
-        offset = 0
+        meshes = []
         for bwmesh in bwmodel.mesh_list:
-            if len(bwmesh.trilist) == 0:
+            if bwmesh.vertex_count() == 0:
                 continue
 
-            model.mesh_list.append((offset, len(bwmesh.trilist)))
-            offset += len(bwmesh.trilist)
-
             model.texnames.append(bwmesh.texname)
-            for vtxpos, vtxuv in bwmesh.trilist:
-                model._triangles.extend(vtxpos)
-                model._triangles.extend(vtxuv)
+            meshes.append(bwmesh.vertex_data())
 
+        model.set_meshes(meshes)
+        return model
+
+    @classmethod
+    def from_indexed_meshes(cls, meshes):
+        # meshes are (texture name, unique vertices, indices) as made by index_mesh
+        model = cls()
+        indexed = []
+        for texname, vertices, indices in meshes:
+            if len(indices) == 0:
+                continue
+
+            model.texnames.append(texname)
+            indexed.append((vertices, indices))
+
+        model.set_indexed_meshes(indexed)
         return model
 
     def rebuild_instance_array(self, array, extradata):
@@ -793,39 +1170,64 @@ class BWModelV2(ModelV2):
 
             self.mtxdirty = False
 
-    def render(self, texarchive, mtx):
-        glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
-        #glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
-        for texname, meshdata in zip(self.texnames, self.mesh_list):
+    def upload_instances(self):
+        instances = self.instances
+        if instances.resized:
+            self.mtxbuffer.init()
+            self.mtxbuffer.load_data(instances.matrices)
+        else:
+            for start, end in instances.dirty_ranges():
+                self.mtxbuffer.init()
+                self.mtxbuffer.update_data(start*4*16, instances.matrices[start:end])
+        instances.reset_dirty()
+
+    def resolve_textures(self, texarchive):
+        if self._texarchive is texarchive and self._texgeneration == texarchive.generation:
+            return
+
+        textures = []
+        for texname in self.texnames:
+            result = None
             if texname is not None:
                 result = texarchive.get_texture(texname.lower())
-                if result is not None:
-                    glEnable(GL_TEXTURE_2D)
-                    glBindTexture(GL_TEXTURE_2D, result[1])
-                else:
-                    glDisable(GL_TEXTURE_2D)
-            else:
-                glDisable(GL_TEXTURE_2D)
+            textures.append(result[1] if result is not None else None)
+
+        self._textures = textures
+        # Meshes sharing a texture are drawn one after another
+        self.draworder = sorted(range(len(textures)),
+                                key=lambda i: (textures[i] is not None, textures[i] or 0))
+        self._texarchive = texarchive
+        self._texgeneration = texarchive.generation
+
+    def texture_sortkey(self, texarchive):
+        # Models are drawn sorted by the texture of their first mesh so a model can reuse
+        # the texture bound by the model before it.
+        self.resolve_textures(texarchive)
+        if len(self.draworder) == 0:
+            return (False, 0)
+        texture = self._textures[self.draworder[0]]
+        return (texture is not None, texture or 0)
 
-            offset, vertexcount = meshdata
-            glDrawArrays(GL_TRIANGLES, offset, vertexcount)
+    def render(self, texarchive, mtx):
+        glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
+        self.resolve_textures(texarchive)
+        for i in self.draworder:
+            render_state.bind_texture(self._textures[i])
+            offset, indexcount, indextype, basevertex = self.mesh_list[i]
+            glDrawElementsBaseVertex(GL_TRIANGLES, indexcount, indextype, ctypes.c_void_p(offset), basevertex)
+            render_state.draw_calls += 1
 
     def instancedrender(self, texarchive):
-        #glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
-        for texname, meshdata in zip(self.texnames, self.mesh_list):
-            if texname is not None:
-                result = texarchive.get_texture(texname.lower())
-                if result is not None:
-                    glEnable(GL_TEXTURE_2D)
-                    glBindTexture(GL_TEXTURE_2D, result[1])
-                else:
-                    glDisable(GL_TEXTURE_2D)
-            else:
-                glDisable(GL_TEXTURE_2D)
+        self.resolve_textures(texarchive)
+        if self._count is None or self._count == 0:
+            return
 
-            offset, vertexcount = meshdata
-            if self._count is not None and self._count > 0:
-                glDrawArraysInstanced(GL_TRIANGLES, offset, vertexcount, self._count)
+        for i in self.draworder:
+            render_state.bind_texture(self._textures[i])
+            offset, indexcount, indextype, basevertex = self.mesh_list[i]
+            glDrawElementsInstancedBaseVertex(GL_TRIANGLES, indexcount, indextype, ctypes.c_void_p(offset),
+                                              self._count, basevertex)
+            render_state.draw_calls += 1
 
 
 class LineDrawing(object):
@@ -997,31 +1399,29 @@ class QuadDrawing(object):
 
 
 class WireframeModel(object):
+    # Drawn instanced. The instance matrix includes the size of the volume and the extra data
+    # is (flags, r, g, b) like for the object cubes, with flag 1 for selected volumes.
     def __init__(self, modelfile):
         self.vertexshader = Shader.create("""
         #version 330 compatibility
         layout(location = 0) in vec3 vert;
+        layout(location = 2) in mat4 instanceMatrix;
+        layout(location = 6) in vec4 val;
 
         out vec4 fragColor;
-        uniform mat4 modelmtx;
-        uniform vec4 size;
-        uniform vec4 color;
+        uniform vec4 selectioncolor;
         
         mat4 mtx = mat4(1.0, 0.0, 0.0, 0.0,
                         0.0, 0.0, 1.0, 0.0,
                         0.0, 1.0, 0.0, 0.0,
                         0.0, 0.0, 0.0, 1.0);
         
-        mat4 scalemtx = mat4(size.x, 0.0, 0.0, 0.0,
-                            0.0, size.y, 0.0, 0.0,
-                            0.0, 0.0, size.z, 0.0,
-                            0.0, 0.0, 0.0, 1.0);    
-    
-        
         void main(void)
         {   
-            fragColor = color;
-            gl_Position = gl_ModelViewProjectionMatrix* mtx*modelmtx*scalemtx*vec4(vert, 1.0);
+            float highlight = float(int(val.x) & 0x1)*1.0;
+            vec4 color = vec4(val.y/255.0, val.z/255.0, val.w/255.0, 1.0);
+            fragColor = mix(color, vec4(selectioncolor.rgb, 1.0), highlight);
+            gl_Position = gl_ModelViewProjectionMatrix* mtx*instanceMatrix*vec4(vert, 1.0);
         }   
 
 
@@ -1041,6 +1441,10 @@ class WireframeModel(object):
         self.vao = None
         self.program = Program(self.vertexshader, self.fragshader)
         self.vbo = VertexPositionBuffer(self.vertexshader.get_location("vert"))
+        self.mtxbuffer = MatrixBuffer(self.vertexshader.get_location("instanceMatrix"))
+        self.extrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
+        self.instances = InstanceSlots()
+        self._count = None
         self.load_lines(modelfile)
 
     def load_lines(self, objfile):
@@ -1066,23 +1470,43 @@ class WireframeModel(object):
         self.vbo.load_data(numpy.array(self.lines, dtype=numpy.float32))
         self.dirty = False
 
-    def bind(self):
+    def upload_instances(self):
+        instances = self.instances
+        if instances.resized:
+            self.mtxbuffer.init()
+            self.mtxbuffer.load_data(instances.matrices)
+            self.extrabuffer.init()
+            self.extrabuffer.load_data(instances.extradata)
+        else:
+            for start, end in instances.dirty_ranges():
+                self.mtxbuffer.init()
+                self.mtxbuffer.update_data(start*4*16, instances.matrices[start:end])
+                self.extrabuffer.init()
+                self.extrabuffer.update_data(start*4, instances.extradata[start:end])
+        instances.reset_dirty()
+
+    def bind_instances(self):
         if not self.program.compiled():
             self.program.compile()
 
         if self.vao is None or self.dirty:
             self.build_mesh()
+        else:
+            glBindVertexArray(self.vao)
 
+        self.upload_instances()
+        self._count = self.instances.count
         self.program.bind()
-        glBindVertexArray(self.vao)
 
     def unbind(self):
         glUseProgram(0)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glBindVertexArray(0)
 
-    def render(self):
-        glDrawArrays(GL_LINES, 0, len(self.lines)//3)
+    def instancedrender(self):
+        if self._count is not None and self._count > 0:
+            glDrawArraysInstanced(GL_LINES, 0, len(self.lines)//3, self._count)
+            render_state.draw_calls += 1
 
 
 class TexturedModel(object):
@@ -0,0 +1,171 @@
+import ctypes
+
+import numpy
+from OpenGL.GL import *
+
+from lib.bw_terrain import TILE_QUADS
+from lib.render.model_renderingv2 import Shader, Program, VertexBuffer, IndexBuffer, render_state
+
+
+# Interleaved terrain vertex, positions are already swapped into the y-up order used for drawing
+TERRAIN_VERTEX_DTYPE = numpy.dtype([
+    ("position", "<f4", (3,)),
+    ("color", "u1", (4,)),
+    ("uv1", "<f4", (2,)),
+    ("uv2", "<f4", (2,))
+])
+
+# Every quad of a tile as two triangles
+TILE_INDICES = numpy.array([index for v1, v2, v3, v4 in TILE_QUADS for index in (v1, v2, v3, v1, v3, v4)],
+                           dtype=numpy.uint32)
+
+
+class TerrainVertexBuffer(VertexBuffer):
+    def __init__(self, vtx_attr_index, color_attr_index, uv1_attr_index, uv2_attr_index):
+        super().__init__()
+        stride = TERRAIN_VERTEX_DTYPE.itemsize
+        fields = TERRAIN_VERTEX_DTYPE.fields
+        self.add_attribute(vtx_attr_index,      3, GL_FLOAT, GL_FALSE, stride, fields["position"][1])
+        self.add_attribute(color_attr_index,    4, GL_UNSIGNED_BYTE, GL_TRUE, stride, fields["color"][1])
+        self.add_attribute(uv1_attr_index,      2, GL_FLOAT, GL_FALSE, stride, fields["uv1"][1])
+        self.add_attribute(uv2_attr_index,      2, GL_FLOAT, GL_FALSE, stride, fields["uv2"][1])
+
+
+def build_terrain_arrays(bwterrain):
+    # Returns the vertices and indices of all tiles and for each material
+    # (material index, offset in bytes, index count) of its range in the indices.
+    # Tiles are grouped by material so every material is a single draw.
+    materials = bwterrain.tile_materials
+    order = numpy.argsort(materials, kind="stable")
+    tilecount = len(order)
+
+    vertices = numpy.empty((tilecount, 16), dtype=TERRAIN_VERTEX_DTYPE)
+    positions = bwterrain.tile_positions[order]
+    vertices["position"][:, :, 0] = positions[:, :, 0]
+    vertices["position"][:, :, 1] = positions[:, :, 2]
+    vertices["position"][:, :, 2] = positions[:, :, 1]
+    vertices["color"] = numpy.rint(bwterrain.tile_colors[order]*255.0)
+    vertices["uv1"] = bwterrain.tile_uv1[order]
+    vertices["uv2"] = bwterrain.tile_uv2[order]
+
+    indices = (numpy.arange(tilecount, dtype=numpy.uint32)[:, numpy.newaxis]*16 + TILE_INDICES).reshape(-1)
+
+    draws = []
+    material_indices, starts, counts = numpy.unique(materials[order], return_index=True, return_counts=True)
+    for material_index, start, count in zip(material_indices.tolist(), starts.tolist(), counts.tolist()):
+        draws.append((material_index, start*len(TILE_INDICES)*4, count*len(TILE_INDICES)))
+
+    return vertices.reshape(-1), indices, draws
+
+
+class TerrainModel(object):
+    def __init__(self):
+        self.vertexshader = Shader.create("""
+#version 330 compatibility
+layout(location = 0) in vec3 vert;
+layout(location = 2) in vec4 color;
+layout(location = 3) in vec2 texCoord1;
+layout(location = 4) in vec2 texCoord2;
+
+out vec2 fragTexCoord1;
+out vec2 fragTexCoord2;
+out vec2 fragOverlayCoord;
+out vec4 fragColor;
+
+void main(void)
+{
+    fragTexCoord1 = texCoord1;
+    fragTexCoord2 = texCoord2;
+    // The overlay texture covers the whole map
+    fragOverlayCoord = (vert.xy + 2048.0)/4096.0;
+    fragColor = color;
+
+    gl_Position = gl_ModelViewProjectionMatrix*vec4(vert, 1.0);
+}
+""")
+
+        self.fragshader = Shader.create("""
+#version 330
+in vec2 fragTexCoord1;
+in vec2 fragTexCoord2;
+in vec2 fragOverlayCoord;
+in vec4 fragColor;
+
+out vec4 finalColor;
+uniform sampler2D tex;
+uniform sampler2D tex2;
+uniform sampler2D overlayTex;
+
+void main (void)
+{
+    vec4 texcolor2 = texture(tex2, fragTexCoord2);
+    vec4 texcolor = texture(tex, fragTexCoord1);
+    vec4 overlaycolor = texture(overlayTex, fragOverlayCoord);
+    float a = fragColor.a * texcolor2.a;
+    vec4 color = a*texcolor2 + (1-a)*texcolor;
+    finalColor = color*vec4(fragColor.rgb, 1)*3*overlaycolor;
+}
+""")
+        self.program = Program(self.vertexshader, self.fragshader)
+        self.vbo = TerrainVertexBuffer(*self.vertexshader.get_locations("vert", "color", "texCoord1", "texCoord2"))
+        self.ibo = IndexBuffer()
+        self.vao = None
+
+        self.draws = []  # (material, offset in bytes, index count)
+
+    def build(self, bwterrain):
+        # The GL context needs to be current
+        vertices, indices, draws = build_terrain_arrays(bwterrain)
+        self.draws = [(bwterrain.materials[material_index], offset, count)
+                      for material_index, offset, count in draws]
+
+        if not self.program.compiled():
+            self.program.compile()
+        if self.vao is None:
+            self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vbo.init()
+        self.vbo.load_data(vertices)
+        self.ibo.init()
+        self.ibo.load_data(indices)
+        glBindVertexArray(0)
+
+    def free(self):
+        if self.vao is not None:
+            glDeleteVertexArrays(1, [self.vao])
+            self.vao = None
+            self.vbo.free()
+            self.ibo.free()
+        self.draws = []
+
+    def render(self, textures, overlaytexture):
+        if self.vao is None:
+            return
+
+        self.program.bind()
+        self.program.set_uniform(glUniform1i, "tex", 0)
+        self.program.set_uniform(glUniform1i, "tex2", 1)
+        self.program.set_uniform(glUniform1i, "overlayTex", 2)
+        glActiveTexture(GL_TEXTURE2)
+        glBindTexture(GL_TEXTURE_2D, overlaytexture.id)
+        glBindVertexArray(self.vao)
+
+        bound1 = bound2 = None
+        for material, offset, count in self.draws:
+            tex1 = textures.get_texture(material.mat1)[1]
+            tex2 = textures.get_texture(material.mat2)[1]
+            if tex1 != bound1:
+                glActiveTexture(GL_TEXTURE0)
+                glBindTexture(GL_TEXTURE_2D, tex1)
+                bound1 = tex1
+            if tex2 != bound2:
+                glActiveTexture(GL_TEXTURE1)
+                glBindTexture(GL_TEXTURE_2D, tex2)
+                bound2 = tex2
+            glDrawElements(GL_TRIANGLES, count, GL_UNSIGNED_INT, ctypes.c_void_p(offset))
+            render_state.draw_calls += 1
+
+        glBindVertexArray(0)
+        glActiveTexture(GL_TEXTURE0)
+        render_state.invalidate()
+        glUseProgram(0)
@@ -0,0 +1,90 @@
+# Fields that searches filter by most often: the object type, its id, resource names and the base of units
+DEFAULT_INDEXED_FIELDS = ("type", "id", "mName", "mBase")
+
+_NO_VALUE = object()
+
+
+class SearchIndex(object):
+    """Inverted index from the values of some fields to the objects that have them. Objects report
+    changes to the fields through BattalionObject.__setattr__ and mark_dirty. Fields that are edited
+    in place without either aren't noticed, so only fields that are reassigned should be indexed."""
+    def __init__(self, fields=DEFAULT_INDEXED_FIELDS):
+        self.fields = tuple(fields)
+        self.values = {field: {} for field in self.fields}  # field -> (value type, value) -> set of objects
+        self.unhashable = {field: set() for field in self.fields}  # Objects that are always a candidate
+        self.objectkeys = {}  # object -> field -> keys of the object's values
+
+    def __len__(self):
+        return len(self.objectkeys)
+
+    def has_field(self, field):
+        return field in self.values
+
+    def add(self, obj):
+        obj._search_index = self
+        self.objectkeys[obj] = {}
+        self.update(obj)
+
+    def remove(self, obj):
+        if obj not in self.objectkeys:
+            return
+        for field in self.fields:
+            self._unlink(obj, field)
+        del self.objectkeys[obj]
+        obj._search_index = None
+
+    def update(self, obj, field=None):
+        # Reindexes one field of the object, or all of them if field is None
+        if obj not in self.objectkeys:
+            return
+        if field is None:
+            for field in self.fields:
+                self._update_field(obj, field)
+        elif field in self.values:
+            self._update_field(obj, field)
+
+    def candidates(self, field, match):
+        # Objects with a value in field for which match is true. match is called once per distinct value.
+        result = set(self.unhashable[field])
+        for (valuetype, value), objects in self.values[field].items():
+            if match(value):
+                result.update(objects)
+        return result
+
+    def _update_field(self, obj, field):
+        self._unlink(obj, field)
+
+        value = getattr(obj, field, _NO_VALUE)
+        if value is _NO_VALUE:
+            return
+        values = value if isinstance(value, list) else (value, )
+
+        try:
+            # The type is part of the key so that e.g. True, 1 and 1.0 don't end up as the same value
+            keys = {(type(val), val) for val in values}
+        except TypeError:
+            self.unhashable[field].add(obj)
+            self.objectkeys[obj][field] = None
+            return
+
+        fieldvalues = self.values[field]
+        for key in keys:
+            objects = fieldvalues.get(key)
+            if objects is None:
+                objects = fieldvalues[key] = set()
+            objects.add(obj)
+        self.objectkeys[obj][field] = keys
+
+    def _unlink(self, obj, field):
+        keys = self.objectkeys[obj].pop(field, ())
+        if keys is None:
+            self.unhashable[field].discard(obj)
+            return
+
+        fieldvalues = self.values[field]
+        for key in keys:
+            objects = fieldvalues[key]
+            objects.discard(obj)
+            if not objects:
+                del fieldvalues[key]
+
@@ -1,5 +1,6 @@
 import re
 import os
+import operator
 from pypeg2 import *
 from numpy import float32
 
@@ -45,6 +46,59 @@ class QueryDepthTooDeepError(Exception):
     pass
 
 
+# Marks a field that doesn't exist or a query value that can't be converted to the type of a field
+MISSING = object()
+
+
+def too_many_values_error(text, count):
+    return QueryDepthTooDeepError("Search term causes too many fields to be expanded! {1}: {0} > 1000".format(count, text))
+
+
+def compile_path(names, text):
+    # Returns a function that does the same as Field.evaluate for the path of field names
+    if len(names) == 0:
+        return lambda obj: [obj]
+
+    name = names[0]
+    if len(names) == 1:
+        def values(obj):
+            curr = getattr(obj, name, MISSING)
+            if curr is MISSING:
+                return []
+            elif isinstance(curr, list):
+                if len(curr) > 1000:
+                    raise too_many_values_error(text, len(curr))
+                return list(curr)
+            else:
+                return [curr]
+    else:
+        remaining = compile_path(names[1:], text)
+
+        def values(obj):
+            curr = getattr(obj, name, MISSING)
+            if curr is MISSING:
+                return []
+            elif isinstance(curr, list):
+                result = []
+                for val in curr:
+                    result.extend(remaining(val))
+            else:
+                result = remaining(curr)
+
+            if len(result) > 1000:
+                raise too_many_values_error(text, len(result))
+            return result
+
+    return values
+
+
+def try_convert(convert, value):
+    try:
+        return convert(value)
+    except (ValueError, AttributeError):
+        return MISSING
+
+
 class Field(List):
     grammar = Keyword("self"), optional(".", word, maybe_some(".", word))
 
@@ -57,6 +111,15 @@ class Field(List):
     def get_values(self, obj):
         return self.evaluate(obj)
 
+    def compile(self):
+        return compile_path(list(self), str(self))
+
+    def compile_values(self):
+        return self.compile()
+
+    def candidates(self, index):
+        return None
+
     def action(self):
         return True
 
@@ -89,7 +152,7 @@ class Field(List):
                 values.extend(self._evaluate_recursive(curr, remainingfields[1:]))
 
         if len(values) > 1000:
-            raise QueryDepthTooDeepError("Search term causes too many fields to be expanded! {1}: {0} > 1000".format(len(values), str(self)))
+            raise too_many_values_error(str(self), len(values))
 
         return values
 
@@ -124,6 +187,7 @@ class Integer(Keyword):
 
 
 class EqualOperator(Keyword):
+    function = staticmethod(operator.eq)
     grammar = Enum(K("="))
     regex = re.compile(r"[=]+")
 
@@ -136,6 +200,7 @@ class EqualOperator(Keyword):
 
 
 class UnequalOperator(Keyword):
+    function = staticmethod(operator.ne)
     grammar = Enum(K("!="))
     regex = re.compile(r"[!=]+")
 
@@ -148,6 +213,7 @@ class UnequalOperator(Keyword):
 
 
 class Less(Keyword):
+    function = staticmethod(operator.lt)
     grammar = Enum(K("<"))
     regex = re.compile(r"[<]")
 
@@ -160,6 +226,7 @@ class Less(Keyword):
 
 
 class LessEqual(Keyword):
+    function = staticmethod(operator.le)
     grammar = Enum(K("<="))
     regex = re.compile(r"[<=]+")
 
@@ -172,6 +239,7 @@ class LessEqual(Keyword):
 
 
 class Greater(Keyword):
+    function = staticmethod(operator.gt)
     grammar = Enum(K(">"))
     regex = re.compile(r"[>]")
 
@@ -184,6 +252,7 @@ class Greater(Keyword):
 
 
 class GreaterEqual(Keyword):
+    function = staticmethod(operator.ge)
     grammar = Enum(K(">="))
     regex = re.compile(r"[>=]+")
 
@@ -225,7 +294,42 @@ class Or(Keyword):
         return a or b
 
 
-class StringContentCheck(List):
+class FieldComparison(List):
+    # A comparison is true if one of the values of the field matches. Subclasses define compile_match,
+    # which returns the function that checks a single value.
+
+    def compile(self):
+        values = self[0].compile()
+        match = self.compile_match()
+
+        def evaluate(obj):
+            for val in values(obj):
+                if match(val):
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        return self[0].compile()
+
+    def candidates(self, index):
+        # Only a value of the field can match, so the objects with a matching value in the index are the
+        # only ones that can match. Further fields are checked on the distinct values of the indexed field.
+        field = self[0]
+        if len(field) == 0 or not index.has_field(field[0]):
+            return None
+
+        match = self.compile_match()
+        if len(field) > 1:
+            values = compile_path(list(field[1:]), str(field))
+            match_value = match
+            match = lambda key: any(match_value(val) for val in values(key))
+
+        return index.candidates(field[0], match)
+
+
+class StringContentCheck(FieldComparison):
     grammar = Field, maybe_some(whitespace), [Contains, Excludes], maybe_some(whitespace), Value
 
     def evaluate(self, obj):
@@ -251,11 +355,22 @@ class StringContentCheck(List):
 
             return result
 
+    def compile_match(self):
+        excludes = isinstance(self[1], Excludes)
+        text = self[2].lower()
+
+        def match(val):
+            if not isinstance(val, str):
+                return False
+            return (text not in val.lower()) if excludes else (text in val.lower())
+
+        return match
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
 
-class Equal(List):
+class Equal(FieldComparison):
     grammar = Field, maybe_some(whitespace), [EqualOperator, UnequalOperator], maybe_some(whitespace), [DecimalNumber, Value]
 
     def evaluate(self, obj):
@@ -287,11 +402,33 @@ class Equal(List):
 
             return result
 
+    def compile_match(self):
+        op = self[1].function
+        text = str(self[2])
+        isnone = text.lower() in ("none", "0")
+        boolvalue = try_convert(lambda value: value.convert_bool(), self[2])
+        intvalue = try_convert(lambda value: value.convert(), self[2])
+        floatvalue = try_convert(float, self[2])
+
+        def match(val):
+            if val is None and isnone:
+                return op(val, None)
+            elif isinstance(val, bool):
+                return boolvalue is not MISSING and op(val, boolvalue)
+            elif isinstance(val, int):
+                return intvalue is not MISSING and op(val, intvalue)
+            elif isinstance(val, (float, float32)):
+                return floatvalue is not MISSING and op(val, floatvalue)
+            else:
+                return op(val, text)
+
+        return match
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
 
-class NumberCompare(List):
+class NumberCompare(FieldComparison):
     grammar = Field, maybe_some(whitespace), [UnequalOperator, EqualOperator, LessEqual, Less, GreaterEqual, Greater], maybe_some(whitespace), [DecimalNumber, Integer]
 
     def evaluate(self, obj):
@@ -322,6 +459,23 @@ class NumberCompare(List):
 
             return result
 
+    def compile_match(self):
+        op = self[1].function
+        intvalue = self[2].convert()
+        floatvalue = float(self[2])
+
+        def match(val):
+            if isinstance(val, str) and val.isdigit():
+                val = int(val)
+            if isinstance(val, int):
+                return op(val, intvalue)
+            elif isinstance(val, (float, float32)):
+                return op(val, floatvalue)
+            else:
+                return False
+
+        return match
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
@@ -335,25 +489,39 @@ class Comparison(List):
     def get_values(self, obj):
         return self[0].get_values(obj)
 
+    def compile(self):
+        return self[0].compile()
+
+    def compile_values(self):
+        return self[0].compile_values()
+
+    def candidates(self, index):
+        return self[0].candidates(index)
+
 
 class AndOrUnit(List):
     grammar = [Comparison, Field], maybe_some(maybe_some(whitespace), [And, Or], maybe_some(whitespace), [Comparison, Field])
 
+    def and_groups(self):
+        andunits = []
+        currunit = []
+
+        for unit in self:
+            if isinstance(unit, Or):
+                andunits.append(currunit)
+                currunit = []
+            elif not isinstance(unit, And):
+                currunit.append(unit)
+        else:
+            andunits.append(currunit)
+
+        return andunits
+
     def evaluate(self, obj):
         if len(self) == 1:
             return self[0].evaluate(obj)
         else:
-            andunits = []
-            currunit = []
-
-            for unit in self:
-                if isinstance(unit, Or):
-                    andunits.append(currunit)
-                    currunit = []
-                elif not isinstance(unit, And):
-                    currunit.append(unit)
-            else:
-                andunits.append(currunit)
+            andunits = self.and_groups()
 
             result = False
             for andunit in andunits:
@@ -376,6 +544,53 @@ class AndOrUnit(List):
 
         return values
 
+    def compile(self):
+        if len(self) == 1:
+            return self[0].compile()
+
+        andunits = [[unit.compile() for unit in andunit] for andunit in self.and_groups()]
+
+        def evaluate(obj):
+            for andunit in andunits:
+                for unit in andunit:
+                    if unit(obj) is False:
+                        break
+                else:
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        functions = [unit.compile_values() for unit in self if hasattr(unit, "get_values")]
+
+        def get_values(obj):
+            values = []
+            for function in functions:
+                values.extend(function(obj))
+            return values
+
+        return get_values
+
+    def candidates(self, index):
+        # Union of the AND groups, a group can only match objects that match all of its indexed comparisons
+        if len(self) == 1:
+            return self[0].candidates(index)
+
+        result = set()
+        for andunit in self.and_groups():
+            unitcandidates = None
+            for unit in andunit:
+                candidates = unit.candidates(index)
+                if candidates is not None:
+                    unitcandidates = candidates if unitcandidates is None else unitcandidates & candidates
+
+            if unitcandidates is None:
+                return None
+            result |= unitcandidates
+
+        return result
+
 
 class BracketedUnit(List):
     grammar = "(", AndOrUnit, ")"
@@ -391,6 +606,15 @@ class BracketedUnit(List):
 
         return values
 
+    def compile(self):
+        return self[0].compile()
+
+    def compile_values(self):
+        return self[0].compile_values()
+
+    def candidates(self, index):
+        return self[0].candidates(index)
+
 
 class QueryGrammar(AndOrUnit):
     grammar = [BracketedUnit, AndOrUnit], maybe_some(maybe_some(whitespace), [And, Or], maybe_some(whitespace), [BracketedUnit, AndOrUnit])
@@ -422,6 +646,31 @@ def create_query(querytext):
     return parse(querytext, QueryGrammar)
 
 
+class CompiledQuery(object):
+    """Query turned into functions once, so searching doesn't need to walk the query for every object."""
+    def __init__(self, query: QueryGrammar):
+        self.query = query
+        self.evaluate = query.compile()
+        self.get_values = query.compile_values()
+
+    def search(self, objects, index=None):
+        # Returns (object, values) of the matching objects in the order of objects. With a SearchIndex
+        # only objects that the index can't rule out are evaluated.
+        candidates = None if index is None else self.query.candidates(index)
+
+        result = []
+        for obj in objects:
+            if candidates is not None and obj not in candidates:
+                continue
+            if self.evaluate(obj):
+                result.append((obj, self.get_values(obj)))
+        return result
+
+
+def compile_query(querytext):
+    return CompiledQuery(create_query(querytext))
+
+
 # Levenshtein distance implemented according to https://en.wikipedia.org/wiki/Levenshtein_distance
 def tail(a):
     if len(a) == 1:
@@ -0,0 +1,87 @@
+class SelectionSet(object):
+    """List-like container for the selection that keeps insertion order but does membership
+    tests in constant time. Additions and removals are recorded until take_changes() is called
+    so that listeners can update for what changed instead of the whole selection."""
+    def __init__(self, items=()):
+        self._items = {}
+        self._added = {}
+        self._removed = {}
+        self.extend(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __getitem__(self, index):
+        if index == 0 and self._items:
+            return next(iter(self._items))
+        return list(self._items)[index]
+
+    def __repr__(self):
+        return "SelectionSet({0})".format(list(self._items))
+
+    def _record_added(self, item):
+        if item in self._removed:
+            del self._removed[item]
+        else:
+            self._added[item] = True
+
+    def _record_removed(self, item):
+        if item in self._added:
+            del self._added[item]
+        else:
+            self._removed[item] = True
+
+    def append(self, item):
+        if item not in self._items:
+            self._items[item] = True
+            self._record_added(item)
+
+    add = append
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def remove(self, item):
+        if item not in self._items:
+            raise ValueError("{0} is not selected".format(item))
+        self.discard(item)
+
+    def discard(self, item):
+        if item in self._items:
+            del self._items[item]
+            self._record_removed(item)
+
+    def clear(self):
+        for item in self._items:
+            self._record_removed(item)
+        self._items = {}
+
+    def replace(self, items):
+        # Takes over the order of items, only what isn't in both counts as a change
+        items = dict.fromkeys(items, True)
+        for item in self._items:
+            if item not in items:
+                self._record_removed(item)
+        for item in items:
+            if item not in self._items:
+                self._record_added(item)
+        self._items = items
+
+    def index(self, item):
+        if item not in self._items:
+            raise ValueError("{0} is not selected".format(item))
+        return list(self._items).index(item)
+
+    def take_changes(self):
+        # Returns (added, removed) since the last call
+        added, removed = list(self._added), list(self._removed)
+        self._added = {}
+        self._removed = {}
+        return added, removed
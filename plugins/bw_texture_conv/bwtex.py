@@ -321,7 +321,8 @@ class BW2Texture(Texture):
         #tex.mipmaps.append(f.read(size))
         print(section, hex(size))
         print(hex(f.tell()))
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        # decode_image zero pads mip data that is shorter than the last block row
+        imagedata = BytesIO(f.read(size))
         
         #assert size == len(imagedata.getbuffer())
         print(FORMAT[tex.fmt], hex(size), tex.size_x, tex.size_y)
@@ -339,7 +340,7 @@ class BW2Texture(Texture):
             section = read_id(f)
             size = read_uint32_le(f)
             assert section == MIP
-            imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+            imagedata = BytesIO(f.read(size))
             mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
             mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
             #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
@@ -567,7 +568,8 @@ class BW1Texture(Texture):
         #tex.mipmaps.append(f.read(size))
         print(section, hex(size))
         print(hex(f.tell()))
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        # decode_image zero pads mip data that is shorter than the last block row
+        imagedata = BytesIO(f.read(size))
         
         #assert size == len(imagedata.getbuffer())
         #print(FORMAT[tex.fmt], hex(size), tex.size_x, tex.size_y)
@@ -585,7 +587,7 @@ class BW1Texture(Texture):
             section = read_id(f)
             size = read_uint32_le(f)
             assert section == MIP
-            imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+            imagedata = BytesIO(f.read(size))
             mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
             mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
             #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
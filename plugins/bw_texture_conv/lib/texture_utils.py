@@ -5,6 +5,8 @@ import colorsys
 from enum import Enum
 import operator
 
+import numpy
+
 from .fs_helpers import *
 
 try:
@@ -604,37 +606,166 @@ def encode_palette(encoded_colors, palette_format, image_format):
 
 
 def decode_image(image_data, palette_data, image_format, palette_format, num_colors, image_width, image_height):
-  colors = decode_palettes(palette_data, palette_format, num_colors, image_format)
+  pixels = decode_image_array(image_data, palette_data, image_format, palette_format, num_colors, image_width, image_height)
+  return Image.fromarray(pixels, "RGBA")
+
+def decode_image_array(image_data, palette_data, image_format, palette_format, num_colors, image_width, image_height):
+  # Decodes all blocks at once with numpy and returns a (height, width, 4) RGBA array.
+  if not isinstance(image_format, ImageFormat):
+    raise Exception("Invalid image format: %s" % image_format)
   
   block_width = BLOCK_WIDTHS[image_format]
   block_height = BLOCK_HEIGHTS[image_format]
   block_data_size = BLOCK_DATA_SIZES[image_format]
   
-  image = Image.new("RGBA", (image_width, image_height), (0, 0, 0, 0))
-  pixels = image.load()
-  offset = 0
-  block_x = 0
-  block_y = 0
-  while block_y < image_height:
-    pixel_color_data = decode_block(image_format, image_data, offset, block_data_size, colors)
-    
-    for i, color in enumerate(pixel_color_data):
-      x_in_block = i % block_width
-      y_in_block = i // block_width
-      x = block_x+x_in_block
-      y = block_y+y_in_block
-      if x >= image_width or y >= image_height:
-        continue
-      
-      pixels[x,y] = color
-    
-    offset += block_data_size
-    block_x += block_width
-    if block_x >= image_width:
-      block_x = 0
-      block_y += block_height
+  blocks_x = (image_width + block_width - 1)//block_width
+  blocks_y = (image_height + block_height - 1)//block_height
+  num_blocks = blocks_x*blocks_y
   
-  return image
+  raw = numpy.frombuffer(read_all_bytes(image_data), dtype=numpy.uint8)
+  if len(raw) < num_blocks*block_data_size:
+    raw = numpy.concatenate((raw, numpy.zeros(num_blocks*block_data_size - len(raw), dtype=numpy.uint8)))
+  blocks = raw[:num_blocks*block_data_size].reshape((num_blocks, block_data_size))
+  
+  if image_format in IMAGE_FORMATS_THAT_USE_PALETTES:
+    colors = decode_palettes_array(palette_data, palette_format, num_colors)
+  else:
+    colors = None
+  
+  # Each block decodes to a (num_blocks, block_height*block_width, 4) array in row-major pixel order.
+  pixel_color_data = decode_blocks_array(image_format, blocks, colors)
+  
+  pixels = pixel_color_data.reshape((blocks_y, blocks_x, block_height, block_width, 4))
+  pixels = pixels.transpose((0, 2, 1, 3, 4)).reshape((blocks_y*block_height, blocks_x*block_width, 4))
+  
+  return numpy.ascontiguousarray(pixels[:image_height, :image_width])
+
+def decode_palettes_array(palette_data, palette_format, num_colors):
+  raw = numpy.frombuffer(read_all_bytes(palette_data), dtype=">u2", count=num_colors)
+  return decode_colors_array(raw, palette_format)
+
+def decode_colors_array(raw_colors, palette_format):
+  if palette_format == PaletteFormat.IA8:
+    return convert_ia8_to_colors(raw_colors)
+  elif palette_format == PaletteFormat.RGB565:
+    return convert_rgb565_to_colors(raw_colors)
+  elif palette_format == PaletteFormat.RGB5A3:
+    return convert_rgb5a3_to_colors(raw_colors)
+  else:
+    raise Exception("Unknown palette format: %s" % palette_format)
+
+def make_colors_array(r, g, b, a):
+  colors = numpy.empty(r.shape + (4,), dtype=numpy.uint8)
+  colors[..., 0] = r
+  colors[..., 1] = g
+  colors[..., 2] = b
+  colors[..., 3] = a
+  return colors
+
+def convert_rgb565_to_colors(rgb565):
+  rgb565 = rgb565.astype(numpy.uint16)
+  r = swizzle_5_bit_to_8_bit((rgb565 >> 11) & 0x1F)
+  g = swizzle_6_bit_to_8_bit((rgb565 >> 5) & 0x3F)
+  b = swizzle_5_bit_to_8_bit((rgb565 >> 0) & 0x1F)
+  return make_colors_array(r, g, b, 255)
+
+def convert_rgb5a3_to_colors(rgb5a3):
+  rgb5a3 = rgb5a3.astype(numpy.uint16)
+  opaque = (rgb5a3 & 0x8000) != 0
+  
+  r = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 10) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 8) & 0xF)
+  )
+  g = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 5) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 4) & 0xF)
+  )
+  b = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 0) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 0) & 0xF)
+  )
+  a = numpy.where(opaque, 255, swizzle_3_bit_to_8_bit((rgb5a3 >> 12) & 0x7))
+  return make_colors_array(r, g, b, a)
+
+def convert_ia8_to_colors(ia8):
+  ia8 = ia8.astype(numpy.uint16)
+  l = ia8 & 0xFF
+  return make_colors_array(l, l, l, (ia8 >> 8) & 0xFF)
+
+def split_nibbles(blocks):
+  # High nibble comes first
+  nibbles = numpy.empty((blocks.shape[0], blocks.shape[1]*2), dtype=numpy.uint8)
+  nibbles[:, 0::2] = blocks >> 4
+  nibbles[:, 1::2] = blocks & 0xF
+  return nibbles
+
+def lookup_palette_colors(colors, color_indexes):
+  # Indexes past the end of the palette come from blocks that bleed past the
+  # edge of the image and are left transparent.
+  palette = numpy.zeros((max(len(colors), int(color_indexes.max(initial=0)) + 1), 4), dtype=numpy.uint8)
+  palette[:len(colors)] = colors
+  return palette[color_indexes]
+
+def decode_blocks_array(image_format, blocks, colors):
+  if image_format == ImageFormat.I4:
+    i8 = swizzle_4_bit_to_8_bit(split_nibbles(blocks))
+    return make_colors_array(i8, i8, i8, i8)
+  elif image_format == ImageFormat.I8:
+    return make_colors_array(blocks, blocks, blocks, blocks)
+  elif image_format == ImageFormat.IA4:
+    l = swizzle_4_bit_to_8_bit(blocks & 0xF)
+    return make_colors_array(l, l, l, swizzle_4_bit_to_8_bit(blocks >> 4))
+  elif image_format == ImageFormat.IA8:
+    return make_colors_array(blocks[:, 1::2], blocks[:, 1::2], blocks[:, 1::2], blocks[:, 0::2])
+  elif image_format == ImageFormat.RGB565:
+    return convert_rgb565_to_colors(blocks.view(">u2"))
+  elif image_format == ImageFormat.RGB5A3:
+    return convert_rgb5a3_to_colors(blocks.view(">u2"))
+  elif image_format == ImageFormat.RGBA32:
+    ar = blocks[:, 0:32].reshape((-1, 16, 2))
+    gb = blocks[:, 32:64].reshape((-1, 16, 2))
+    return make_colors_array(ar[..., 1], gb[..., 0], gb[..., 1], ar[..., 0])
+  elif image_format == ImageFormat.C4:
+    return lookup_palette_colors(colors, split_nibbles(blocks))
+  elif image_format == ImageFormat.C8:
+    return lookup_palette_colors(colors, blocks)
+  elif image_format == ImageFormat.C14X2:
+    return lookup_palette_colors(colors, blocks.view(">u2") & 0x3FFF)
+  elif image_format == ImageFormat.CMPR:
+    return decode_cmpr_blocks_array(blocks)
+  else:
+    raise Exception("Unknown image format: %s" % image_format.name)
+
+def decode_cmpr_blocks_array(blocks):
+  num_blocks = blocks.shape[0]
+  # Every block has 4 DXT1 subblocks of 8 bytes: two RGB565 key colors followed by 16 2-bit indexes.
+  subblocks = blocks.reshape((num_blocks, 4, 8))
+  color_0_rgb565 = subblocks[:, :, 0:2].copy().view(">u2")[..., 0]
+  color_1_rgb565 = subblocks[:, :, 2:4].copy().view(">u2")[..., 0]
+  color_indexes = subblocks[:, :, 4:8].copy().view(">u4")[..., 0]
+  
+  color_0 = convert_rgb565_to_colors(color_0_rgb565).astype(numpy.int32)
+  color_1 = convert_rgb565_to_colors(color_1_rgb565).astype(numpy.int32)
+  
+  four_colors = (color_0_rgb565 > color_1_rgb565)[..., None]
+  color_2 = numpy.where(four_colors, (2*color_0 + 1*color_1)//3, color_0//2 + color_1//2)
+  color_3 = numpy.where(four_colors, (1*color_0 + 2*color_1)//3, 0)
+  color_2[..., 3] = 255
+  color_3[..., 3] = numpy.where(four_colors[..., 0], 255, 0)
+  
+  palettes = numpy.stack((color_0, color_1, color_2, color_3), axis=2).astype(numpy.uint8)
+  
+  shifts = numpy.arange(15, -1, -1, dtype=numpy.uint32)*2
+  indexes = (color_indexes[..., None] >> shifts) & 3
+  
+  # (block, subblock, pixel in subblock, rgba) -> 8x8 block in row-major order
+  subblock_colors = numpy.take_along_axis(palettes, indexes[..., None].astype(numpy.intp), axis=2)
+  subblock_colors = subblock_colors.reshape((num_blocks, 2, 2, 4, 4, 4))
+  return subblock_colors.transpose((0, 1, 3, 2, 4, 5)).reshape((num_blocks, 64, 4))
 
 def decode_block(image_format, image_data, offset, block_data_size, colors):
   if image_format == ImageFormat.I4:
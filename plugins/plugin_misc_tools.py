@@ -326,7 +326,7 @@ class Plugin(object):
                 while newid in newids:
                     newid = random.randint(1, 800000)
 
-                obj._node.attrib["id"] = str(newid)
+                obj.set_id(newid)
                 assert newid not in newids
                 newids[newid] = True
 
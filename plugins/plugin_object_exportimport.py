@@ -13,7 +13,7 @@ from collections import namedtuple
 
 import lib.lua.bwarchivelib as bwarchivelib
 from lib.lua.bwarchivelib import BattalionArchive
-from lib.BattalionXMLLib import BattalionLevelFile, BattalionObject
+from lib.BattalionXMLLib import BattalionLevelFile, BattalionObject, calc_hashes_recursive
 from widgets.editor_widgets import open_error_dialog, open_message_dialog, open_yesno_box
 from widgets.graphics_widgets import UnitViewer
 from plugins.plugin_padding import YesNoQuestionDialog
@@ -39,7 +39,7 @@ def replace_references(obj, replacement_map):
                 for i in range(len(pointers)):
                     if pointers[i] is not None:
                         if pointers[i].id in replacement_map:
-                            pointers[i] = replacement_map[pointers[i].id]
+                            obj.set_element(attr_node.attrib["name"], i, replacement_map[pointers[i].id])
             else:
                 if pointers is not None and pointers.id in replacement_map:
                     setattr(obj, attr_node.attrib["name"], replacement_map[pointers.id])
@@ -1001,7 +1001,7 @@ class Plugin(object):
 
                         for i in range(len(obj.mPassenger)):
                             print("skipping passenger", obj.name, obj.mPassenger[i])
-                            obj.mPassenger[i] = None
+                            obj.set_element("mPassenger", i, None)
 
                 if not include_startwaypoint:
                     if hasattr(obj, "mStartWaypoint"):
@@ -1118,18 +1118,17 @@ class Plugin(object):
         bundlename = os.path.basename(bundlepath)
         bundle.resolve_pointers(None)
 
+        # Do not reuse existing seatbases
+        level_objects = [obj for obj in editor.level_file.objects.values() if obj.type != "cSeatBase"]
+        level_hashes = calc_hashes_recursive(level_objects)
         hashed_objects = {}
-        for id, obj in editor.level_file.objects.items():
-            if obj.type == "cSeatBase":
-                # Do not reuse existing seatbases
-                continue
-            else:
-                hash = obj.calc_hash_recursive()
-                hashed_objects[hash] = obj
+        for obj in level_objects:
+            hashed_objects[level_hashes[obj]] = obj
 
+        bundle_hashes = calc_hashes_recursive(bundle.objects.values())
         reference_remap = {}
         for id, obj in bundle.objects.items():
-            hash = obj.calc_hash_recursive()
+            hash = bundle_hashes[obj]
             if hash in hashed_objects:
                 print(obj.name, "will be remaped to", hashed_objects[hash].name)
                 reference_remap[obj.id] = hashed_objects[hash]
@@ -1137,7 +1136,7 @@ class Plugin(object):
         for id, obj in bundle.objects.items():
             replace_references(obj, reference_remap)
 
-        visited = []
+        visited = set()
         to_visit = []
         roots = []
         for id, obj in bundle.objects.items():
@@ -1148,9 +1147,8 @@ class Plugin(object):
                 roots.append(obj)
 
         while len(to_visit) > 0:
-            next = to_visit.pop(0)
-            if next not in visited:
-                visited.append(next)
+            next = to_visit.pop()
+            visited.add(next)
             for ref in next.references:
                 if ref not in visited:
                     to_visit.append(ref)
@@ -1180,10 +1178,12 @@ class Plugin(object):
         update_textures = []
         objects_actually_added = []
 
+        # The references were remapped so these can differ from bundle_hashes
+        to_add_hashes = calc_hashes_recursive(to_add)
         for obj in to_add:
             assert not obj.is_preload(), "Preload Object Import not supported"
 
-            if obj.calc_hash_recursive() in hashed_objects:
+            if to_add_hashes[obj] in hashed_objects:
                 print(obj.name, "has already been added")
 
                 resource = None
@@ -56,9 +56,7 @@ class Plugin(object):
                 preload_notice = ", padding update necessary"
             preload_pad = f"{round(preload_pad/1024, 2)} KiB"
 
-        tmp = BytesIO()
-        editor.file_menu.resource_archive.write(tmp)
-        res_size = len(tmp.getvalue())
+        res_size = editor.file_menu.resource_archive.packed_size()
         res_notice = ""
         if res_padding is not None:
             if res_size > res_padding:
@@ -185,10 +183,7 @@ class Plugin(object):
                 editor.file_menu.level_paths.clear_res_padding()
                 editor.set_has_unsaved_changes(True)
             else:
-                tmp = BytesIO()
-                editor.file_menu.resource_archive.write(tmp)
-                size = len(tmp.getvalue())
-                del tmp
+                size = editor.file_menu.resource_archive.packed_size()
 
                 padding = int(size*(1+value/100.0))
                 editor.file_menu.level_paths.set_res_padding(padding)
@@ -8,6 +8,7 @@ from math import ceil, floor
 from OpenGL.GL import *
 import struct
 import traceback
+import numpy
 #from lib.bw.texture import OpenGLTexture
 from lib.model_rendering import TexturedMesh
 from PIL import Image
@@ -592,8 +593,8 @@ class Plugin(object):
         self.edge_template = PathEdge(0, 0, 0)
 
     def gen_gradient_map(self, editor: "bw_editor.LevelEditor"):
-        check_height = editor.level_view.bwterrain.check_height_interpolate
-        res = 512.0
+        check_heights = editor.level_view.bwterrain.check_heights_interpolate
+        res = 512
         step = 4096/res
 
         start_x = -2048 - 2*step
@@ -617,60 +618,38 @@ class Plugin(object):
         boundary_end_z = boundary.mMatrix.z + boundary.mSize.z / 2.0
         print(boundary_start_x)
 
-        def calc_gradient(x, y):
-            curr = (start_x + x * step, start_y + y * step)
-            curr_up = (start_x + (x + 1) * step, start_y + y * step)
-            curr_right = (start_x + x * step, start_y + (y + 1) * step)
-            curr_upright = (start_x + (x+1) * step, start_y + (y + 1) * step)
-
-            curr_height = check_height(*curr)
-            up_height = check_height(*curr_up)
-            right_height = check_height(*curr_right)
-            upright_height = check_height(*curr_upright)
-
-            if curr_height is None or curr_height < waterheight:
-                curr_height = 0
-            if up_height is None:
-                up_height = curr_height
-            if right_height is None:
-                right_height = curr_height
-            if right_height is None:
-                right_height = curr_height
-
-        for x in range(int(res)):
-            for y in range(int(res)):
-                curr = (start_x + x*step, start_y + y*step)
-                curr_up = (start_x + (x+1)*step, start_y + y*step)
-                curr_right = (start_x + x*step, start_y + (y+1)*step)
-                curr_upright = (start_x + (x + 1) * step, start_y + (y + 1) * step)
-                if (not boundary_start_x <= curr[0] <= boundary_end_x
-                        or not boundary_start_z <= curr[1] <= boundary_end_z):
-                    continue
-
-                curr_height = check_height(*curr)
-                up_height = check_height(*curr_up)
-                right_height = check_height(*curr_right)
-                upright_height = check_height(*curr_upright)
-
-                if curr_height is None or curr_height < waterheight:
-                    curr_height = 0
-                    #img_data.putpixel((x, y), (0xAA, 0xAA, 0xAA))
-                    self.pfd.set_map_val(x, y, 0xAA)
-                    continue
-                if up_height is None:
-                    up_height = curr_height
-                if right_height is None:
-                    right_height = curr_height
-                if curr_upright is None:
-                    curr_upright = curr_height
-
-                gradient_up = abs(curr_height - up_height)/step
-                gradient_right = abs(curr_height - right_height)/step
-                gradient_upright = abs(curr_height - upright_height)/step
-                gradient = max(gradient_up, gradient_right, gradient_upright)
-                v = max(0, min(int((round(gradient, 1)-0.1) *300), 255))
-
-                self.pfd.set_map_val(x, y, v)
+        # All cells are calculated at once, indexed as [y, x] like the gradient map
+        y, x = numpy.mgrid[0:res, 0:res]
+        curr_x = start_x + x*step
+        curr_y = start_y + y*step
+        next_x = start_x + (x+1)*step
+        next_y = start_y + (y+1)*step
+
+        curr_height = check_heights(curr_x, curr_y)
+        up_height = check_heights(next_x, curr_y)
+        right_height = check_heights(curr_x, next_y)
+        upright_height = check_heights(next_x, next_y)
+
+        in_boundary = ((boundary_start_x <= curr_x) & (curr_x <= boundary_end_x)
+                       & (boundary_start_z <= curr_y) & (curr_y <= boundary_end_z))
+        no_ground = numpy.isnan(curr_height) | (curr_height < waterheight)
+
+        up_height = numpy.where(numpy.isnan(up_height), curr_height, up_height)
+        right_height = numpy.where(numpy.isnan(right_height), curr_height, right_height)
+        upright_height = numpy.where(numpy.isnan(upright_height), curr_height, upright_height)
+
+        gradient_up = numpy.abs(curr_height - up_height)/step
+        gradient_right = numpy.abs(curr_height - right_height)/step
+        gradient_upright = numpy.abs(curr_height - upright_height)/step
+        gradient = numpy.maximum(numpy.maximum(gradient_up, gradient_right), gradient_upright)
+        with numpy.errstate(invalid="ignore"):
+            values = numpy.clip(numpy.trunc((numpy.round(gradient, 1)-0.1)*300), 0, 255)
+
+        gradient_map = numpy.frombuffer(self.pfd.gradient_map, dtype=numpy.uint8).reshape(res, res).copy()
+        gradient_map[in_boundary & no_ground] = 0xAA
+        valid = in_boundary & ~no_ground
+        gradient_map[valid] = values[valid]
+        self.pfd.gradient_map[:] = gradient_map.tobytes()
 
     def testfunc(self, editor: "bw_editor.LevelEditor"):
         path, _ = QtWidgets.QFileDialog.getOpenFileName(editor,
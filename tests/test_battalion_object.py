@@ -0,0 +1,193 @@
+# Checks that objects keep the reverse reference index of the objects they point to up to date
+from io import BytesIO
+
+import pytest
+
+from lib.BattalionXMLLib import BattalionLevelFile, calc_hashes_recursive
+
+
+def make_level():
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', "<Instances>"]
+    for i in range(4):
+        lines.append('<Object type="sTroopBase" id="{0}">'.format(100 + i))
+        lines.append('<Attribute name="mName" type="cFxString8" elements="1"><Item>Base_{0}</Item></Attribute>'.format(i))
+        lines.append('<Resource name="mBAN_Model" type="cNodeHierarchyResource" elements="1"><Item>0</Item></Resource>')
+        lines.append("</Object>")
+
+    lines.append('<Object type="cTroop" id="200">')
+    lines.append('<Attribute name="mName" type="cFxString8" elements="1"><Item>Unit</Item></Attribute>')
+    lines.append('<Attribute name="Mat" type="sMatrix4x4" elements="1"><Item>1.0,0.0,0.0,0.0, 0.0,1.0,0.0,0.0, '
+                 '0.0,0.0,1.0,0.0, 10.0,0.0,20.0,1.0</Item></Attribute>')
+    lines.append('<Pointer name="mBase" type="sTroopBase" elements="1"><Item>100</Item></Pointer>')
+    lines.append('<Pointer name="mOther" type="sTroopBase" elements="1"><Item>0</Item></Pointer>')
+    lines.append('<Pointer name="mBases" type="sTroopBase" elements="3"><Item>101</Item><Item>101</Item>'
+                 '<Item>102</Item></Pointer>')
+    lines.append("</Object>")
+    lines.append("</Instances>")
+
+    level = BattalionLevelFile(BytesIO("\n".join(lines).encode("utf-8")))
+    level.resolve_pointers(None)
+    return level
+
+
+@pytest.fixture
+def level():
+    return make_level()
+
+
+def bases(level):
+    return [level.objects[str(100 + i)] for i in range(4)]
+
+
+def test_resolved_references(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+    assert base0.referenced_by == [unit]
+    assert base1.referenced_by == [unit]
+    assert base2.referenced_by == [unit]
+    assert base3.referenced_by == []
+
+
+def test_reassign_pointer(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    unit.mBase = base3
+    assert base0.referenced_by == []
+    assert base3.referenced_by == [unit]
+
+    # Still pointed to through mBase
+    unit.mOther = base3
+    unit.mOther = None
+    assert base3.referenced_by == [unit]
+
+    unit.mBase = None
+    assert base3.referenced_by == []
+
+
+def test_reassign_pointer_list(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    unit.mBases = [base1, None, base3]
+    assert base1.referenced_by == [unit]
+    assert base2.referenced_by == []
+    assert base3.referenced_by == [unit]
+
+
+def test_set_element(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    # base1 is in the list twice
+    unit.set_element("mBases", 0, base3)
+    assert unit.mBases == [base3, base1, base2]
+    assert base1.referenced_by == [unit]
+    assert base3.referenced_by == [unit]
+
+    unit.set_element("mBases", 1, None)
+    assert base1.referenced_by == []
+
+
+def test_delete_objects(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    level.delete_objects([base1, base0])
+    assert unit.mBase is None
+    assert unit.mBases == [None, None, base2]
+    assert base2.referenced_by == [unit]
+
+    level.delete_objects([unit])
+    assert base2.referenced_by == []
+
+
+def test_hashes_keep_references(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    unit.set_element("mBases", 2, None)
+    before = {obj: set(obj._referenced_by) for obj in level.objects.values()}
+    hashes = calc_hashes_recursive([unit])
+    assert {obj: set(obj._referenced_by) for obj in level.objects.values()} == before
+    assert base2.referenced_by == []
+
+    # Changes to pointed to objects and to pointer lists change the recursive hash
+    base1.mName = "Renamed"
+    assert calc_hashes_recursive([unit])[unit] != hashes[unit]
+    hashes = calc_hashes_recursive([unit])
+    unit.set_element("mBases", 2, base3)
+    assert calc_hashes_recursive([unit])[unit] != hashes[unit]
+
+
+def test_no_instance_dict(level):
+    # Fields and editor state are all kept in slots
+    for obj in level.objects.values():
+        assert obj.__dict__ == {}
+
+
+def test_serialize_cached(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+
+    xml = unit.serialize()
+    assert not unit.is_xml_dirty()
+    assert unit.serialize() is xml
+
+    unit.set_element("mBases", 2, base3)
+    assert unit.is_xml_dirty()
+    assert b"<Item>103</Item>" in unit.serialize()
+    assert not unit.is_xml_dirty()
+
+
+def test_set_id_marks_referrers(level):
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+    for obj in level.objects.values():
+        obj.serialize()
+
+    base0.set_id(150)
+    assert base0.id == "150"
+    assert base0.is_xml_dirty()
+    assert unit.is_xml_dirty()
+    assert not base1.is_xml_dirty()
+
+    out = BytesIO()
+    level.write(out)
+    assert b'<Object type="sTroopBase" id="150">' in out.getvalue()
+    assert b'<Pointer name="mBase" type="sTroopBase" elements="1"><Item>150</Item></Pointer>' in out.getvalue()
+
+
+def test_cloned_pointer_list(level):
+    # Like cloning a unit with its passengers: the clone's list gets copies of the pointed to objects
+    unit = level.objects["200"]
+    base0, base1, base2, base3 = bases(level)
+    preload = BattalionLevelFile()
+
+    clone = unit.clone_object(level, preload)
+    level.add_object_new(clone)
+    copied = base1.clone_object(level, preload)
+    level.add_object_new(copied)
+    clone.set_element("mBases", 0, copied)
+    assert copied.referenced_by == [clone]
+    assert set(base1.referenced_by) == {unit, clone}
+
+    level.delete_objects([copied])
+    assert clone.mBases[0] is None
+    out = BytesIO()
+    level.write(out)
+    assert "<Item>{0}</Item>".format(copied._node.attrib["id"]).encode("utf-8") not in out.getvalue()
+
+
+def test_write_in_place_edit(level):
+    unit = level.objects["200"]
+    assert level.write(BytesIO()) == len(level.objects)
+    assert level.write(BytesIO()) == 0
+
+    # Edited in place without calling mark_dirty
+    unit.Mat.mtx[12] = 55.5
+    assert unit.is_xml_dirty()
+    out = BytesIO()
+    assert level.write(out) == 1
+    assert b"55.5" in out.getvalue()
+    assert not unit.is_xml_dirty()
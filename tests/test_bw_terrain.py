@@ -0,0 +1,177 @@
+# Checks the numpy parse of BWTerrainV2 against the old parse that read every tile element with struct
+from io import BytesIO
+from struct import pack, unpack_from
+
+import numpy
+import pytest
+
+from lib.bw_terrain import BWTerrainV2, TILE_DTYPE, MapMaterial
+
+
+CHUNK_COUNT = 5
+MATERIAL_COUNT = 3
+# (chunk x, chunk y, chunk index) of the chunks placed on the map
+PLACED = [(0, 0, 0), (1, 0, 1), (0, 1, 2), (10, 20, 3), (63, 63, 4), (5, 7, 1)]
+
+
+# Per-element readers of the old parse
+def read_tile(data, i):
+    tiledata = data[i*180:(i+1)*180]
+    heights = [x/16.0 for x in unpack_from(">16H", tiledata, 0)]
+    colors = [[x/255.0 for x in unpack_from("BBBB", tiledata, 32 + j*4)] for j in range(16)]
+    surface = [[x/4096.0 for x in unpack_from(">HH", tiledata, 96 + j*4)] for j in range(4)]
+    detail = [[x/4096.0 for x in unpack_from(">HH", tiledata, 112 + j*4)] for j in range(16)]
+    material_index = unpack_from(">I", tiledata, 176)[0]
+    return heights, colors, surface, detail, material_index
+
+
+def read_chunk(data, i):
+    chunkdata = data[i*180*16:(i+1)*180*16]
+    return [read_tile(chunkdata, j) for j in range(16)]
+
+
+def read_tile_vertices(tile, offsetx, offsety):
+    heights, colors, surface, detail, material_index = tile
+    br, bl, tr, tl = surface
+    positions, uv1 = [], []
+    for y in range(4):
+        fy = y/3.0
+        for x in range(4):
+            fx = x/3.0
+            u = fy*(fx*tl[0] + (1-fx)*tr[0]) + (1-fy)*(fx*bl[0] + (1-fx)*br[0])
+            v = fy*(fx*tl[1] + (1-fx)*tr[1]) + (1-fy)*(fx*bl[1] + (1-fx)*br[1])
+            positions.append([(x+offsetx)*4*(4/3)-2048, heights[4*y + x], (y+offsety)*4*(4/3)-2048])
+            uv1.append([u, v])
+    return positions, colors, uv1, detail, material_index
+
+
+def read_terrain(chunkdata, mapdata):
+    # Vertex data and height grid in the order and layout of the old BWTerrainV2 loop
+    positions, colors, uv1, uv2, materials = [], [], [], [], []
+    pointdata = numpy.full((64*16 + 1, 64*16 + 1), -1.0)
+    for chunkx in range(64):
+        for chunky in range(64):
+            a, b, chunkindex = unpack_from(">BBH", mapdata, (chunky*64 + chunkx)*4)
+            if b != 1:
+                continue
+            tiles = read_chunk(chunkdata, chunkindex)
+            for tilex in range(4):
+                for tiley in range(4):
+                    tile = tiles[tiley*4 + tilex]
+                    for x in range(4):
+                        for y in range(4):
+                            pointdata[chunkx*16 + tilex*4 + x, chunky*16 + tiley*4 + y] = tile[0][y*4 + x]
+
+                    vertices = read_tile_vertices(tile, chunkx*12 + tilex*3, chunky*12 + tiley*3)
+                    for values, result in zip(vertices, (positions, colors, uv1, uv2, materials)):
+                        result.append(values)
+    return positions, colors, uv1, uv2, materials, pointdata
+
+
+def make_terrain_file():
+    rng = numpy.random.default_rng(1234)
+    tiles = numpy.zeros(CHUNK_COUNT*16, dtype=TILE_DTYPE)
+    tiles["heights"] = rng.integers(0, 2**16, size=tiles["heights"].shape)
+    tiles["vertex_colors"] = rng.integers(0, 256, size=tiles["vertex_colors"].shape)
+    tiles["surface_coordinates"] = rng.integers(0, 2**16, size=tiles["surface_coordinates"].shape)
+    tiles["detail_coordinates"] = rng.integers(0, 2**16, size=tiles["detail_coordinates"].shape)
+    tiles["material_index"] = rng.integers(0, MATERIAL_COUNT, size=tiles["material_index"].shape)
+    chunkdata = tiles.tobytes()
+
+    mapentries = [(0, 0, 0)]*(64*64)
+    for chunkx, chunky, chunkindex in PLACED:
+        mapentries[chunky*64 + chunkx] = (7, 1, chunkindex)
+    mapentries[3*64 + 3] = (0, 2, 4)  # Not placed
+    mapdata = b"".join(pack(">BBH", *entry) for entry in mapentries)
+
+    materials = b"".join(pack("16s16sIIII", "Mat{0}A".format(i).encode("ascii"), "Mat{0}B".format(i).encode("ascii"),
+                              i, 0, 1, 2)
+                         for i in range(MATERIAL_COUNT))
+
+    data = BytesIO()
+    for name, section in ((b"RRET", pack("IIII", 64, 64, 0, MATERIAL_COUNT)),
+                          (b"KNHC", chunkdata),
+                          (b"PAMC", mapdata),
+                          (b"LTAM", materials)):
+        data.write(name)
+        data.write(pack("I", len(section)))
+        data.write(section)
+    data.seek(0)
+    return data, chunkdata, mapdata
+
+
+@pytest.fixture(scope="module")
+def terrain():
+    f, chunkdata, mapdata = make_terrain_file()
+    return BWTerrainV2(f), chunkdata, mapdata
+
+
+def test_chunks(terrain):
+    bwterrain, chunkdata, mapdata = terrain
+    assert len(bwterrain.chunks) == CHUNK_COUNT
+
+    for i, chunk in enumerate(bwterrain.chunks):
+        for tile, expected in zip(chunk.tiles, read_chunk(chunkdata, i)):
+            heights, colors, surface, detail, material_index = expected
+            assert tile.heights == heights
+            assert [[c.r, c.g, c.b, c.a] for c in tile.vertex_colors] == colors
+            assert [[uv.x, uv.y] for uv in tile.surface_coordinates] == surface
+            assert [[uv.x, uv.y] for uv in tile.detail_coordinates] == detail
+            assert tile.material_index == material_index
+
+
+def test_map_and_materials(terrain):
+    bwterrain, chunkdata, mapdata = terrain
+    assert len(bwterrain.map) == 64*64
+    for i, entry in enumerate(bwterrain.map):
+        assert (entry.a, entry.b, entry.chunkindex) == unpack_from(">BBH", mapdata, i*4)
+
+    assert bwterrain.materials == [MapMaterial("Mat{0}A".format(i), "Mat{0}B".format(i), i, 0, 1, 2)
+                                   for i in range(MATERIAL_COUNT)]
+
+
+def test_vertex_data(terrain):
+    bwterrain, chunkdata, mapdata = terrain
+    positions, colors, uv1, uv2, materials, pointdata = read_terrain(chunkdata, mapdata)
+    assert len(positions) == len(PLACED)*16
+
+    assert bwterrain.tile_positions.tolist() == positions
+    assert bwterrain.tile_colors.tolist() == colors
+    numpy.testing.assert_allclose(bwterrain.tile_uv1, uv1, rtol=0, atol=1e-12)
+    assert bwterrain.tile_uv2.tolist() == uv2
+    assert bwterrain.tile_materials.tolist() == materials
+    assert numpy.array_equal(bwterrain.pointdata, pointdata)
+
+
+def test_tile_models(terrain):
+    bwterrain, chunkdata, mapdata = terrain
+    positions, colors, uv1, uv2, materials, pointdata = read_terrain(chunkdata, mapdata)
+
+    tilemodels = [tilemodel for material_index in sorted(bwterrain.meshes)
+                  for tilemodel in bwterrain.meshes[material_index]]
+    assert len(tilemodels) == len(positions)
+    expected = sorted(range(len(positions)), key=lambda i: materials[i])
+    for tilemodel, i in zip(tilemodels, expected):
+        assert tilemodel.positions.tolist() == positions[i]
+        assert tilemodel.material == bwterrain.materials[materials[i]]
+        tile_positions = numpy.array(positions[i])
+        assert [tilemodel.aabb.min.x, tilemodel.aabb.min.y, tilemodel.aabb.min.z] == tile_positions.min(axis=0).tolist()
+        assert [tilemodel.aabb.max.x, tilemodel.aabb.max.y, tilemodel.aabb.max.z] == tile_positions.max(axis=0).tolist()
+
+
+def test_heights(terrain):
+    bwterrain, chunkdata, mapdata = terrain
+    rng = numpy.random.default_rng(5)
+    x = rng.uniform(-2100, 2100, 500)
+    y = rng.uniform(-2100, 2100, 500)
+    # Points on the placed chunks
+    x = numpy.concatenate((x, rng.uniform(-2048, -2048 + 2*64, 200)))
+    y = numpy.concatenate((y, rng.uniform(-2048, -2048 + 2*64, 200)))
+
+    heights = bwterrain.check_heights(x, y)
+    for px, py, height in zip(x.tolist(), y.tolist(), heights.tolist()):
+        expected = bwterrain.check_height(px, py)
+        if expected is None:
+            assert numpy.isnan(height)
+        else:
+            assert height == expected
@@ -0,0 +1,122 @@
+# Checks the numpy texture decoder against the old decoder that went through the image one block at a time
+from io import BytesIO
+
+import numpy
+import pytest
+from PIL import Image
+
+from lib.bw import bwtex
+from lib.bw.texlib import texture_utils
+from plugins.bw_texture_conv.lib import texture_utils as plugin_texture_utils
+
+
+SIZES = [(8, 8), (16, 8), (32, 64), (1, 1), (5, 3), (13, 21), (64, 7)]
+
+FORMATS = ([(image_format, None) for image_format in texture_utils.ImageFormat
+            if image_format not in texture_utils.IMAGE_FORMATS_THAT_USE_PALETTES]
+           + [(image_format, palette_format) for image_format in texture_utils.IMAGE_FORMATS_THAT_USE_PALETTES
+              for palette_format in texture_utils.PaletteFormat])
+
+
+def reference_decode_image(utils, image_data, palette_data, image_format, palette_format, num_colors,
+                           image_width, image_height):
+    # The old decode_image, except that pixels with a color index past the end of the palette are
+    # left transparent instead of failing to be set
+    colors = utils.decode_palettes(palette_data, palette_format, num_colors, image_format)
+
+    block_width = utils.BLOCK_WIDTHS[image_format]
+    block_height = utils.BLOCK_HEIGHTS[image_format]
+    block_data_size = utils.BLOCK_DATA_SIZES[image_format]
+
+    image = Image.new("RGBA", (image_width, image_height), (0, 0, 0, 0))
+    pixels = image.load()
+    offset = 0
+    block_x = 0
+    block_y = 0
+    while block_y < image_height:
+        pixel_color_data = utils.decode_block(image_format, image_data, offset, block_data_size, colors)
+
+        for i, color in enumerate(pixel_color_data):
+            x = block_x + i % block_width
+            y = block_y + i // block_width
+            if x >= image_width or y >= image_height or color is None:
+                continue
+
+            pixels[x, y] = color
+
+        offset += block_data_size
+        block_x += block_width
+        if block_x >= image_width:
+            block_x = 0
+            block_y += block_height
+
+    return image
+
+
+def image_data_size(utils, image_format, width, height):
+    blocks_x = (width + utils.BLOCK_WIDTHS[image_format] - 1)//utils.BLOCK_WIDTHS[image_format]
+    blocks_y = (height + utils.BLOCK_HEIGHTS[image_format] - 1)//utils.BLOCK_HEIGHTS[image_format]
+    return blocks_x*blocks_y*utils.BLOCK_DATA_SIZES[image_format]
+
+
+def make_data(seed, size):
+    return numpy.random.default_rng(seed).integers(0, 256, size, dtype=numpy.uint8).tobytes()
+
+
+def check_decode(utils, image_data, palette_data, image_format, palette_format, num_colors, width, height):
+    # The old decoder can't read past the end of the data, so it gets the data zero padded to whole blocks
+    padded = image_data.ljust(image_data_size(utils, image_format, width, height), b"\x00")
+    expected = reference_decode_image(utils, BytesIO(padded), BytesIO(palette_data), image_format,
+                                      palette_format, num_colors, width, height)
+    image = utils.decode_image(BytesIO(image_data), BytesIO(palette_data), image_format, palette_format,
+                               num_colors, width, height)
+
+    assert image.mode == "RGBA"
+    assert image.size == (width, height)
+    assert image.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("utils", [texture_utils, plugin_texture_utils], ids=["lib", "plugin"])
+@pytest.mark.parametrize("image_format, palette_format", FORMATS,
+                         ids=["{0}-{1}".format(image_format.name, palette_format.name if palette_format else "none")
+                              for image_format, palette_format in FORMATS])
+@pytest.mark.parametrize("width, height", SIZES)
+def test_decode_image(utils, image_format, palette_format, width, height):
+    utils_image_format = utils.ImageFormat[image_format.name]
+    utils_palette_format = utils.PaletteFormat[palette_format.name] if palette_format else None
+    num_colors = utils.MAX_COLORS_FOR_IMAGE_FORMAT.get(utils_image_format, 0)
+
+    image_data = make_data(width*height, image_data_size(utils, utils_image_format, width, height))
+    palette_data = make_data(num_colors, num_colors*2)
+    check_decode(utils, image_data, palette_data, utils_image_format, utils_palette_format, num_colors, width, height)
+
+
+@pytest.mark.parametrize("image_format", texture_utils.IMAGE_FORMATS_THAT_USE_PALETTES)
+@pytest.mark.parametrize("palette_format", texture_utils.PaletteFormat)
+def test_decode_image_short_palette(image_format, palette_format):
+    # Color indexes past the end of the palette are left transparent
+    image_data = make_data(1, image_data_size(texture_utils, image_format, 16, 16))
+    palette_data = make_data(2, 10*2)
+    check_decode(texture_utils, image_data, palette_data, image_format, palette_format, 10, 16, 16)
+
+
+@pytest.mark.parametrize("image_format", list(texture_utils.ImageFormat))
+def test_decode_image_short_data(image_format):
+    # Mip data that ends before the last block row is decoded as if it was zero padded
+    num_colors = texture_utils.MAX_COLORS_FOR_IMAGE_FORMAT.get(image_format, 0)
+    size = image_data_size(texture_utils, image_format, 32, 32)
+    image_data = make_data(3, size - texture_utils.BLOCK_DATA_SIZES[image_format]*3 - 5)
+    palette_data = make_data(4, num_colors*2)
+    check_decode(texture_utils, image_data, palette_data, image_format, texture_utils.PaletteFormat.RGB5A3,
+                 num_colors, 32, 32)
+
+
+@pytest.mark.parametrize("name", sorted(bwtex.FORMAT))
+def test_bwtex_formats(name):
+    # The texture formats of the bwtex files, at the size of a small mip map
+    image_format = bwtex.FORMAT[name]
+    num_colors = texture_utils.MAX_COLORS_FOR_IMAGE_FORMAT.get(image_format, 0)
+    image_data = make_data(5, image_data_size(texture_utils, image_format, 4, 2))
+    palette_data = make_data(6, num_colors*2)
+    check_decode(texture_utils, image_data, palette_data, image_format, texture_utils.PaletteFormat.RGB5A3,
+                 num_colors, 4, 2)
@@ -0,0 +1,91 @@
+# Checks that objects can be updated in the culled instance batches without rebuilding the others
+import numpy
+
+from lib.render.culling import CulledInstances, Frustum
+from lib.render.model_renderingv2 import InstanceSlots
+
+
+def translation(x, y, z):
+    mtx = numpy.identity(4, dtype=numpy.float32).reshape(-1)
+    mtx[12:15] = x, y, z
+    return mtx
+
+
+def box_frustum(size):
+    # Everything within size of the origin
+    planes = numpy.array([[1, 0, 0, size], [-1, 0, 0, size],
+                          [0, 1, 0, size], [0, -1, 0, size],
+                          [0, 0, 1, size], [0, 0, -1, size]], dtype=numpy.float64)
+    return Frustum(planes)
+
+
+def add(culling, key, instances, position):
+    mtx = translation(*position)
+    culling.add(key, instances, mtx, (0, 1, 2, 3))
+    culling.set_bounds(key, position, 1.0)
+
+
+def setup():
+    culling = CulledInstances()
+    cubes, icons = InstanceSlots(), InstanceSlots()
+    culling.begin()
+    cubes.begin()
+    icons.begin()
+    for i in range(4):
+        add(culling, i, cubes, (i*10.0, 0.0, 0.0))
+    culling.add(0, icons, translation(0.0, 0.0, 0.0))
+    culling.end()
+    culling.update(box_frustum(25.0), rebuild=True)
+    cubes.end()
+    icons.end()
+    cubes.reset_dirty()
+    icons.reset_dirty()
+    return culling, cubes, icons
+
+
+def test_replace_moves_slot():
+    culling, cubes, icons = setup()
+    frustum = box_frustum(25.0)
+    assert set(cubes.slots) == {0, 1, 2}
+    slot = cubes.slots[1]
+
+    culling.replace(1)
+    add(culling, 1, cubes, (5.0, 0.0, 0.0))
+    culling.update_replaced(frustum)
+    assert cubes.slots[1] == slot
+    assert cubes.dirty == {slot}
+    assert cubes.matrices[slot][12] == 5.0
+    assert not culling.update(frustum)
+
+
+def test_replace_into_and_out_of_view():
+    culling, cubes, icons = setup()
+    frustum = box_frustum(25.0)
+
+    culling.replace(1)
+    add(culling, 1, cubes, (100.0, 0.0, 0.0))
+    culling.replace(3)
+    add(culling, 3, cubes, (-10.0, 0.0, 0.0))
+    culling.update_replaced(frustum)
+    assert set(cubes.slots) == {0, 2, 3}
+    assert culling.visible == {0, 2, 3}
+
+    # Moving the camera still works on the new positions
+    assert culling.update(box_frustum(200.0))
+    assert set(cubes.slots) == {0, 1, 2, 3}
+
+
+def test_replace_drops_unused_instances():
+    culling, cubes, icons = setup()
+    assert set(icons.slots) == {0}
+
+    culling.replace(0)
+    add(culling, 0, cubes, (0.0, 0.0, 0.0))
+    culling.update_replaced(box_frustum(25.0))
+    assert set(icons.slots) == set()
+    assert 0 in cubes.slots
+
+    culling.remove(2)
+    culling.update_replaced(box_frustum(25.0))
+    assert 2 not in cubes.slots
+    assert 2 not in culling.grid
@@ -0,0 +1,277 @@
+# Checks the numpy display list parse and the triangle arrays of the textured BW models against
+# the old parse that read every vertex attribute on its own
+from io import BytesIO
+from struct import pack, unpack
+
+import numpy
+import pytest
+
+from lib.bw.gx import VertexDescriptor, VTX, VTXFMT, vertex_dtype, read_display_list, strip_triangles
+from lib.bw.model_rendering import BW2Model, NodeBW2, Material, Primitive
+from lib.bw.vectors import Matrix4x4
+
+
+# The old per-vertex parse of a display list
+def reference_read_display_list(data, vertexdesc=0):
+    f = BytesIO(data)
+    strips = []
+    while f.tell() < len(data):
+        opcode = f.read(1)[0]
+
+        if opcode == 0x8:  # Load CP Reg
+            command = f.read(1)[0]
+            val = unpack(">I", f.read(4))[0]
+            if command == 0x50:
+                vertexdesc &= ~0x1FFFF
+                vertexdesc |= val
+            elif command == 0x60:
+                vertexdesc &= 0x1FFFF
+                vertexdesc |= (val << 17)
+            else:
+                raise RuntimeError("unknown CP command {0:x}".format(command))
+        elif opcode == 0x10:  # Load XF Reg
+            f.read(8)
+        elif opcode & 0xFA == 0x98:  # Triangle strip
+            attribs = VertexDescriptor()
+            attribs.from_value(vertexdesc)
+
+            vertex_count = unpack(">H", f.read(2))[0]
+            vertices = []
+            for i in range(vertex_count):
+                primattrib = [None]*10
+
+                for attrib, fmt in attribs.active_attributes():
+                    if attrib == VTX.Position or attrib == VTX.Normal:
+                        if fmt == VTXFMT.INDEX8:
+                            index = f.read(1)[0]
+                        elif fmt == VTXFMT.INDEX16:
+                            index = unpack(">H", f.read(2))[0]
+                        else:
+                            raise RuntimeError("unknown format")
+                        primattrib[0 if attrib == VTX.Position else 1] = index
+                    elif VTX.Tex0Coord <= attrib <= VTX.Tex7Coord:
+                        primattrib[2 + attrib - VTX.Tex0Coord] = f.read(1)[0]
+                    elif fmt is not None:
+                        if fmt == VTXFMT.INDEX8:
+                            f.read(1)
+                        elif fmt == VTXFMT.INDEX16:
+                            f.read(2)
+                    else:
+                        f.read(1)
+
+                vertices.append(primattrib)
+            strips.append(vertices)
+        elif opcode == 0x00:
+            pass
+        else:
+            raise RuntimeError("Unknown opcode: {0:x}".format(opcode))
+
+    return strips, vertexdesc
+
+
+def reference_strip_triangles(vertex_count):
+    # Corners of the triangles in the order the old mesh building loop added them
+    corners = []
+    i = 0
+    vert1, vert2, vert3 = None, None, None
+    for vertex in range(vertex_count):
+        if vert1 is None:
+            vert1 = vertex
+            continue
+        elif vert2 is None:
+            vert2 = vertex
+            continue
+        elif vert3 is None:
+            vert3 = vertex
+        else:
+            vert1 = vert2
+            vert2 = vert3
+            vert3 = vertex
+            i = (i + 1) % 2
+
+        if i == 0:
+            v1, v2, v3 = vert1, vert2, vert3
+        else:
+            v1, v2, v3 = vert2, vert1, vert3
+        corners.extend((v3, v2, v1))
+    return corners
+
+
+def random_vertexdesc(rng, texcoords=None):
+    # Position is always an index, normals and colors are optional
+    val = int(rng.integers(0, 2))  # Position matrix index
+    val |= int(rng.integers(0, 2**8)) << 1  # Texture matrix indices
+    val |= int(rng.integers(2, 4)) << 9
+    val |= int(rng.choice([0, 2, 3])) << 11
+    val |= int(rng.integers(0, 4)) << 13
+    val |= int(rng.integers(0, 4)) << 15
+    if texcoords is None:
+        texcoords = int(rng.integers(0, 2**8))
+    return val, texcoords
+
+
+def cp_commands(vertexdesc):
+    low, high = vertexdesc
+    return pack(">BBI", 0x8, 0x50, low) + pack(">BBI", 0x8, 0x60, high)
+
+
+def make_display_list(rng, strip_count):
+    data = b""
+    for i in range(strip_count):
+        vertexdesc = random_vertexdesc(rng)
+        data += cp_commands(vertexdesc)
+        if rng.integers(0, 2):
+            data += b"\x00"  # NOP
+        if rng.integers(0, 2):
+            data += b"\x10" + rng.bytes(8)  # XF register
+
+        dtype = vertex_dtype(vertexdesc[0] | vertexdesc[1] << 17)
+        vertex_count = int(rng.integers(0, 20))
+        opcode = int(rng.choice([0x98, 0x99, 0x9C, 0x9D]))
+        data += pack(">BH", opcode, vertex_count) + rng.bytes(vertex_count*dtype.itemsize)
+    return data
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_read_display_list(seed):
+    rng = numpy.random.default_rng(seed)
+    data = make_display_list(rng, 8)
+    vertexdesc = int(rng.integers(0, 2**25))
+
+    strips, result_vertexdesc = read_display_list(data, vertexdesc)
+    expected_strips, expected_vertexdesc = reference_read_display_list(data, vertexdesc)
+
+    assert result_vertexdesc == expected_vertexdesc
+    assert [Primitive(0x98, strip).vertices for strip in strips] == expected_strips
+
+
+def test_read_display_list_keeps_vertexdesc():
+    # A display list can draw with the vertex descriptor that an earlier one set
+    rng = numpy.random.default_rng(100)
+    low, high = random_vertexdesc(rng, texcoords=0b11)
+    vertexdesc = low | high << 17
+    dtype = vertex_dtype(vertexdesc)
+    data = pack(">BH", 0x98, 5) + rng.bytes(5*dtype.itemsize)
+
+    strips, result_vertexdesc = read_display_list(data, vertexdesc)
+    assert result_vertexdesc == vertexdesc
+    assert [Primitive(0x98, strip).vertices for strip in strips] == reference_read_display_list(data, vertexdesc)[0]
+
+
+def test_vertex_dtype():
+    attribs = VertexDescriptor()
+    rng = numpy.random.default_rng(200)
+    for i in range(100):
+        low, high = random_vertexdesc(rng)
+        vertexdesc = low | high << 17
+        attribs.from_value(vertexdesc)
+        dtype = vertex_dtype(vertexdesc)
+
+        # Direct colors take no space in the display list
+        names = [attrib.name for attrib, fmt in attribs.active_attributes() if fmt != VTXFMT.DIRECT]
+        assert list(dtype.names) == names
+        for attrib, fmt in attribs.active_attributes():
+            if fmt == VTXFMT.INDEX16:
+                assert dtype[attrib.name] == numpy.dtype(">u2")
+            elif fmt != VTXFMT.DIRECT:
+                assert dtype[attrib.name] == numpy.dtype("u1")
+        assert vertex_dtype(vertexdesc) is dtype
+
+
+def test_strip_triangles():
+    for vertex_count in range(12):
+        assert strip_triangles(vertex_count).tolist() == reference_strip_triangles(vertex_count)
+
+
+def make_strip(rng, vertexdesc, vertex_count, position_count, uv_count):
+    # Display list of one strip with indices that are in range of the node's vertices and uvs
+    low, high = vertexdesc
+    strip = numpy.zeros(vertex_count, dtype=vertex_dtype(low | high << 17))
+    for name in strip.dtype.names:
+        strip[name] = rng.integers(0, 2**(8*strip.dtype[name].itemsize), vertex_count)
+    strip["Position"] = rng.integers(0, position_count, vertex_count)
+    if "Tex1Coord" in strip.dtype.names:
+        texcoords = rng.integers(0, uv_count, vertex_count)
+        strip["Tex1Coord"] = texcoords & 0xFF
+        if "Tex0Coord" in strip.dtype.names:
+            strip["Tex0Coord"] = texcoords >> 8
+    return cp_commands(vertexdesc) + pack(">BH", 0x98, vertex_count) + strip.tobytes()
+
+
+def make_node(rng, parent, textures, uv_count):
+    node = NodeBW2(0)
+    node.name = b"Node"
+    node.xbs2count = 1
+    node.parent = parent
+    matrix = Matrix4x4(*rng.uniform(-2, 2, 16).tolist())
+    node.transform = type("Transform", (object, ), {"matrix4": matrix})()
+    node.vscl = float(rng.uniform(0.001, 0.1))
+    node.vertices = [tuple(vertex) for vertex in rng.integers(-2**15, 2**15, (40, 3)).tolist()]
+    node.uvmaps[0] = rng.integers(-2**15, 2**15, (uv_count, 2)) / 2.0**11
+
+    for texture in textures:
+        material = Material()
+        material.tex1 = texture
+        node.materials.append(material)
+
+    # The same display lists as the old parse read them
+    node.reference_meshes = []
+    for matindex in range(len(textures)):
+        data = b""
+        for i in range(3):
+            # 16 bit texcoords, 8 bit texcoords and strips without texcoords
+            texcoords = [0b11, 0b10, 0b01][i]
+            data += make_strip(rng, random_vertexdesc(rng, texcoords), int(rng.integers(3, 12)),
+                               len(node.vertices), uv_count if texcoords == 0b11 else min(uv_count, 256))
+        strips, vertexdesc = read_display_list(data)
+        node.meshes.append((matindex, [Primitive(0x98, strip) for strip in strips]))
+        node.reference_meshes.append((matindex, reference_read_display_list(data)[0]))
+    return node
+
+
+def reference_triangles(model):
+    # Triangle corners per texture as the old make_textured_model added them to the meshes
+    trilists = {}
+    for node in model.nodes:
+        mvmat = Matrix4x4.identity()
+        currnode = node
+        mvmat.inplace_multiply_mat4(node.transform.matrix4)
+        while currnode.parent is not None:
+            currnode = currnode.parent
+            mvmat.inplace_multiply_mat4(currnode.transform.matrix4)
+
+        vertices = []
+        for x, y, z in node.vertices:
+            newx, newy, newz, _ = mvmat.multiply_vec4(x * node.vscl, y * node.vscl, z * node.vscl, 1)
+            vertices.append((newx, newy, newz))
+        uvs = [(u, v) for u, v in node.uvmaps[0].tolist()]
+
+        for matindex, mesh in node.reference_meshes:
+            trilist = trilists.setdefault(node.materials[matindex].tex1, [])
+            for vertexlist in mesh:
+                for corner in reference_strip_triangles(len(vertexlist)):
+                    posindex, normindex, tex0, tex1 = vertexlist[corner][0:4]
+                    if tex1 is not None:
+                        texcoordindex = tex0 << 8 | tex1 if tex0 is not None else tex1
+                        trilist.append((vertices[posindex], uvs[texcoordindex]))
+    return trilists
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_textured_model(seed):
+    rng = numpy.random.default_rng(seed)
+    model = BW2Model()
+    root = make_node(rng, None, [b"tex_a", b"tex_b"], 300)
+    child = make_node(rng, root, [b"tex_b", b"tex_c"], 200)
+    model.nodes = [root, child]
+
+    texmodel = model.make_textured_model(None)
+    expected = reference_triangles(model)
+
+    assert [mesh.texname for mesh in texmodel.mesh_list] == ["tex_a", "tex_b", "tex_c"]
+    for mesh, texname in zip(texmodel.mesh_list, (b"tex_a", b"tex_b", b"tex_c")):
+        trilist = expected[texname]
+        reference_data = numpy.array([vtxpos + uv for vtxpos, uv in trilist], dtype=numpy.float32).reshape(-1, 5)
+        assert len(trilist) > 0
+        assert mesh.vertex_count() == len(trilist)
+        assert numpy.array_equal(mesh.vertex_data(), reference_data)
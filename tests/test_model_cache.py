@@ -0,0 +1,61 @@
+# Checks that indexed meshes survive the model cache and give back the triangle lists they were made from
+import numpy
+
+from lib.bw.bwmodelrender import make_textured_model
+from lib.bw.model_cache import read_cache_entry, write_cache_entry
+from lib.render.model_renderingv2 import index_mesh
+
+
+def make_triangles(rng, vertex_count, corner_count):
+    vertices = rng.uniform(-100, 100, (vertex_count, 5)).astype(numpy.float32)
+    return vertices[rng.integers(0, vertex_count, corner_count)]
+
+
+def test_index_mesh():
+    rng = numpy.random.default_rng(0)
+    data = make_triangles(rng, 50, 300)
+    vertices, indices = index_mesh(data, 5)
+
+    assert indices.dtype == numpy.uint16
+    assert len(vertices) == len(numpy.unique(data, axis=0))
+    assert numpy.array_equal(vertices[indices], data)
+    # Unique vertices are in the order they are first used
+    assert indices[0] == 0 and numpy.all(numpy.diff(numpy.maximum.accumulate(indices)) <= 1)
+
+
+def test_index_mesh_32bit():
+    data = numpy.arange(0x10001*3*5, dtype=numpy.float32).reshape(-1, 5)
+    vertices, indices = index_mesh(data, 5)
+    assert indices.dtype == numpy.uint32
+    assert numpy.array_equal(vertices[indices], data)
+
+    vertices, indices = index_mesh(data[:0x10000], 5)
+    assert indices.dtype == numpy.uint16
+
+
+def test_cache_entry(tmp_path):
+    rng = numpy.random.default_rng(1)
+    triangles = [make_triangles(rng, 20, 60), numpy.zeros((0, 5), dtype=numpy.float32), make_triangles(rng, 5, 9)]
+    parsed = {
+        "textures": ["tex_a", "tex_b", "tex_c"],
+        "meshes": [(texname, *index_mesh(data, 5)) for texname, data in zip(("tex_a", "tex_b", "tex_c"), triangles)],
+        "boundsphere": (1.0, 2.0, 3.0, 4.0)
+    }
+
+    path = str(tmp_path / "entry.npz")
+    write_cache_entry(path, parsed)
+    entry = read_cache_entry(path)
+
+    assert entry["textures"] == parsed["textures"]
+    assert entry["boundsphere"] == parsed["boundsphere"]
+    for (texname, vertices, indices), (cached_texname, cached_vertices, cached_indices) in zip(parsed["meshes"],
+                                                                                              entry["meshes"]):
+        assert cached_texname == texname
+        assert cached_indices.dtype == indices.dtype
+        assert numpy.array_equal(cached_vertices, vertices)
+        assert numpy.array_equal(cached_indices, indices)
+
+    texmodel = make_textured_model(entry)
+    assert [mesh.texname for mesh in texmodel.mesh_list] == parsed["textures"]
+    for mesh, data in zip(texmodel.mesh_list, triangles):
+        assert numpy.array_equal(mesh.vertex_data(), data)
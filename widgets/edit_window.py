@@ -46,7 +46,10 @@ def make_setter(obj, attr, index=None):
     def changed(newval):
         val = getattr(obj, attr)
         if isinstance(val, list):
-            val[index] = newval
+            if isinstance(obj, BattalionObject):
+                obj.set_element(attr, index, newval)
+            else:
+                val[index] = newval
         else:
             setattr(obj, attr, newval)
 
@@ -1259,12 +1262,15 @@ class FieldEdit(QtCore.QObject):
 
             content = Vector4Edit(line, type, getter)
             content.update_value()
+            # Edited in place
+            content.changed.connect(self.object.mark_dirty)
             line_layout.addWidget(content)
         elif tag == "Attribute" and type in ("sMatrix4x4", "cMatrix4x4"):
             getter = make_getter(self.object, name, element)
 
             content = MatrixEdit(line, getter)
             content.update_value()
+            content.changed.connect(self.object.mark_dirty)
             line_layout.addWidget(content)
         elif tag == "Attribute" and type in ("cFxString8", "cFxString16"):
             getter = make_getter(self.object, name, element)
@@ -1577,10 +1583,12 @@ class CopyPasteObjectData(object):
                     other_value.y = value.y
                     other_value.z = value.z
                     other_value.w = value.w
+                    other_obj.mark_dirty()
                 elif isinstance(value, BWMatrix):
                     for i in range(16):
                         other_value: BWMatrix
                         other_value.mtx[i] = value.mtx[i]
+                    other_obj.mark_dirty()
                 else:
                     open_message_dialog(f"Unknown type {type(value)}", "", None)
 
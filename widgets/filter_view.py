@@ -172,6 +172,13 @@ class FilterViewMenu(NonAutodismissibleMenu):
         self.show_full_scenery_action.triggered.connect(self.show_full_scenery_changed)
         self.addAction(self.show_full_scenery_action)
 
+        self.frustum_culling_action = QAction("Frustum Culling", self)
+        self.frustum_culling_action.setCheckable(True)
+        self.frustum_culling_action.setChecked(True)
+        self.frustum_culling_action.setToolTip("If enabled, objects outside of the view aren't sent to the GPU.")
+        self.frustum_culling_action.triggered.connect(self.emit_update)
+        self.addAction(self.frustum_culling_action)
+
         self.addSeparator()
 
         self.units_menu = SubGroup("Units", self)
@@ -310,6 +317,9 @@ class FilterViewMenu(NonAutodismissibleMenu):
     def show_full_scenery(self):
         return self.show_full_scenery_action.isChecked()
 
+    def frustum_culling(self):
+        return self.frustum_culling_action.isChecked()
+
     def show_only(self, toggle_group):
         self.handle_hide_all()
         toggle_group.show_all()
@@ -346,10 +356,13 @@ class FilterViewMenu(NonAutodismissibleMenu):
 
         if "View Filter Toggles" in cfg:
             full_scenery = cfg["View Filter Toggles"].getboolean("full_scenery", fallback=False)
+            frustum_culling = cfg["View Filter Toggles"].getboolean("frustum_culling", fallback=True)
         else:
             full_scenery = False
+            frustum_culling = True
 
         self.show_full_scenery_action.setChecked(full_scenery)
+        self.frustum_culling_action.setChecked(frustum_culling)
 
     def save(self, cfg):
         if "View Filter Toggles" not in cfg:
@@ -360,6 +373,7 @@ class FilterViewMenu(NonAutodismissibleMenu):
                 cfg["View Filter Toggles"][type+"_3D"] = str(toggle.is_selectable())
 
         cfg["View Filter Toggles"]["full_scenery"] = str(self.show_full_scenery_action.isChecked())
+        cfg["View Filter Toggles"]["frustum_culling"] = str(self.frustum_culling_action.isChecked())
 
     def object_3d_visible(self, objtype):
         if self.visibility_override:
@@ -25,12 +25,13 @@ import gzip
 from PyQt6.QtCore import QSize, pyqtSignal, QPoint, QRect, QObject
 from io import BytesIO
 from lib.lua.luaworkshop import LuaWorkbench
+from lib.load_pipeline import LoadPipeline
+from lib.bw_terrain import BWTerrainV2
 from configuration import save_cfg
 from typing import TYPE_CHECKING
 from widgets.menu.menu import Menu
 if TYPE_CHECKING:
     import bw_editor
-    from lib.bw_terrain import BWTerrainV2
 
 
 def resolve_case_insensitive_join(base, relpath):
@@ -71,6 +72,62 @@ def resolve_case_insensitive_join(base, relpath):
     return curr
 
 
+def open_maybe_gzip(path, gzipped):
+    if gzipped:
+        return gzip.open(path, "rb")
+    else:
+        return open(path, "rb")
+
+
+def read_level_file(path, gzipped, callback=None):
+    with open_maybe_gzip(path, gzipped) as f:
+        return BattalionLevelFile(f, callback)
+
+
+def resolve_level_pointers(level_data, preload_data):
+    level_data.resolve_pointers(preload_data)
+    preload_data.resolve_pointers(level_data)
+
+
+def read_resource_archive(path, gzipped):
+    with open_maybe_gzip(path, gzipped) as f:
+        return BattalionArchive.from_file(f)
+
+
+def read_terrain(path, gzipped):
+    with open_maybe_gzip(path, gzipped) as f:
+        return BWTerrainV2(f)
+
+
+def prepare_lua_workbench(workdir, resource_archive):
+    # Returns the workbench and the error that stopped script decompilation, if any.
+    # Errors are shown by the caller because dialogs can't be opened from a worker thread.
+    error = None
+    lua_workbench = LuaWorkbench(workdir)
+    if not lua_workbench.is_initialized():
+        try:
+            lua_workbench.unpack_scripts_archive(resource_archive)
+        except Exception as err:
+            error = err
+
+    if lua_workbench.is_initialized():
+        lua_workbench.read_entity_initialization()
+
+    return lua_workbench, error
+
+
+def format_stage_timings(timings):
+    lines = []
+    for name, duration, done in timings:
+        if duration is None:
+            lines.append("{0}: waiting".format(name))
+        elif done:
+            lines.append("{0}: {1:.2f}s".format(name, duration))
+        else:
+            lines.append("{0}: {1:.1f}s...".format(name, duration))
+    return lines
+
+
 class LoadingBar(QtWidgets.QDialog):
     def __init__(self, parent):
         super().__init__(parent)
@@ -96,9 +153,19 @@ class LoadingBar(QtWidgets.QDialog):
         self.last_time = None
         self.force = False
 
+        # Text lines shown below the bar, e.g. the time each load step took
+        self.stages = []
+        self.line_height = 16
+
     def update_progress(self, progress):
         self.progress = progress
 
+    def set_stages(self, lines):
+        if len(lines) != len(self.stages):
+            self.setFixedHeight(self.loadingbar_height + self.vertical_distance*3 + len(lines)*self.line_height)
+        self.stages = lines
+        self.update()
+
     def closeEvent(self, closeevent):
         self.timer.stop()
         if not self.force:
@@ -135,6 +202,12 @@ class LoadingBar(QtWidgets.QDialog):
                          self.loadingbar_height,
                          0x00FF00)
 
+        y = self.vertical_distance*2 + self.loadingbar_height
+        for line in self.stages:
+            painter.drawText(self.horizontal_distance, y, self.loadingbar_width, self.line_height,
+                             Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, line)
+            y += self.line_height
+
         # This highlight animation is cool but it doesn't update when
         # editor is inside a computation loop
         """highlightcolor = Vector3(0xCF, 0xFF, 0xCF)
@@ -331,47 +404,53 @@ class EditorFileMenu(QMenu):
                     QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
                     progressbar.progressupdate.connect(self.updatestatus)
                     objpath = resolve_case_insensitive_join(base, levelpaths.objectpath)
-                    if levelpaths.objectpath.endswith(".gz"):
-                        with gzip.open(objpath, "rb") as g:
-                            level_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-                    else:
-                        with open(objpath, "rb") as g:
-                            level_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-
-                    progressbar.set(10)
                     preloadpath = resolve_case_insensitive_join(base, levelpaths.preloadpath)
-                    if levelpaths.preloadpath.endswith(".gz"):
-                        with gzip.open(preloadpath, "rb") as g:
-                            preload_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-                    else:
-                        with open(preloadpath, "rb") as g:
-                            preload_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-
-                    progressbar.set(20)
-                    level_data.resolve_pointers(preload_data)
-                    preload_data.resolve_pointers(level_data)
-
                     resourcepath = resolve_case_insensitive_join(base, levelpaths.resourcepath)
-                    if levelpaths.resourcepath.endswith(".gz"):
-                        with gzip.open(resourcepath, "rb") as g:
-                            resource_archive = BattalionArchive.from_file(g)
+                    terrainpath = resolve_case_insensitive_join(base, levelpaths.terrainpath)
+                    level_view = self.editor.level_view
+
+                    # Parsing, archive reading, script decompilation and the terrain parse don't depend
+                    # on each other and run in worker threads. GL uploads stay on this thread.
+                    pipeline = LoadPipeline()
+                    pipeline.add("Level XML",
+                                 partial(read_level_file, objpath, levelpaths.objectpath.endswith(".gz")),
+                                 progress=True)
+                    pipeline.add("Preload XML",
+                                 partial(read_level_file, preloadpath, levelpaths.preloadpath.endswith(".gz")),
+                                 progress=True)
+                    pipeline.add("Resolve pointers", resolve_level_pointers, ("Level XML", "Preload XML"))
+                    pipeline.add("Resource archive",
+                                 partial(read_resource_archive, resourcepath, levelpaths.resourcepath.endswith(".gz")))
+                    pipeline.add("Scripts", partial(prepare_lua_workbench, filepath+"_lua"), ("Resource archive", ))
+                    pipeline.add("Terrain parse",
+                                 partial(read_terrain, terrainpath, levelpaths.terrainpath.endswith(".gz")))
+                    pipeline.add("Models", level_view.reloadModels, ("Resource archive", ),
+                                 main_thread=True, progress=True)
+
+                    def upload_terrain(bwterrain, models, callback):
+                        # Needs the textures of the model handler
+                        level_view.set_terrain(bwterrain, callback)
+
+                    pipeline.add("Terrain upload", upload_terrain, ("Terrain parse", "Models"),
+                                 main_thread=True, progress=True)
+
+                    def update_progress():
+                        loadingbar.set_stages(format_stage_timings(pipeline.timings()))
+                        progressbar.set(int(pipeline.progress()*100))
 
-                    else:
-                        with open(resourcepath, "rb") as g:
-                            resource_archive = BattalionArchive.from_file(g)
+                    try:
+                        results = pipeline.run(update_progress)
+                    finally:
+                        pipeline.print_timings()
+
+                    level_data, preload_data = results["Level XML"], results["Preload XML"]
+                    resource_archive = results["Resource archive"]
 
                     del self.editor.lua_workbench
-                    self.editor.lua_workbench = LuaWorkbench(filepath+"_lua")
-                    if not self.editor.lua_workbench.is_initialized():
-                        respath = os.path.join(base, levelpaths.resourcepath)
-                        try:
-                            self.editor.lua_workbench.unpack_scripts_archive(resource_archive)
-                        except Exception as err:
-                            open_error_dialog(str(err)+"\nPress OK to continue. Script decompilation will be skipped.",
-                                              None)
-
-                    if self.editor.lua_workbench.is_initialized():
-                        self.editor.lua_workbench.read_entity_initialization()
+                    self.editor.lua_workbench, script_error = results["Scripts"]
+                    if script_error is not None:
+                        open_error_dialog(str(script_error)+"\nPress OK to continue. Script decompilation will be skipped.",
+                                          None)
 
                     for id, obj in preload_data.objects.items():
                         if obj.type == "cLevelSettings":
@@ -383,21 +462,6 @@ class EditorFileMenu(QMenu):
                                     None)
                             else:
                                 self.editor.level_view.waterheight = obj.mpRenderParams.mWaterHeight
-                    progressbar.set(30)
-
-
-                    print("Reloading models...")
-                    self.editor.level_view.reloadModels(resource_archive, partial(progressbar.callback, 30))
-                    progressbar.set(60)
-
-                    print("Reloading terrain...")
-                    terrainpath = resolve_case_insensitive_join(base, levelpaths.terrainpath)
-                    if levelpaths.terrainpath.endswith(".gz"):
-                        with gzip.open(terrainpath, "rb") as g:
-                            self.editor.level_view.reloadTerrain(g, partial(progressbar.callback, 30))
-                    else:
-                        with open(terrainpath, "rb") as g:
-                            self.editor.level_view.reloadTerrain(g, partial(progressbar.callback, 30))
 
                     progressbar.set(100)
                     print("Done")
@@ -466,8 +530,6 @@ class EditorFileMenu(QMenu):
                 self.editor.leveldatatreeview.updatenames()
 
                 progressbar.set(5)
-                for object in self.level_data.objects.values():
-                    object.update_xml()
                 self.editor.level_view.selected_positions = []
                 for obj in self.editor.level_view.selected:
                     if obj.getmatrix() is not None:
@@ -538,23 +600,22 @@ class EditorFileMenu(QMenu):
                             loadingbar.force_close()
                             return
 
-                progressbar.set(25)
-                for object in self.preload_data.objects.values():
-                    object.update_xml()
                 progressbar.set(30)
 
-
                 print("Sorting XML nodes...")
                 self.level_data.sort_nodes()
 
                 tmp = BytesIO()
                 print("Writing level data to temp file...")
-                self.level_data.write(tmp)
+                level_reserialized = self.level_data.write(tmp)
                 progressbar.set(70)
                 tmp2 = BytesIO()
 
                 print("Writing preload data to temp file...")
-                self.preload_data.write(tmp2)
+                preload_reserialized = self.preload_data.write(tmp2)
+                print("Re-serialized {0} of {1} level objects and {2} of {3} preload objects".format(
+                    level_reserialized, len(self.level_data.objects),
+                    preload_reserialized, len(self.preload_data.objects)))
 
                 obj_out_path = resolve_case_insensitive_join(base, levelpaths.objectpath)
                 if levelpaths.objectpath.endswith(".gz"):
@@ -596,29 +657,33 @@ class EditorFileMenu(QMenu):
                                     "If you are using save states, you have to restart the game and set a new savestate.",
                                     self)
 
-                if levelpaths.resourcepath.endswith(".gz"):
-                    self.resource_archive.set_additional_padding(0)
-                    out = BytesIO()
-                    self.resource_archive.write(out)
-
-                    res_out_path = resolve_case_insensitive_join(base, levelpaths.resourcepath)
-                    with gzip.open(res_out_path, "wb") as f:
-                        f.write(out.getvalue())
-                else:
-                    self.resource_archive.set_additional_padding(0)
-                    if levelpaths.respadding is not None:
-                        tmp = BytesIO()
-                        self.resource_archive.write(tmp)
-                        padding = levelpaths.respadding-len(tmp.getvalue())
-                        if padding > 0:
-                            self.resource_archive.set_additional_padding(padding)
-
-                    out = BytesIO()
-                    self.resource_archive.write(out)
-
-                    res_out_path = resolve_case_insensitive_join(base, levelpaths.resourcepath)
-                    with open(res_out_path, "wb") as f:
-                        f.write(out.getvalue())
+                # The archive is written straight to the file, the padding is worked out from
+                # the section sizes beforehand.
+                self.resource_archive.set_additional_padding(0)
+                if not levelpaths.resourcepath.endswith(".gz") and levelpaths.respadding is not None:
+                    padding = levelpaths.respadding-self.resource_archive.packed_size()
+                    if padding > 0:
+                        self.resource_archive.set_additional_padding(padding)
+
+                # The archive may still be memory mapped from the file we are about to overwrite
+                if self.editor.level_view.bwmodelhandler is not None:
+                    self.editor.level_view.bwmodelhandler.detach()
+                self.resource_archive.detach()
+                res_out_path = resolve_case_insensitive_join(base, levelpaths.resourcepath)
+                # Written next to the original which is only replaced once writing succeeded
+                res_tmp_path = res_out_path + ".tmp"
+                try:
+                    if levelpaths.resourcepath.endswith(".gz"):
+                        with gzip.open(res_tmp_path, "wb") as f:
+                            self.resource_archive.write(f)
+                    else:
+                        with open(res_tmp_path, "wb") as f:
+                            self.resource_archive.write(f)
+                    os.replace(res_tmp_path, res_out_path)
+                except:
+                    if os.path.exists(res_tmp_path):
+                        os.remove(res_tmp_path)
+                    raise
 
 
                 tmp = BytesIO()
@@ -283,6 +283,7 @@ class EditorMenuBar(QtWidgets.QMenuBar):
                     mtx = obj.getmatrix().mtx
                     for i in range(16):
                         mtx[i] = obj.mtxoverride[i]
+                    obj.mark_dirty()
                     obj.update_xml()
 
     def reset_hook(self):
@@ -12,7 +12,7 @@ if TYPE_CHECKING:
 from widgets.editor_widgets import open_error_dialog
 from widgets.tree_view import LevelDataTreeView, ObjectGroup, NamedItem
 from widgets.menu.menubar import Menu
-from lib.searchquery import create_query, find_best_fit, autocompletefull, QueryDepthTooDeepError
+from lib.searchquery import create_query, compile_query, find_best_fit, autocompletefull, QueryDepthTooDeepError
 from lib.BattalionXMLLib import BattalionObject
 from widgets.lua_search_widgets import LuaSearchResultItem
 import typing
@@ -634,21 +634,17 @@ class SearchWidget(QtWidgets.QMainWindow):
             else:
                 searchquery = self.queryinput.toPlainText().replace("\n", "")
                 try:
-                    query = create_query(searchquery)
+                    query = compile_query(searchquery)
                 except Exception as err:
                     open_error_dialog("Cannot save: Search query has syntax errors.", self)
                     return
 
                 try:
-                    for object in self.editor.level_file.objects.values():
-                        if query.evaluate(object):
-                            values = query.get_values(object)
-                            objects.append((object, values))
+                    level_file = self.editor.level_file
+                    objects.extend(query.search(level_file.objects.values(), level_file.get_search_index()))
                     print("searched all level file objects")
-                    for object in self.editor.preload_file.objects.values():
-                        if query.evaluate(object):
-                            values = query.get_values(object)
-                            objects.append((object, values))
+                    preload_file = self.editor.preload_file
+                    objects.extend(query.search(preload_file.objects.values(), preload_file.get_search_index()))
                     print("searched all preload objects")
                 except QueryDepthTooDeepError as err:
                     open_error_dialog(str(err), self)
@@ -125,9 +125,9 @@ class PikminSideWidget(QWidget):
 
         self.main_window = None
         self.editwindows = []
-        self.parent.level_view.select_update.connect(self.update_main_edit_window)
+        self.parent.level_view.selection_changed.connect(self.update_main_edit_window)
 
-    def update_main_edit_window(self):
+    def update_main_edit_window(self, added, removed):
         if self.main_window is not None:
             obj = self.parent.get_selected_obj()
             if obj is not None and self.main_window.object != obj and self.main_window.is_autoupdate:
@@ -170,6 +170,7 @@ class PikminSideWidget(QWidget):
             if hasattr(obj, "spawnMatrix") and hasattr(obj, "Mat"):
                 for i in range(16):
                     obj.spawnMatrix.mtx[i] = obj.Mat.mtx[i]
+                obj.mark_dirty()
         self.parent.level_view.do_redraw()
         self.parent.set_has_unsaved_changes(True)
 
@@ -224,7 +225,7 @@ class PikminSideWidget(QWidget):
             if hasattr(obj, "mPassenger"):
                 for i, v in enumerate(clone.mPassenger):
                     if v is not None:
-                        clone.mPassenger[i] = self._copy_object(clone.mPassenger[i], 5, 5)
+                        clone.set_element("mPassenger", i, self._copy_object(clone.mPassenger[i], 5, 5))
                         newclones.append(clone.mPassenger[i])
 
         if not code_clone:
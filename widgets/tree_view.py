@@ -233,6 +233,7 @@ class LevelDataTreeView(QTreeWidget):
         self.effects = None
         self.preload = None
         self.other: ObjectGroup = None
+        self.object_items = {}  # object -> NamedItem
 
         self.setup_groups()
 
@@ -375,6 +376,7 @@ class LevelDataTreeView(QTreeWidget):
         for section in (self.other, self.units, self.components, self.mapobjects, self.scenery,
                         self.assets, self.hud, self.scripts, self.effects, self.preload):
             section.remove_children()
+        self.object_items = {}
 
     def choose_category(self, objecttype):
         if objecttype in self._categorydistribution:
@@ -440,6 +442,7 @@ class LevelDataTreeView(QTreeWidget):
                         unused = True
 
             item = NamedItem(parent, name, object)
+            self.object_items[object] = item
             itemflag = QtCore.Qt.ItemFlag
             item.setFlags(itemflag.ItemIsEnabled | itemflag.ItemIsSelectable | itemflag.ItemIsEditable)
 
@@ -466,6 +469,9 @@ class LevelDataTreeView(QTreeWidget):
                         item2.setExpanded(True)
             self.verticalScrollBar().setValue(scrollvalue)
 
+    def get_item(self, obj):
+        return self.object_items.get(obj)
+
     def updatenames(self):
         levelsettings = None
         damagesettings = []